@@ -11,7 +11,9 @@ from trac.db import Table, Column, Index
 # The TracPM environment
 name = 'TracPM'
 # Version 1 is the current schedule and history
-version = 1
+# Version 2 adds the reschedule queue and schedule checkpoints and
+# flags schedule changes that idle a ticket
+version = 2
 
 # The schedule table holds the current calculated start and finish for
 # each ticket
@@ -22,6 +24,9 @@ tables = [
          Column('finish', type='int64'),
          Index(['ticket']),
      ],
+     # idled is 1 for changes that took the ticket out of the schedule
+     # (new start and finish are NULL or, if it was closed, its final
+     # dates).
      Table('schedule_change', key=('ticket', 'time')) [
          Column('ticket', type='int'),
          Column('time', type='int64'),
@@ -29,7 +34,37 @@ tables = [
          Column('oldfinish', type='int64'),
          Column('newstart', type='int64'),
          Column('newfinish', type='int64'),
+         Column('idled', type='int'),
          Index(['ticket']),
          Index(['time']),
      ],
+     # Ticket changes waiting for the rescheduler (see "trac-admin pm
+     # worker").  old_values is the change listener's old values as JSON.
+     # claim identifies the worker handling the change (NULL until one
+     # does) and claim_time is when it took it.
+     Table('pm_reschedule_queue', key=('id')) [
+         Column('id', auto_increment=True),
+         Column('ticket', type='int'),
+         Column('time', type='int64'),
+         Column('old_values'),
+         Column('claim'),
+         Column('claim_time', type='int64'),
+         Index(['ticket']),
+         Index(['claim']),
+     ],
+     # Copies of the schedule table taken from time to time so past
+     # schedules can be rebuilt without replaying all of
+     # schedule_change.  data is the rows as compressed JSON.
+     Table('schedule_checkpoint', key=('time')) [
+         Column('time', type='int64'),
+         Column('data'),
+     ],
     ]
+
+# The version that added each table, for upgrades
+table_versions = {
+    'schedule': 1,
+    'schedule_change': 1,
+    'pm_reschedule_queue': 2,
+    'schedule_checkpoint': 2,
+    }
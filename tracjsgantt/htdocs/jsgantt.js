@@ -122,9 +122,10 @@ function mouseDown(e) {
 * @param pDepend {String} Comma seperated list of IDs this task depends on
 * @param pCaption {String} Caption to be used instead of default caption (Resource). 
 * note : you should use setCaption("Caption") in order to display the caption
+* @param pLazy {Boolean} Group whose children are loaded when it is opened (see JSGantt.loadChildren()).  Its start, end, and completion are used until then.
 * @return void
 */
-JSGantt.TaskItem = function(g, pID, pName, pStart, pEnd, pDisplay, pLink, pMile, pRes, pComp, pGroup, pParent, pOpen, pDepend, pCaption)
+JSGantt.TaskItem = function(g, pID, pName, pStart, pEnd, pDisplay, pLink, pMile, pRes, pComp, pGroup, pParent, pOpen, pDepend, pCaption, pLazy)
 {
 
 /**
@@ -271,6 +272,14 @@ var vParent = pParent;
 */    
 var vOpen   = pOpen;
 
+/**
+* @property vLazy 
+* @type Number 
+* @default pLazy
+* @private
+*/    
+var vLazy   = pLazy ? 1 : 0;
+
 /**
 * @property vDepend 
 * @type String 
@@ -321,10 +330,12 @@ var vVisible  = 1;
       var x1, y1, x2, y2;
 
 
-      if (vGroup != 1)
+      if (vGroup != 1 || vLazy)
       {  
-         vStart = JSGantt.parseDateStr(pStart,g.getDateInputFormat());
-         vEnd   = JSGantt.parseDateStr(pEnd,g.getDateInputFormat());
+         vStart = (pStart instanceof Date) ? pStart :
+             JSGantt.parseDateStr(pStart,g.getDateInputFormat());
+         vEnd   = (pEnd instanceof Date) ? pEnd :
+             JSGantt.parseDateStr(pEnd,g.getDateInputFormat());
       }
 /**
 * Returns task ID
@@ -498,6 +509,13 @@ this.getName     = function(){ return htmlspecialchars(vName) };
 * @return {Boolean}
 */    this.getLevel    = function(){ return vLevel };
 
+/**
+* Returns whether the task's children are still to be loaded: 0 if
+* not, 1 if they are, 2 while they are loading
+* @method getLazy
+* @return {Number}
+*/    this.getLazy     = function(){ return vLazy };
+
 /**
 * Returns the number of child tasks
 * @method getNumKids
@@ -568,6 +586,13 @@ this.getName     = function(){ return htmlspecialchars(vName) };
 * @return {void}
 */    this.setNumKid   = function(pNumKid){ vNumKid = pNumKid;};
 
+/**
+* Set whether the task's children are still to be loaded (see getLazy())
+* @method setLazy
+* @param pLazy {Number}
+* @return {void}
+*/    this.setLazy     = function(pLazy){ vLazy = pLazy;};
+
 /**
 * Set task work
 * @method setWorkVal
@@ -750,6 +775,13 @@ JSGantt.GanttChart =  function(pGanttVar, pDiv, pFormat, pShowDep)
 * @private
 */var vScrollDateStr = null;
 /**
+* URL to load tasks from (see JSGantt.loadChildren())
+* @property vTaskDataURL
+* @type String
+* @default null
+* @private
+*/var vTaskDataURL = null;
+/**
 * Popup-window features (width, height, scroll bars, etc.)
 * @property vPopupFeatures
 * @type String 
@@ -847,6 +879,12 @@ JSGantt.GanttChart =  function(pGanttVar, pDiv, pFormat, pShowDep)
 * @return {void}
 */      this.setScrollDate = function(pDateStr) { vScrollDateStr = pDateStr; };
 /**
+* URL to load the children of lazy tasks from
+* @param pURL {String}
+* @method setTaskDataURL
+* @return {void}
+*/      this.setTaskDataURL = function(pURL) { vTaskDataURL = pURL; };
+/**
 * Popup window features
 * @param pPopupFeatures {String} 
 * @method setPopupFeatures
@@ -912,6 +950,11 @@ Complete-Displays task percent complete</p>
 * @return {String}
 */  this.getDateInputFormat = function() { return vDateInputFormat };
 /**
+* Returns the URL to load the children of lazy tasks from
+* @method getTaskDataURL
+* @return {String}
+*/  this.getTaskDataURL = function() { return vTaskDataURL };
+/**
 * Returns current display format
 * @method getDateDisplayFormat
 * @return {String}
@@ -1737,7 +1780,7 @@ Complete-Displays task percent complete</p>
                 else
                 {
                     vTaskRight = (Date.parse(vTaskList[i].getEnd()) - Date.parse(vTaskList[i].getStart())) / (24 * 60 * 60 * 1000) + 1/vColUnit;
-                    vTaskLeft = Math.ceil((Date.parse(vTaskList[i].getStart()) - Date.parse(vMinDate)) / (24 * 60 * 60 * 1000));
+                    vTaskLeft = Math.ceil((Date.parse(vTaskList[i].getStart()) - Date.parse(vMinDate)) / (24 * 60 * 60 * 1000));
                     if (vFormat='day')
                     {
                         vTaskRight += 1;
@@ -1963,7 +2006,8 @@ JSGantt.processRows = function(pList, pID, pRow, pLevel, pOpen)
         }
     }
 
-    if (pRow >= 0) {
+    // Lazy groups keep their own values until their children load.
+    if (pRow >= 0 && !pList[pRow].getLazy()) {
         pList[pRow].setStart(vMinDate);
         pList[pRow].setEnd(vMaxDate);
         pList[pRow].setNumKid(vNumKid);
@@ -2250,6 +2294,10 @@ JSGantt.folder= function (pID,ganttObj) {
             else
              {JSGantt.findObj(objID).textContent = '+';}
 				
+         } else if (vList[i].getLazy()) {
+
+            JSGantt.loadChildren(pID, ganttObj);
+
          } else {
 
             vList[i].setOpen(1);
@@ -2425,6 +2473,79 @@ JSGantt.parseDateStr = function(pDateStr,pFormatStr) {
     
 };
 
+/**
+* Add tasks to a chart from a list of task records
+*
+* Each record is a list of the arguments to JSGantt.TaskItem() after
+* the chart.  Start and end dates are milliseconds from the epoch to
+* the wall clock time in UTC; the task starts and ends at that wall
+* clock time in the browser's time zone.
+*
+* @method addTaskData
+* @param g {GanttChart} - The chart to add the tasks to
+* @param pTasks {Array} - Task records
+* @param pAfterID {Number} - If given, the tasks are inserted after this task (instead of at the end)
+* @return void
+*/
+JSGantt.addTaskData = function(g, pTasks, pAfterID) {
+   function wallClock(pMS) {
+      var vUTC = new Date(pMS);
+      return new Date(vUTC.getUTCFullYear(), vUTC.getUTCMonth(),
+                      vUTC.getUTCDate(), vUTC.getUTCHours(),
+                      vUTC.getUTCMinutes(), vUTC.getUTCSeconds());
+   }
+
+   var vList = g.getList();
+   var vRow = vList.length;
+   if (pAfterID != undefined) {
+      vRow = g.getArrayLocationByID(pAfterID) + 1;
+   }
+
+   for (var i = 0; i < pTasks.length; i++) {
+      var r = pTasks[i];
+      vList.splice(vRow + i, 0,
+                   new JSGantt.TaskItem(g, r[0], r[1],
+                                        wallClock(r[2]), wallClock(r[3]),
+                                        r[4], r[5], r[6], r[7], r[8],
+                                        r[9], r[10], r[11], r[12], r[13],
+                                        r[14]));
+   }
+};
+
+/**
+* Load the children of a lazy task from the chart's task data URL and
+* show them.  Does nothing if they are already loading.
+*
+* @method loadChildren
+* @param pID {Number} - Task ID
+* @param ganttObj {GanttChart} - The gantt object
+* @return void
+*/
+JSGantt.loadChildren = function(pID, ganttObj) {
+   var vURL = ganttObj.getTaskDataURL();
+   if (!vURL) {
+      return;
+   }
+   vURL += (vURL.indexOf('?') == -1 ? '?' : '&') + '_children_of=' + pID;
+
+   var vTask = ganttObj.getList()[ganttObj.getArrayLocationByID(pID)];
+   if (vTask.getLazy() != 1) {
+      return;
+   }
+   vTask.setLazy(2);
+
+   jQuery.getJSON(vURL, function(pTasks) {
+      vTask.setLazy(0);
+      vTask.setOpen(1);
+      JSGantt.addTaskData(ganttObj, pTasks, pID);
+      ganttObj.Draw();
+      ganttObj.DrawDependencies();
+   }).fail(function() {
+      // Let the user try again.
+      vTask.setLazy(1);
+   });
+};
+
 /**
 * Display a formatted date based on gantt date format setting as defined in JSGantt.GanttChart.setDateDisplayFormat()
 *
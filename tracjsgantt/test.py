@@ -8,16 +8,20 @@
 
 import sys
 import os
+import re
 import tempfile
 import shutil
 import unittest
 import pprint
 import filecmp
 import copy
+import threading
+from StringIO import StringIO
 
 from trac.web.api import Request
 from trac.env import Environment
 from trac.core import TracError
+from trac.ticket.query import Query
 
 from tracpm import *
 
@@ -38,6 +42,15 @@ class TracPMTestCase(unittest.TestCase):
         open(os.path.join(os.path.join(instancedir, 'conf'), 'trac.ini'), 'a').write('\n' + configuration + '\n')
         return Environment(instancedir)
 
+    # Put schedule_change back as it was before the idled column.
+    def _dropIdled(self, env):
+        env.db_transaction("CREATE TABLE schedule_change_old AS SELECT"
+                           " ticket, time, oldstart, oldfinish,"
+                           " newstart, newfinish FROM schedule_change")
+        env.db_transaction("DROP TABLE schedule_change")
+        env.db_transaction("ALTER TABLE schedule_change_old"
+                           " RENAME TO schedule_change")
+
     def _get_data(self, env, options, tickets):
         pm = TracPM(env)
         pm.recomputeSchedule(options, tickets)
@@ -102,6 +115,1079 @@ class TracPMTestCase(unittest.TestCase):
 
         self._do_test_diffs(env, options, tickets, self._get_data, 'test_resource_leveling_1_ASAP')
 
+    def test_load_tickets(self):
+        env = self._setup('[TracPM]\nfields.estimate = estimatedhours\n' +
+                          'date_format = %Y-%m-%d\n' +
+                          '[ticket-custom]\nestimatedhours = text\n' +
+                          '[components]\ntracpm.* = enabled\n')
+        env.upgrade()
+
+        for owner, est in [('Monty', '6'), ('Phred', ''), ('Monty', '9')]:
+            ticket = Ticket(env)
+            ticket['summary'] = 'Task for %s' % owner
+            ticket['owner'] = owner
+            ticket['status'] = 'new'
+            if est:
+                ticket['estimatedhours'] = est
+            ticket.insert()
+
+        pm = TracPM(env)
+        tickets = pm.loadTickets(set(['summary']), ['3', '1'])
+        self.assertEquals([1, 3], [t['id'] for t in tickets])
+        self.assertEquals(['6', '9'], [t['estimatedhours'] for t in tickets])
+        self.assertEquals('Task for Monty', tickets[0]['summary'])
+
+        tickets = pm.loadTickets(set(), constraints={'owner': ['Phred']})
+        self.assertEquals([2], [t['id'] for t in tickets])
+        self.assertEquals('', tickets[0]['estimatedhours'])
+
+        # Simple queries are loaded directly and match Trac's Query.
+        self.assertEquals({'owner': ['Monty']},
+                          pm._simpleConstraints({'owner': 'Monty', 'max': 0}))
+        self.assertEquals(None, pm._simpleConstraints({'owner!': 'Monty'}))
+        direct = pm.query({'owner': 'Monty'}, set(['summary']))
+        tickets = Query.from_string(env, 'owner=Monty&col=summary&max=0') \
+            .execute()
+        self.assertEquals([t['id'] for t in tickets],
+                          [t['id'] for t in direct if t['id'] > 0])
+
+        # Date ranges and cut-off results are left to Query.
+        self.assertEquals(None, pm._simpleConstraints({'time': '2014-1-1..'}))
+        env.db_transaction("UPDATE ticket SET priority='critical' WHERE id=3")
+        direct = pm.query({'owner': 'Monty', 'max': 1}, set())
+        self.assertEquals([3], [t['id'] for t in direct if t['id'] > 0])
+
+    def test_iter_query(self):
+        env = self._setup('[TracPM]\nfields.estimate = estimatedhours\n' +
+                          'fields.parent = parent\n' +
+                          'date_format = %Y-%m-%d\n' +
+                          '[ticket-custom]\nestimatedhours = text\n' +
+                          'parent = text\n' +
+                          '[components]\ntracpm.* = enabled\n')
+        env.upgrade()
+
+        for parent in ['', '1', '1']:
+            ticket = Ticket(env)
+            ticket['summary'] = 'Task'
+            ticket['status'] = 'new'
+            ticket['parent'] = parent
+            ticket.insert()
+
+        # Links between batches are kept.
+        pm = TracPM(env)
+        tickets = list(pm.iterQuery({'id': '1|2|3'}, set(), batchSize=1))
+        self.assertEquals([1, 2, 3], [t['id'] for t in tickets])
+        self.assertEquals([2, 3], pm.children(tickets[0]))
+        self.assertEquals(1, pm.parent(tickets[2]))
+
+        queried = dict([(t['id'], t) for t in pm.query({'id': '1|2|3'},
+                                                       set())])
+        for t in tickets:
+            self.assertEquals(pm.children(queried[t['id']]), pm.children(t))
+
+    def test_milestone_rows_cached_per_request(self):
+        env = self._setup('[TracPM]\nfields.estimate = estimatedhours\n' +
+                          'date_format = %Y-%m-%d\n' +
+                          '[ticket-custom]\nestimatedhours = text\n' +
+                          '[components]\ntracpm.* = enabled\n')
+        env.upgrade()
+
+        for milestone in ['milestone1', 'milestone1', 'milestone2']:
+            ticket = Ticket(env)
+            ticket['summary'] = 'Task'
+            ticket['status'] = 'new'
+            ticket['milestone'] = milestone
+            ticket.insert()
+
+        class FakeRequest(object):
+            path_info = '/'
+        req = FakeRequest()
+
+        pm = TracPM(env)
+        tickets = pm.query({'milestone': 'milestone1|milestone3'}, set(), req)
+        milestones = [t['milestone'] for t in tickets if t['id'] < 0]
+        self.assertEquals(['milestone1', 'milestone3'], milestones)
+
+        # Later queries in the same request don't read the rows again.
+        env.db_transaction("DELETE FROM milestone WHERE name=%s",
+                           ('milestone1',))
+        tickets = pm.query({'milestone': 'milestone1'}, set(), req)
+        self.assertEquals(['milestone1'],
+                          [t['milestone'] for t in tickets if t['id'] < 0])
+        tickets = pm.query({'milestone': 'milestone1'}, set())
+        self.assertEquals([], [t for t in tickets if t['id'] < 0])
+
+    def test_enum_and_user_maps(self):
+        from trac.ticket.model import Priority
+        env = self._setup()
+        env.upgrade()
+
+        pm = TracPM(env)
+        prioMap = pm.enumMap('priority')
+        self.assertEquals(1, prioMap['blocker'])
+        self.assertTrue(prioMap is pm.enumMap('priority'))
+
+        # Changing an enum rebuilds the maps.
+        priority = Priority(env)
+        priority.name = 'urgent'
+        priority.insert()
+        self.assertEquals(6, pm.enumMap('priority')['urgent'])
+
+        env.db_transaction("INSERT INTO session VALUES (%s,1,0)", ('monty',))
+        env.db_transaction("INSERT INTO session_attribute "
+                           "VALUES (%s,1,'name',%s)", ('monty', 'Monty'))
+        env.invalidate_known_users_cache()
+        names = pm.userNames()
+        self.assertEquals({'monty': 'Monty'}, names)
+        self.assertTrue(names is pm.userNames())
+
+    def test_parse_dates(self):
+        env = self._setup()
+        pm = TracPM(env)
+
+        d = pm.parseDbDate('2014-3-07')
+        self.assertEquals(datetime(2014, 3, 7, tzinfo=localtz), d)
+        self.assertTrue(d is pm.parseDbDate('2014-3-07'))
+        self.assertRaises(ValueError, pm.parseDbDate, '2014-03-07x')
+        self.assertRaises(ValueError, pm.parseDbDate, '2014-13-07')
+
+        # Dates are converted once per value.
+        ticket = {'id': 1, 'estimatedhours': 6, '_sched_start': 1394150400000000}
+        start = pm.start(ticket)
+        self.assertTrue(start is pm.start(ticket))
+        ticket['_sched_start'] += 86400000000
+        self.assertEquals(timedelta(days=1), pm.start(ticket) - start)
+
+    def test_augment_tickets(self):
+        env = self._setup('[TracPM]\nfields.estimate = estimatedhours\n' +
+                          'fields.parent = parent\n' +
+                          'fields.pred = blockedby\n' +
+                          'fields.succ = blocking\n' +
+                          '[components]\ntracpm.* = enabled\n')
+        pm = TracPM(env)
+
+        # 1 is blocked by 9; 2 and 3 are its children, in sequence
+        # (2 blocks 3); 4 is a child of 2.
+        def task(tid, parent, children, pred, succ):
+            return {'id': tid, 'parent': parent, 'children': children,
+                    'blockedby': pred, 'blocking': succ}
+        ticketsByID = {
+            1: task(1, [], [2, 3], [9], []),
+            2: task(2, [1], [4], [], [3]),
+            3: task(3, [1], [], [2], []),
+            4: task(4, [2], [], [], []),
+            9: task(9, [], [], [], [1]),
+            }
+        pm.augmentTickets(ticketsByID)
+
+        self.assertEquals([9], ticketsByID[2]['blockedby'])
+        self.assertEquals([2, 4], ticketsByID[3]['blockedby'])
+        self.assertEquals([9], ticketsByID[4]['blockedby'])
+        self.assertEquals([1, 2, 4], ticketsByID[9]['blocking'])
+
+    def test_background_reschedule(self):
+        env = self._setup('[TracPM]\nfields.estimate = estimatedhours\n' +
+                          'date_format = %Y-%m-%d\n' +
+                          'reschedule_mode = background\n' +
+                          'reschedule_debounce = 0.5\n' +
+                          '[ticket-custom]\nestimatedhours = text\n' +
+                          '[components]\ntracpm.* = enabled\n')
+        env.upgrade()
+
+        # A burst of changes is queued and rescheduled once.
+        for i in range(3):
+            ticket = Ticket(env)
+            ticket['summary'] = 'Task'
+            ticket['status'] = 'new'
+            ticket.insert()
+        rescheduler = TicketRescheduler(env)
+        self.assertEquals(3, rescheduler.rescheduleStatus()['queued'])
+
+        for i in range(50):
+            if rescheduler.rescheduleStatus()['lastRun']:
+                break
+            time.sleep(0.1)
+        status = rescheduler.rescheduleStatus()
+        self.assertEquals(0, status['queued'])
+        self.assertEquals(3, status['lastRunCount'])
+        self.assertTrue(status['lastRunDuration'] is not None)
+
+        changes = {'1': {'owner': 'Monty'}}
+        rescheduler.mergeChanges(changes, {'1': {'owner': 'Phred',
+                                                 'status': 'new'}})
+        self.assertEquals({'1': {'owner': 'Monty', 'status': 'new'}}, changes)
+
+    def test_request_deferred_reschedule(self):
+        env = self._setup('[TracPM]\nfields.estimate = estimatedhours\n' +
+                          'date_format = %Y-%m-%d\n' +
+                          '[ticket-custom]\nestimatedhours = text\n' +
+                          '[components]\ntracpm.* = enabled\n')
+        env.upgrade()
+
+        rescheduler = TicketRescheduler(env)
+        calls = []
+        rescheduler.rescheduleChanges = calls.append
+
+        class FakeRequest(object):
+            def __init__(self, path='/ticket/2', method='POST'):
+                self.path_info = path
+                self.method = method
+                self.listeners = []
+            def add_redirect_listener(self, listener):
+                self.listeners.append(listener)
+            def redirect(self, url):
+                for listener in self.listeners:
+                    listener(self, url, False)
+
+        # Changes in a request are rescheduled once, when it redirects.
+        req = FakeRequest('/newticket')
+        rescheduler.pre_process_request(req, None)
+        for i in range(2):
+            ticket = Ticket(env)
+            ticket['summary'] = 'Task'
+            ticket['status'] = 'new'
+            ticket.insert()
+        ticket['owner'] = 'Monty'
+        ticket.save_changes('Phred')
+        self.assertEquals([], calls)
+        req.redirect('/ticket/2')
+        self.assertEquals([{'1': {}, '2': {'owner': ''}}], calls)
+
+        # Outside a request, changes are rescheduled right away.
+        ticket['owner'] = 'Phred'
+        ticket.save_changes('Monty')
+        self.assertEquals({'2': {'owner': 'Monty'}}, calls[-1])
+
+        # Or when the request is post-processed (also done on errors).
+        rescheduler.pre_process_request(FakeRequest(), None)
+        ticket['owner'] = 'Monty'
+        ticket.save_changes('Phred')
+        self.assertEquals(2, len(calls))
+        rescheduler.post_process_request(req, None, None, None)
+        self.assertEquals({'2': {'owner': 'Phred'}}, calls[-1])
+
+        # Requests that may send their own response (and so not be
+        # post-processed) don't defer.
+        for path, method, owner, oldOwner in \
+                [('/xmlrpc', 'POST', 'Zed', 'Monty'),
+                 ('/ticket/2', 'GET', 'Monty', 'Zed')]:
+            rescheduler.pre_process_request(FakeRequest(path, method),
+                                            None)
+            ticket['owner'] = owner
+            ticket.save_changes('Monty')
+            self.assertEquals({'2': {'owner': oldOwner}}, calls[-1])
+        self.assertEquals(5, len(calls))
+
+        # Changes a deferring request left are handled when the next
+        # request starts, not with its changes.
+        rescheduler.pre_process_request(FakeRequest(), None)
+        ticket['owner'] = 'Phred'
+        ticket.save_changes('Monty')
+        rescheduler.pre_process_request(FakeRequest(), None)
+        self.assertEquals({'2': {'owner': 'Monty'}}, calls[-1])
+        rescheduler.post_process_request(req, None, None, None)
+        self.assertEquals(6, len(calls))
+
+    def test_reschedule_queue(self):
+        env = self._setup('[TracPM]\nfields.estimate = estimatedhours\n' +
+                          'date_format = %Y-%m-%d\n' +
+                          'reschedule_mode = queue\n' +
+                          'reschedule_queue_batch = 2\n' +
+                          '[ticket-custom]\nestimatedhours = text\n' +
+                          '[components]\ntracpm.* = enabled\n')
+        env.upgrade()
+
+        # Upgrading from version 1 adds only the newer tables.
+        env.db_transaction("DROP TABLE pm_reschedule_queue")
+        env.db_transaction("DROP TABLE schedule_checkpoint")
+        self._dropIdled(env)
+        env.db_transaction("UPDATE system SET value='1' WHERE name='TracPM'")
+        self.assertTrue(env.needs_upgrade())
+        env.upgrade()
+        self.assertFalse(env.needs_upgrade())
+
+        ticket = Ticket(env)
+        ticket['summary'] = 'Task'
+        ticket['status'] = 'new'
+        ticket.insert()
+        for owner in ['Monty', 'Phred']:
+            ticket['owner'] = owner
+            ticket.save_changes('Monty')
+        rescheduler = TicketRescheduler(env)
+        self.assertEquals(3, rescheduler.rescheduleStatus()['queued'])
+
+        # A worker only gets changes no other worker has claimed.
+        self.assertEquals([1, 2], [row[0] for row in
+                                   rescheduler._claimQueued('other')])
+        calls = []
+        rescheduler.rescheduleChanges = calls.append
+        self.assertEquals(1, rescheduler.drainQueue())
+        self.assertEquals([{'1': {'owner': 'Monty'}}], calls)
+        self.assertEquals(2, rescheduler.rescheduleStatus()['queued'])
+
+        # Stale claims are taken over.
+        env.db_transaction("UPDATE pm_reschedule_queue SET claim_time=0")
+        del calls[:]
+        self.assertEquals(2, rescheduler.drainQueue())
+        self.assertEquals([{'1': {'owner': ''}}], calls)
+        self.assertEquals(0, rescheduler.rescheduleStatus()['queued'])
+
+        # Unknown modes are reported and treated as sync.
+        env = self._setup('[TracPM]\nreschedule_mode = later\n' +
+                          '[components]\ntracpm.* = enabled\n')
+        self.assertEquals('sync', TicketRescheduler(env).rescheduleMode)
+
+    def test_find_affected(self):
+        env = self._setup('[TracPM]\nfields.estimate = estimatedhours\n' +
+                          'fields.parent = parent\n' +
+                          'date_format = %Y-%m-%d\n' +
+                          '[ticket-custom]\nestimatedhours = text\n' +
+                          'parent = text\n' +
+                          '[components]\ntracpm.* = enabled\n')
+        env.upgrade()
+
+        tickets = []
+        for owner, parent in [('Monty', ''), ('Phred', '1'),
+                              ('Phred', ''), ('Zed', '')]:
+            ticket = Ticket(env)
+            ticket['summary'] = 'Task'
+            ticket['status'] = 'new'
+            ticket['owner'] = owner
+            ticket['parent'] = parent
+            ticket.insert()
+            tickets.append(ticket)
+
+        # Linked tickets and open tickets of their owners are affected.
+        rescheduler = TicketRescheduler(env)
+        self.assertEquals(['1', '2', '3'],
+                          sorted(rescheduler._findAffected('1', {})))
+
+        # Changes are picked up from the database.
+        env.db_transaction("UPDATE ticket_custom SET value='1'"
+                           " WHERE ticket=4 AND name='parent'")
+        env.db_transaction("UPDATE ticket SET changetime=changetime+1"
+                           " WHERE id=4")
+        self.assertEquals(['1', '2', '3', '4'],
+                          sorted(rescheduler._findAffected('1', {})))
+
+        # And from the change listener.
+        tickets[2]['status'] = 'closed'
+        tickets[2].save_changes('Monty')
+        self.assertEquals(['1', '2', '4'],
+                          sorted(rescheduler._findAffected('1', {})))
+        self.assertEquals(['1', '2', '4'],
+                          sorted(rescheduler._findAffected(
+                    '1', {'owner': 'Phred'})))
+
+    def test_update_schedule_db(self):
+        env = self._setup()
+        env.upgrade()
+
+        rescheduler = TicketRescheduler(env)
+        rescheduler.writeChunkSize = 1
+        day = datetime(2014, 3, 7, tzinfo=localtz)
+        tickets = [{'id': tid, 'status': 'new',
+                    '_calc_start': [day, True],
+                    '_calc_finish': [day + timedelta(days=tid), True]}
+                   for tid in [1, 2, 3]]
+
+        def history():
+            return env.db_query("SELECT ticket, oldfinish, newfinish"
+                                " FROM schedule_change ORDER BY ticket")
+
+        rescheduler._updateScheduleDB([], tickets, [])
+        self.assertEquals(3, len(history()))
+
+        # Only changed schedules are written.
+        env.db_transaction("DELETE FROM schedule_change")
+        tickets[1]['_calc_finish'] = [day + timedelta(days=5), True]
+        profile = []
+        rescheduler._updateScheduleDB([], tickets, profile)
+        self.assertEquals([(2, to_utimestamp(day + timedelta(days=2)),
+                            to_utimestamp(day + timedelta(days=5)))],
+                          history())
+        self.assertEquals([('updating', 1), ('inserting', 0)],
+                          [tuple(step[:2]) for step in profile])
+        self.assertEquals([(to_utimestamp(day + timedelta(days=5)),)],
+                          env.db_query("SELECT finish FROM schedule"
+                                       " WHERE ticket=2"))
+
+        # Idle tickets leave the schedule.
+        rescheduler._updateScheduleDB(tickets[:2], [], [])
+        self.assertEquals([(3,)], env.db_query("SELECT ticket FROM schedule"))
+
+    def test_compact_history(self):
+        env = self._setup('[TracPM]\nfields.estimate = estimatedhours\n' +
+                          'history_detail_days = 10\n' +
+                          'history_bucket_hours = 24\n' +
+                          'history_retention_days = 100\n' +
+                          '[components]\ntracpm.* = enabled\n')
+        env.upgrade()
+
+        now = datetime(2014, 6, 1, 12, tzinfo=localtz)
+        def ts(days, hours=0):
+            return to_utimestamp(now - timedelta(days=days, hours=hours))
+        # Ticket 1 moves: first change 200 days ago, two too old to
+        # keep, three on one day 20 days ago, one back and forth on
+        # another day, one recent.
+        rows = [(ts(200), None, 1), (ts(150), 1, 2), (ts(120), 2, 3),
+                (ts(20, 3), 3, 4), (ts(20, 2), 4, 5), (ts(20, 1), 5, 6),
+                (ts(15, 2), 6, 7), (ts(15, 1), 7, 6),
+                (ts(1), 6, 8)]
+        for when, old, new in rows:
+            env.db_transaction("INSERT INTO schedule_change"
+                               " (ticket, time, oldfinish, newfinish)"
+                               " VALUES (1,%s,%s,%s)", (when, old, new))
+
+        rescheduler = TicketRescheduler(env)
+        self.assertEquals([1, 6, 1], rescheduler.compactHistory(now))
+        self.assertEquals([(ts(200), None, 1), (ts(20, 1), 3, 6),
+                           (ts(1), 6, 8)],
+                          env.db_query("SELECT time, oldfinish, newfinish"
+                                       " FROM schedule_change"
+                                       " ORDER BY time"))
+
+        # Ticket 2 closes alone on one day and right after a change on
+        # another, then is reopened.  It stays out of the schedule
+        # while closed.
+        rows = [(ts(200), None, 1, None), (ts(30), 1, 2, 1),
+                (ts(25), None, 3, None), (ts(20, 3), 3, 4, None),
+                (ts(20, 2), 4, 4, 1), (ts(1), None, 5, None)]
+        for when, old, new, idled in rows:
+            env.db_transaction("INSERT INTO schedule_change"
+                               " (ticket, time, oldfinish, newfinish, idled)"
+                               " VALUES (2,%s,%s,%s,%s)",
+                               (when, old, new, idled))
+        self.assertEquals([2, 0, 0], rescheduler.compactHistory(now))
+        self.assertEquals(6, len(env.db_query("SELECT * FROM schedule_change"
+                                              " WHERE ticket=2")))
+        pm = TracPM(env)
+        self.assertFalse(2 in pm.scheduleAsOf(now - timedelta(days=28)))
+        self.assertTrue(2 in pm.scheduleAsOf(now - timedelta(days=22)))
+        self.assertFalse(2 in pm.scheduleAsOf(now - timedelta(days=10)))
+
+    def test_schedule_as_of(self):
+        env = self._setup()
+        env.upgrade()
+
+        rescheduler = TicketRescheduler(env)
+        pm = TracPM(env)
+        day = datetime(2014, 3, 7, tzinfo=localtz)
+        tickets = [{'id': tid, 'status': 'new',
+                    '_calc_start': [day, True],
+                    '_calc_finish': [day + timedelta(days=tid), True]}
+                   for tid in [1, 2]]
+
+        def schedule(tickets):
+            return dict([(t['id'], [t['_calc_start'][0],
+                                    t['_calc_finish'][0]])
+                         for t in tickets])
+
+        # Each update is a new point in history.
+        states = []
+        for days in [3, 4, 5]:
+            tickets[1]['_calc_finish'] = [day + timedelta(days=days), True]
+            rescheduler._updateScheduleDB([], tickets, [])
+            states.append((datetime.now(localtz), schedule(tickets)))
+            time.sleep(0.01)
+            if days == 4:
+                self.assertTrue(pm.checkpointSchedule(force=True))
+                time.sleep(0.01)
+        tickets[0]['status'] = 'closed'
+        rescheduler._updateScheduleDB(tickets[:1], [], [])
+        states.append((datetime.now(localtz), schedule(tickets[1:])))
+
+        # The first update and the forced one were checkpointed.
+        self.assertEquals(2, len(env.db_query("SELECT time FROM"
+                                              " schedule_checkpoint")))
+        self.assertEquals({}, pm.scheduleAsOf(day))
+        for when, expected in states:
+            self.assertEquals(expected, pm.scheduleAsOf(when))
+
+        # Upgrading from version 1 flags the changes that idled a
+        # ticket (rows for unchanged tickets had the same old and new
+        # dates, too) and checkpoints the schedule as of the last one.
+        finish = to_utimestamp(day + timedelta(days=5))
+        env.db_transaction("INSERT INTO schedule_change"
+                           " (ticket, time, oldstart, oldfinish,"
+                           " newstart, newfinish) VALUES (2,%s,%s,%s,%s,%s)",
+                           (to_utimestamp(states[-1][0]), to_utimestamp(day),
+                            finish, to_utimestamp(day), finish))
+        self._dropIdled(env)
+        env.db_transaction("DROP TABLE pm_reschedule_queue")
+        env.db_transaction("DROP TABLE schedule_checkpoint")
+        env.db_transaction("UPDATE system SET value='1' WHERE name='TracPM'")
+        self.assertTrue(env.needs_upgrade())
+        env.upgrade()
+        self.assertEquals([(to_utimestamp(states[-1][0]),)],
+                          env.db_query("SELECT time FROM"
+                                       " schedule_checkpoint"))
+        for when, expected in states:
+            self.assertEquals(expected, pm.scheduleAsOf(when))
+
+    def test_full_reschedule(self):
+        env = self._setup('[TracPM]\nfields.estimate = estimatedhours\n' +
+                          'fields.pred = blockedby\n' +
+                          'fields.succ = blocking\n' +
+                          'date_format = %Y-%m-%d\n' +
+                          '[ticket-custom]\nestimatedhours = text\n' +
+                          'blockedby = text\nblocking = text\n' +
+                          '[components]\ntracpm.* = enabled\n')
+        env.upgrade()
+
+        # Monty's two tasks for one goal, Phred's task for another
+        for owner, blocking, tickettype in [('Monty', '3', 'task'),
+                                            ('Monty', '3', 'task'),
+                                            ('', '', 'milestone'),
+                                            ('Phred', '5', 'task'),
+                                            ('', '', 'milestone')]:
+            ticket = Ticket(env)
+            ticket['summary'] = 'Task'
+            ticket['type'] = tickettype
+            ticket['owner'] = owner
+            ticket['estimatedhours'] = '8'
+            ticket['blocking'] = blocking
+            ticket['status'] = tickettype == 'milestone' and 'active' \
+                or 'new'
+            ticket.insert()
+
+        rescheduler = TicketRescheduler(env)
+        groups = rescheduler._independentGroups(
+            rescheduler.queryTickets(['1', '2', '3', '4', '5']))
+        self.assertEquals([[1, 2, 3], [4, 5]],
+                          sorted([sorted([t['id'] for t in group])
+                                  for group in groups]))
+
+        # Start from an empty schedule so every ticket is rescheduled.
+        env.db_transaction("DELETE FROM schedule")
+        nowActive, wasActive = rescheduler._activeTickets([])
+        self.assertEquals(set(['1', '2', '3', '4', '5']), nowActive)
+        idle, serial = rescheduler._reschedule(nowActive, wasActive, [],
+                                               dryRun=True)
+        idle, parallel = rescheduler._reschedule(nowActive, wasActive, [],
+                                                 dryRun=True, jobs=2)
+        def dates(tickets):
+            return sorted([(t['id'], t['_calc_start'][0],
+                            t['_calc_finish'][0]) for t in tickets])
+        self.assertEquals(5, len(serial))
+        self.assertEquals(dates(serial), dates(parallel))
+
+        nowActive, wasActive = rescheduler._activeTickets([], ['5'])
+        self.assertEquals((set(['4', '5']), set()), (nowActive, wasActive))
+
+        # Changes reschedule only the tickets they affect.
+        rescheduler._rescheduleLocked({'4': {}})
+        self.assertEquals([(4,), (5,)],
+                          env.db_query("SELECT ticket FROM schedule"
+                                       " ORDER BY ticket"))
+
+        # A dry run counts tickets whose dates would change and
+        # rescheduling a goal is always a dry run.
+        def reschedule(*args):
+            out = sys.stdout
+            sys.stdout = StringIO()
+            try:
+                rescheduler._do_reschedule(*args)
+                return sys.stdout.getvalue()
+            finally:
+                sys.stdout = out
+        self.assertTrue('3 tickets would get new dates, 0 idled'
+                        in reschedule('--dry-run'))
+        self.assertTrue('0 tickets would get new dates'
+                        in reschedule('--goal', '5'))
+        self.assertEquals([(4,), (5,)],
+                          env.db_query("SELECT ticket FROM schedule"
+                                       " ORDER BY ticket"))
+
+    def test_reschedule_on_delete(self):
+        env = self._setup('[TracPM]\nfields.estimate = estimatedhours\n' +
+                          'fields.pred = blockedby\n' +
+                          'fields.succ = blocking\n' +
+                          'date_format = %Y-%m-%d\n' +
+                          '[ticket-custom]\nestimatedhours = text\n' +
+                          'blockedby = text\nblocking = text\n' +
+                          '[components]\ntracpm.* = enabled\n')
+        env.upgrade()
+
+        # Monty's two tasks for a goal
+        for blocking, tickettype in [('3', 'task'), ('3', 'task'),
+                                     ('', 'milestone')]:
+            ticket = Ticket(env)
+            ticket['summary'] = 'Task'
+            ticket['type'] = tickettype
+            ticket['owner'] = tickettype == 'task' and 'Monty' or ''
+            ticket['estimatedhours'] = '8'
+            ticket['blocking'] = blocking
+            ticket['status'] = tickettype == 'milestone' and 'active' \
+                or 'new'
+            ticket.insert()
+
+        def schedule():
+            return dict([(tid, (start, finish)) for tid, start, finish in
+                         env.db_query("SELECT * FROM schedule")])
+        before = schedule()
+        self.assertEquals(set([1, 2, 3]), set(before))
+
+        # Deleting Monty's first task moves the other one up.
+        Ticket(env, 1).delete()
+        after = schedule()
+        self.assertEquals(set([2, 3]), set(after))
+        self.assertTrue(after[2] < before[2])
+
+    def test_simulate(self):
+        env = self._setup('[TracPM]\nfields.estimate = estimatedhours\n' +
+                          'fields.pred = blockedby\n' +
+                          'fields.succ = blocking\n' +
+                          'date_format = %Y-%m-%d\n' +
+                          '[ticket-custom]\nestimatedhours = text\n' +
+                          'blockedby = text\nblocking = text\n' +
+                          '[components]\ntracpm.* = enabled\n')
+        env.upgrade()
+
+        for owner, blocking, tickettype in [('Monty', '3', 'task'),
+                                            ('Monty', '3', 'task'),
+                                            ('', '', 'milestone'),
+                                            ('Phred', '5', 'task'),
+                                            ('', '', 'milestone')]:
+            ticket = Ticket(env)
+            ticket['summary'] = 'Task'
+            ticket['type'] = tickettype
+            ticket['owner'] = owner
+            ticket['estimatedhours'] = '8'
+            ticket['blocking'] = blocking
+            ticket['status'] = tickettype == 'milestone' and 'active' \
+                or 'new'
+            ticket.insert()
+
+        pm = TracPM(env)
+        rescheduler = TicketRescheduler(env)
+        tickets = rescheduler.queryTickets(['1', '2', '3', '4', '5'])
+        stored = env.db_query("SELECT * FROM schedule ORDER BY ticket")
+
+        # A longer task for Monty delays Monty's other task but not
+        # Phred's.
+        changes = pm.simulate(rescheduler.options, tickets,
+                              {'tickets': {'1': {'estimate': '24'}}})
+        self.assertEquals([1, 2], [c['id'] for c in changes])
+        for c in changes:
+            self.assertTrue(c['finish'][1] > c['finish'][0])
+
+        # Phred being out the day his task starts delays it.
+        t4 = [t for t in tickets if t['id'] == 4][0]
+        out = pm.start(t4).strftime('%Y-%m-%d')
+        changes = pm.simulate(rescheduler.options, tickets,
+                              {'unavailable': {'Phred': [out]}})
+        self.assertEquals([4], [c['id'] for c in changes])
+
+        # Nothing was written and the tickets are unchanged.
+        self.assertEquals(stored,
+                          env.db_query("SELECT * FROM schedule "
+                                       "ORDER BY ticket"))
+        self.assertEquals('8', [t for t in tickets if t['id'] == 1][0]
+                          ['estimatedhours'])
+
+        self.assertRaises(TracError, pm.simulate, rescheduler.options,
+                          tickets, {'tickets': {'99': {'owner': 'Monty'}}})
+        self.assertRaises(TracError, pm.simulate, rescheduler.options,
+                          tickets, {'tickets': {'x': {'owner': 'Monty'}}})
+        self.assertRaises(TracError, pm.simulate, rescheduler.options,
+                          tickets, {'tickets': {'1': 'Monty'}})
+        for change in [{'estimate': 'abc'}, {'addPred': 2},
+                       {'owner': ['x']}, {'addSucc': ['x']}]:
+            self.assertRaises(TracError, pm.simulate, rescheduler.options,
+                              tickets, {'tickets': {'1': change}})
+
+        # Numeric string IDs work like integers.
+        changes = pm.simulate(rescheduler.options, tickets,
+                              {'tickets': {'4': {'addPred': ['1']}}})
+        self.assertEquals([4], [c['id'] for c in changes])
+
+        # No change is no change, whatever the options.
+        options = dict(rescheduler.options)
+        options['hoursPerDay'] = 8.0
+        self.assertEquals([], pm.simulate(options, tickets,
+                                          {'tickets': {'1': {}}}))
+
+        # Bad input is a bad request, not a server error.
+        from trac.test import MockPerm
+        class FakeRequest(object):
+            perm = MockPerm()
+            path_info = '/pm/simulate'
+            def __init__(self, args):
+                self.args = args
+        simulator = TracPMSimulator(env)
+        for args in [{'hoursPerDay': 'lots'},
+                     {'overrides': '{"tickets": {"x": {}}}'}]:
+            self.assertRaises(HTTPBadRequest, simulator.process_request,
+                              FakeRequest(args))
+
+    def test_single_flight_reschedule(self):
+        env = self._setup('[TracPM]\nfields.estimate = estimatedhours\n' +
+                          'fields.pred = blockedby\n' +
+                          'fields.succ = blocking\n' +
+                          'date_format = %Y-%m-%d\n' +
+                          '[ticket-custom]\nestimatedhours = text\n' +
+                          'blockedby = text\nblocking = text\n' +
+                          '[components]\ntracpm.* = enabled\n')
+        env.upgrade()
+
+        for blocking, tickettype in [('2', 'task'), ('', 'milestone')]:
+            ticket = Ticket(env)
+            ticket['summary'] = 'Task'
+            ticket['type'] = tickettype
+            ticket['owner'] = 'Monty'
+            ticket['estimatedhours'] = '8'
+            ticket['blocking'] = blocking
+            ticket['status'] = tickettype == 'milestone' and 'active' \
+                or 'new'
+            ticket.insert()
+
+        rescheduler = TicketRescheduler(env)
+        rescheduler.lockPoll = 0.01
+        runs = []
+        rescheduleLocked = rescheduler._rescheduleLocked
+        def countRuns(changes):
+            runs.append(changes)
+            rescheduleLocked(changes)
+        rescheduler._rescheduleLocked = countRuns
+
+        # Only one reschedule holds the lock.
+        lock = rescheduler._acquireLock()
+        self.assertTrue(lock)
+        self.assertEquals(None, rescheduler._acquireLock())
+
+        # A request waiting on a reschedule that covers it reuses it.
+        generation = rescheduler._getCounter(rescheduler.generationKey)
+        waiter = threading.Thread(target=rescheduler.rescheduleChanges,
+                                  args=({'1': {}},))
+        waiter.start()
+        while rescheduler._getCounter(rescheduler.generationKey) == \
+                generation:
+            time.sleep(0.01)
+        rescheduler._setCounter(rescheduler.doneKey, generation + 1)
+        rescheduler._releaseLock(lock)
+        waiter.join()
+        self.assertEquals([], runs)
+
+        # Otherwise it reschedules once the lock is free.
+        rescheduler.rescheduleChanges({'1': {}})
+        self.assertEquals(1, len(runs))
+
+        # A reschedule saves even if there were newer requests, which
+        # reschedule for themselves, and records its generation done.
+        env.db_transaction("DELETE FROM schedule")
+        nowActive, wasActive = rescheduler._activeTickets([])
+        generation = rescheduler._bumpGeneration()
+        rescheduler._bumpGeneration()
+        rescheduler._reschedule(nowActive, wasActive, [],
+                                generation=generation)
+        self.assertEquals(2, len(env.db_query("SELECT * FROM schedule")))
+        self.assertEquals(generation,
+                          rescheduler._getCounter(rescheduler.doneKey))
+
+        # Dry runs don't count as requests.
+        generation = rescheduler._getCounter(rescheduler.generationKey)
+        out = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            rescheduler._do_reschedule('--dry-run')
+        finally:
+            sys.stdout = out
+        self.assertEquals(generation,
+                          rescheduler._getCounter(rescheduler.generationKey))
+
+        # A long reschedule keeps its lock fresh.
+        rescheduler.lockTimeout = 0.1
+        def slowReschedule():
+            time.sleep(0.3)
+            return rescheduler._acquireLock()
+        self.assertEquals(None, rescheduler._whileLocked(
+                rescheduler._acquireLock(), slowReschedule))
+        self.assertEquals([], env.db_query("SELECT value FROM system"
+                                           " WHERE name=%s",
+                                           (rescheduler.lockKey,)))
+        rescheduler.lockTimeout = 300
+
+        # A lock left by a reschedule that died is broken.
+        env.db_transaction("INSERT INTO system (name, value)"
+                           " VALUES (%s, '0 1:1')", (rescheduler.lockKey,))
+        lock = rescheduler._acquireLock()
+        self.assertTrue(lock)
+        rescheduler._releaseLock(lock)
+
+    def test_chart_cache(self):
+        from trac.perm import PermissionCache
+        from trac.web.href import Href
+        from tracjsgantt import TracJSGanttChart
+        env = self._setup('[TracPM]\nfields.estimate = estimatedhours\n' +
+                          'date_format = %Y-%m-%d\n' +
+                          '[ticket-custom]\nestimatedhours = text\n' +
+                          '[trac-jsgantt]\ncache_size = 1\n' +
+                          '[components]\ntracpm.* = enabled\n' +
+                          'tracjsgantt.* = enabled\n')
+        env.upgrade()
+
+        ticket = Ticket(env)
+        ticket['summary'] = 'Task'
+        ticket['status'] = 'new'
+        ticket['milestone'] = 'milestone1'
+        ticket['estimatedhours'] = '8'
+        ticket.insert()
+
+        class FakeRequest(object):
+            path_info = '/wiki/WikiStart'
+            authname = 'anonymous'
+            href = Href('/trac')
+            perm = PermissionCache(env, 'anonymous')
+        class FakeFormatter(object):
+            req = FakeRequest()
+        formatter = FakeFormatter()
+
+        def ganttID(page):
+            return re.search('var (g_\d+) = ', page).group(1)
+
+        chart = TracJSGanttChart(env)
+        first = chart.expand_macro(formatter, 'TracJSGanttChart',
+                                   'milestone=milestone1')
+        firstID = ganttID(first)
+        self.assertTrue('addTaskData' in first)
+        time.sleep(0.01)
+
+        # A hit is the same chart with a new ID.
+        again = chart.expand_macro(formatter, 'TracJSGanttChart',
+                                   'milestone=milestone1')
+        self.assertNotEquals(firstID, ganttID(again))
+        self.assertEquals(first.replace(firstID, ganttID(again)), again)
+
+        # Changing a ticket makes the chart stale.
+        ticket['summary'] = 'Renamed task'
+        ticket.save_changes('me', '')
+        changed = chart.expand_macro(formatter, 'TracJSGanttChart',
+                                     'milestone=milestone1')
+        self.assertTrue('Renamed task' in changed)
+
+        # Only cache_size charts are kept.
+        chart.expand_macro(formatter, 'TracJSGanttChart',
+                           'milestone=milestone2')
+        self.assertEquals(1, len(chart.chartCache))
+
+        # The same tasks are served as JSON, revalidated with an ETag.
+        from trac.web.api import RequestDone
+        def fetch(etag=None):
+            environ = {'REQUEST_METHOD': 'GET', 'SCRIPT_NAME': '/trac',
+                       'PATH_INFO': '/pm/gantt.json',
+                       'QUERY_STRING': 'milestone=milestone1',
+                       'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+                       'wsgi.url_scheme': 'http',
+                       'wsgi.input': StringIO('')}
+            if etag:
+                environ['HTTP_IF_NONE_MATCH'] = etag
+            response = {}
+            body = StringIO()
+            def start_response(status, headers, exc_info=None):
+                response['status'] = status
+                response['headers'] = dict(headers)
+                return body.write
+            req = Request(environ, start_response)
+            req.callbacks['authname'] = lambda req: 'anonymous'
+            req.callbacks['perm'] = \
+                lambda req: PermissionCache(env, 'anonymous')
+            self.assertTrue(chart.match_request(req))
+            self.assertRaises(RequestDone, chart.process_request, req)
+            return response['status'], response['headers'], body.getvalue()
+
+        status, headers, body = fetch()
+        self.assertEquals('200 Ok', status)
+        tasks = json.loads(body)
+        self.assertTrue('Renamed task' in [t[1] for t in tasks][0])
+        self.assertEquals('304 Not Modified',
+                          fetch(headers['ETag'])[0])
+        ticket['summary'] = 'Task'
+        ticket.save_changes('me', '')
+        self.assertEquals('200 Ok', fetch(headers['ETag'])[0])
+
+        # So does renaming an enum.
+        from trac.ticket.model import Priority
+        etag = fetch()[1]['ETag']
+        priority = Priority(env, 'major')
+        priority.name = 'big'
+        priority.update()
+        self.assertEquals('200 Ok', fetch(etag)[0])
+
+        # Descriptions are only sent for caption=Caption, shortened.
+        self.assertEquals('', tasks[0][13])
+        ticket['description'] = 'Long\n\n' + 'words ' * 1000
+        ticket.save_changes('me', '')
+        page = chart.expand_macro(formatter, 'TracJSGanttChart',
+                                  'milestone=milestone1,caption=Caption')
+        self.assertTrue('"Long words words' in page)
+        self.assertTrue(len(page) < 4000)
+
+        # An async chart fetches the tasks.
+        page = chart.expand_macro(formatter, 'TracJSGanttChart',
+                                  'milestone=milestone1,async=1')
+        self.assertTrue('/trac/pm/gantt.json?milestone=milestone1' in page)
+        self.assertFalse('addTaskData(%s, [' % ganttID(page) in page)
+
+        # Users with the same permissions get their own $USER charts.
+        for owner in ['alice', 'bob']:
+            ticket = Ticket(env)
+            ticket['summary'] = 'Task for %s' % owner
+            ticket['status'] = 'new'
+            ticket['owner'] = owner
+            ticket['milestone'] = 'milestone3'
+            ticket.insert()
+        chart.cacheSize = 2
+        for user, other in [('alice', 'bob'), ('bob', 'alice')]:
+            formatter.req = FakeRequest()
+            formatter.req.tz = localtz
+            formatter.req.locale = None
+            formatter.req.authname = user
+            formatter.req.perm = PermissionCache(env, user)
+            page = chart.expand_macro(formatter, 'TracJSGanttChart',
+                                      'milestone=milestone3,owner=$USER')
+            self.assertTrue('Task for %s' % user in page)
+            self.assertFalse('Task for %s' % other in page)
+
+    def test_viewable_tickets(self):
+        from tracjsgantt import TracJSGanttChart, _ChartState
+        env = self._setup()
+        chart = TracJSGanttChart(env)
+        tickets = [{'id': tid} for tid in [1, 2, 3, -1]]
+
+        class FakePerm(object):
+            def __init__(self, actions, denied=()):
+                self.actions = actions
+                self.denied = denied
+                self.checked = []
+            def __contains__(self, action):
+                return action in self.actions
+            def __call__(self, realm, tid):
+                self.checked.append(tid)
+                if tid in self.denied:
+                    return FakePerm([])
+                return self
+        class FakeRequest(object):
+            pass
+
+        # With the default policies, realm permission decides.
+        state = _ChartState(FakeRequest(), 'g')
+        state.req.perm = FakePerm(['TICKET_VIEW'])
+        self.assertEquals(tickets, chart._viewable_tickets(state, tickets))
+        state.req.perm = FakePerm([])
+        self.assertEquals([], chart._viewable_tickets(state, tickets))
+        self.assertEquals([], state.req.perm.checked)
+
+        # Otherwise, each ticket is checked once per request.
+        chart.plainPolicies = ()
+        state = _ChartState(FakeRequest(), 'g')
+        state.req.perm = FakePerm(['TICKET_VIEW'], [2])
+        self.assertEquals([1, 3, -1],
+                          [t['id'] for t in
+                           chart._viewable_tickets(state, tickets)])
+        self.assertEquals([1, 3],
+                          [t['id'] for t in
+                           chart._viewable_tickets(state, tickets[:3])])
+        self.assertEquals([1, 2, 3, -1], state.req.perm.checked)
+
+    def test_rank_tickets(self):
+        from tracjsgantt import TracJSGanttChart, _ChartState
+        env = self._setup('[TracPM]\nfields.pred = blockedby\n' +
+                          'fields.succ = blocking\n' +
+                          '[ticket-custom]\n' +
+                          'blockedby = text\nblocking = text\n' +
+                          '[components]\ntracpm.* = enabled\n')
+        chart = TracJSGanttChart(env)
+        day = datetime(2014, 3, 7, tzinfo=localtz)
+        def task(tid, finish, start, pred):
+            return {'id': tid, 'blockedby': pred, 'blocking': [],
+                    '_calc_start': [day + timedelta(days=start), True],
+                    '_calc_finish': [day + timedelta(days=finish), True]}
+        # 1 must come before 2 although it finishes later; 3 and 4 tie
+        # on finish and are ordered by start; 5 and 6 block each other.
+        state = _ChartState(None, 'g')
+        state.tickets = [task(2, 1, 0, [1]), task(1, 3, 0, []),
+                         task(4, 2, 1, []), task(3, 2, 0, []),
+                         task(6, 5, 0, [5]), task(5, 5, 0, [6])]
+        ranks = chart._rank_tickets(state)
+        self.assertEquals([3, 4, 1, 2, 5, 6],
+                          sorted(ranks, key=ranks.get))
+
+    def test_sort_tickets(self):
+        from tracjsgantt import TracJSGanttChart
+        env = self._setup()
+        env.upgrade()
+        chart = TracJSGanttChart(env)
+        tickets = [{'id': 1, 'type': 'task', 'priority': 'minor',
+                    'milestone': 'ms1', 'wbs': [2]},
+                   {'id': -1, 'type': 'milestone', 'priority': '',
+                    'milestone': 'ms1', 'wbs': [1]},
+                   {'id': 2, 'type': 'task', 'priority': 'blocker',
+                    'milestone': 'ms2', 'wbs': [3]},
+                   {'id': 3, 'type': 'task', 'priority': 'major',
+                    'milestone': 'ms1', 'wbs': [4]}]
+
+        # Enums sort by value; names not in the enum sort last.
+        self.assertEquals([2, 3, 1, -1],
+                          [t['id'] for t in chart._sortTickets(
+                    list(tickets), {'order': 'priority'})])
+        # Milestones sort after their tickets.
+        self.assertEquals([1, 3, -1, 2],
+                          [t['id'] for t in chart._sortTickets(
+                    list(tickets), {'order': 'milestone'})])
+        self.assertEquals([3, 1, -1, 2],
+                          [t['id'] for t in chart._sortTickets(
+                    list(tickets), {'order': 'milestone|priority'})])
+
+    def test_lazy_groups(self):
+        from trac.perm import PermissionCache
+        from trac.web.href import Href
+        from tracjsgantt import TracJSGanttChart, _ChartState
+        env = self._setup('[TracPM]\nfields.estimate = estimatedhours\n' +
+                          'fields.parent = parent\n' +
+                          'date_format = %Y-%m-%d\n' +
+                          '[ticket-custom]\nestimatedhours = text\n' +
+                          'parent = text\n' +
+                          '[components]\ntracpm.* = enabled\n' +
+                          'tracjsgantt.* = enabled\n')
+        env.upgrade()
+
+        # 1 has child 2 which has child 3
+        for parent in ['', '1', '2']:
+            ticket = Ticket(env)
+            ticket['summary'] = 'Task'
+            ticket['status'] = 'new'
+            ticket['milestone'] = 'milestone1'
+            ticket['estimatedhours'] = '8'
+            ticket['parent'] = parent
+            ticket.insert()
+
+        class FakeRequest(object):
+            path_info = '/wiki/WikiStart'
+            authname = 'anonymous'
+            href = Href('/trac')
+            perm = PermissionCache(env, 'anonymous')
+        chart = TracJSGanttChart(env)
+        state = _ChartState(FakeRequest(), 'g')
+        options = chart._default_options({'milestone': 'milestone1',
+                                          'openLevel': '2',
+                                          'omitMilestones': '1'})
+
+        # 2 is closed so 3 is left out and 2 is lazy, with 3's dates.
+        records = chart._task_records(state, options)
+        self.assertEquals([1, 2], [r[0] for r in records])
+        lazy = records[1]
+        self.assertEquals(15, len(lazy))
+        self.assertEquals(1, lazy[14])
+        self.assertEquals(0, lazy[11])
+
+        # Opening 2 loads 3.
+        children = chart._task_records(_ChartState(FakeRequest(), 'g'),
+                                       options, 2)
+        self.assertEquals([3], [r[0] for r in children])
+        self.assertEquals(14, len(children[0]))
+        self.assertEquals(lazy[2:4], children[0][2:4])
+
 def suite():
     return unittest.makeSuite(TracPMTestCase, 'test')
 
@@ -8,6 +8,11 @@
 
 import re
 import time
+import calendar
+import hashlib
+import heapq
+import threading
+from collections import OrderedDict
 from datetime import timedelta, datetime
 from operator import itemgetter, attrgetter
 
@@ -16,22 +21,23 @@ try:
     from trac.util.datefmt import to_utimestamp
 except ImportError:
     from trac.util.datefmt import to_timestamp as to_utimestamp
-from trac.util.text import to_unicode
+from trac.util.text import to_unicode, shorten_line
 from trac.util.html import Markup
 from trac.wiki.macros import WikiMacroBase
 from trac.web.chrome import Chrome
 import copy
 from trac.ticket.query import Query
+from trac.perm import PermissionSystem
 
 from trac.config import IntOption, Option
 from trac.core import implements, Component, TracError
-from trac.web.api import IRequestFilter
+from trac.web.api import IRequestFilter, IRequestHandler, HTTPBadRequest
 from trac.web.chrome import ITemplateProvider, add_script, add_stylesheet
 from pkg_resources import resource_filename
 
 from trac.wiki.api import parse_args
 
-from tracpm import TracPM
+from tracpm import TracPM, json
 
 try:
     from trac.util.text import javascript_quote
@@ -52,6 +58,36 @@ except ImportError:
         return _js_quote_re.sub(replace, text)
 
 # ========================================================================
+# Milliseconds from the epoch to the wall clock time of d, taken as
+# UTC.  See JSGantt.addTaskData().
+def _epochMS(d):
+    return calendar.timegm(d.timetuple()) * 1000
+
+# Serialize data as compact JSON that is safe inside a <script>
+# element.
+def _jsonForScript(data):
+    text = json.dumps(data, separators=(',', ':'))
+    return text.replace('<', '\\u003c').replace('>', '\\u003e') \
+        .replace('&', '\\u0026')
+
+# The state of drawing one chart.  The chart component is shared by
+# all requests so anything that belongs to one request or chart is
+# kept here and passed to the methods that need it.
+class _ChartState(object):
+    def __init__(self, req, ganttID):
+        self.req = req
+        self.GanttID = ganttID
+
+        # Map from colorBy values to classes.  See _task_display().
+        self.classMap = None
+
+        # The queried tickets, indexed by ID, and their ranks.  See
+        # _task_records().
+        self.tickets = []
+        self.ticketsByID = {}
+        self.ranks = {}
+
+
 class TracJSGanttSupport(Component):
     implements(IRequestFilter, ITemplateProvider)
 
@@ -61,6 +97,8 @@ class TracJSGanttSupport(Component):
            """Formats to show for Gantt chart""")
     IntOption('trac-jsgantt', 'option.sample', 0,
               """Show sample Gantt""")
+    IntOption('trac-jsgantt', 'option.async', 0,
+              """Load tasks after the page is displayed""")
     IntOption('trac-jsgantt', 'option.res', 1,
               """Show resource column""")
     IntOption('trac-jsgantt', 'option.dur', 1,
@@ -106,6 +144,13 @@ class TracJSGanttSupport(Component):
     Option('trac-jsGantt', 'option.linkStyle', 'standard',
             """Style for ticket links; jsgantt (new window) or standard browser behavior like ticket links.""")
 
+    IntOption('trac-jsgantt', 'caption_length', 100,
+              """Most characters of a ticket's description to show as
+                 its caption (with caption=Caption)""")
+    IntOption('trac-jsgantt', 'cache_size', 32,
+              """Number of rendered charts to keep for reuse (0 to not
+                 cache charts)""")
+
 
     # ITemplateProvider methods
     def get_htdocs_dirs(self):
@@ -128,6 +173,8 @@ class TracJSGanttSupport(Component):
 
 
 class TracJSGanttChart(WikiMacroBase):
+    implements(IRequestHandler)
+
     """
 Displays a Gantt chart for the specified tickets.
 
@@ -137,6 +184,7 @@ The chart display can be controlled with a number of macro arguments:
 || `formats`||What to display in the format control.  A pipe-separated list of `minute`, `hour`, `day`, `week`, `month`, and `quarter` (though `minute` may not be very useful). ||'day|week|month|quarter'||
 || `format`||Initial display format, one of those listed in `formats` || First format ||
 || `sample`||Display sample tasks (1) or not (0) || 0 ||
+|| `async`||Load the tasks after the page is displayed (1) or with the page (0).  The tasks come from `/pm/gantt.json`, which takes the same arguments as the macro. || 0 ||
 || `res`||Show resource column (1) or not (0) || 1 ||
 || `dur`||Show duration colunn (1) or not (0) || 1 ||
 || `comp`||Show percent complete column (1) or not (0) || 1 ||
@@ -166,6 +214,15 @@ All other macro arguments are treated as TracQuery specification (e.g., mileston
     pm = None
     options = {}
 
+    # Rendered charts, least recently used first.  See _cachedChart().
+    chartCache = None
+    chartCacheLock = threading.Lock()
+
+    # Permission policies which grant TICKET_VIEW on every ticket
+    # just as the user's permissions do.  With others, the chart may
+    # differ for each user.
+    plainPolicies = ('DefaultPermissionPolicy', 'LegacyAttachmentPolicy')
+
     # The date part of these formats has to be in sync.  Including
     # hour and minute in the pyDateFormat makes the plugin easier to
     # debug at times because that's how the date shows up in page
@@ -179,20 +236,15 @@ All other macro arguments are treated as TracQuery specification (e.g., mileston
     jsDateFormat = 'yyyy-mm-dd'
     pyDateFormat = '%Y-%m-%d %H:%M'
 
-    # User map (login -> realname) is loaded on demand, once.
-    # Initialization to None means it is not yet initialized.
-    user_map = None
-
     def __init__(self):
         # Instantiate the PM component
         self.pm = TracPM(self.env)
 
-        self.GanttID = 'g'
-
 
         # All the macro's options with default values.
         # Anything else passed to the macro is a TracQuery field.
-        options = ('format', 'formats', 'sample', 'res', 'dur', 'comp',
+        options = ('format', 'formats', 'sample', 'async',
+                   'res', 'dur', 'comp',
                    'caption', 'startDate', 'endDate', 'dateDisplay',
                    'openLevel', 'expandClosedTickets', 'colorBy', 'lwidth',
                    'showdep', 'userMap', 'omitMilestones',
@@ -203,8 +255,13 @@ All other macro arguments are treated as TracQuery specification (e.g., mileston
             self.options[opt] = self.config.get('trac-jsgantt',
                                                 'option.%s' % opt)
 
+        self.cacheSize = self.config.getint('trac-jsgantt', 'cache_size', 32)
+        self.captionLength = self.config.getint('trac-jsgantt',
+                                                'caption_length', 100)
+        self.chartCache = OrderedDict()
+
 
-    def _begin_gantt(self, options):
+    def _begin_gantt(self, state, options):
         if options['format']:
             defaultFormat = options['format']
         else:
@@ -212,100 +269,123 @@ All other macro arguments are treated as TracQuery specification (e.g., mileston
         showdep = options['showdep']
         text = ''
         text += '<div style="position:relative" class="gantt" ' + \
-            'id="GanttChartDIV_'+self.GanttID+'"></div>\n'
+            'id="GanttChartDIV_'+state.GanttID+'"></div>\n'
         text += '<script language="javascript">\n'
-        text += 'var '+self.GanttID+' = new JSGantt.GanttChart("'+ \
-            self.GanttID+'",document.getElementById("GanttChartDIV_'+ \
-            self.GanttID+'"), "%s", "%s");\n' % \
+        text += 'var '+state.GanttID+' = new JSGantt.GanttChart("'+ \
+            state.GanttID+'",document.getElementById("GanttChartDIV_'+ \
+            state.GanttID+'"), "%s", "%s");\n' % \
             (javascript_quote(defaultFormat), showdep)
         text += 'var t;\n'
         text += 'if (window.addEventListener){\n'
         text += '  window.addEventListener("resize", ' + \
-            'function() { ' + self.GanttID+'.Draw(); '
+            'function() { ' + state.GanttID+'.Draw(); '
         if options['showdep']:
-            text += self.GanttID+'.DrawDependencies();'
+            text += state.GanttID+'.DrawDependencies();'
         text += '}, false);\n'
         text += '} else {\n'
         text += '  window.attachEvent("onresize", ' + \
-            'function() { '+self.GanttID+'.Draw(); '
+            'function() { '+state.GanttID+'.Draw(); '
         if options['showdep']:
-            text += self.GanttID+'.DrawDependencies();'
+            text += state.GanttID+'.DrawDependencies();'
         text += '});\n'
         text += '}\n'
         return text
 
-    def _end_gantt(self, options):
+    def _draw_gantt(self, state, options):
         chart = ''
-        chart += self.GanttID+'.Draw();\n'
+        chart += state.GanttID+'.Draw();\n'
         if options['showdep']:
-            chart += self.GanttID+'.DrawDependencies();\n'
+            chart += state.GanttID+'.DrawDependencies();\n'
+        return chart
+
+    def _end_gantt(self, state, options):
+        chart = self._draw_gantt(state, options)
+        chart += '</script>\n'
+        return chart
+
+    # Fetch tasks from url (see process_request()) and draw the chart
+    # when they arrive.
+    def _load_gantt(self, state, options, url):
+        chart = ''
+        chart += state.GanttID + '.setTaskDataURL("%s");\n' % \
+            javascript_quote(url)
+        chart += 'jQuery.getJSON("%s", function(tasks) {\n' % \
+            javascript_quote(url)
+        chart += '  if (tasks.length == 0) {\n'
+        chart += '    jQuery("#GanttChartDIV_%s").text(' % state.GanttID + \
+            '"No tasks selected.");\n'
+        chart += '    return;\n'
+        chart += '  }\n'
+        chart += '  JSGantt.addTaskData(%s, tasks);\n' % state.GanttID
+        chart += self._draw_gantt(state, options)
+        chart += '});\n'
         chart += '</script>\n'
         return chart
 
-    def _gantt_options(self, options):
+    def _gantt_options(self, state, options):
         opt = ''
         if (options['linkStyle']):
             linkStyle = options['linkStyle']
         else:
             linkStyle = 'standard'
-        opt += self.GanttID+'.setLinkStyle("%s")\n' % linkStyle
-        opt += self.GanttID+'.setShowRes(%s);\n' % options['res']
-        opt += self.GanttID+'.setShowDur(%s);\n' % options['dur']
-        opt += self.GanttID+'.setShowComp(%s);\n' % options['comp']
+        opt += state.GanttID+'.setLinkStyle("%s")\n' % linkStyle
+        opt += state.GanttID+'.setShowRes(%s);\n' % options['res']
+        opt += state.GanttID+'.setShowDur(%s);\n' % options['dur']
+        opt += state.GanttID+'.setShowComp(%s);\n' % options['comp']
         if (options['scrollTo']):
-            opt += self.GanttID+'.setScrollDate("%s");\n' % options['scrollTo']
+            opt += state.GanttID+'.setScrollDate("%s");\n' % options['scrollTo']
         w = options['lwidth']
         if w:
-            opt += self.GanttID+'.setLeftWidth(%s);\n' % w
+            opt += state.GanttID+'.setLeftWidth(%s);\n' % w
 
 
-        opt += self.GanttID+'.setCaptionType("%s");\n' % \
+        opt += state.GanttID+'.setCaptionType("%s");\n' % \
             javascript_quote(options['caption'])
 
-        opt += self.GanttID+'.setShowStartDate(%s);\n' % options['startDate']
-        opt += self.GanttID+'.setShowEndDate(%s);\n' % options['endDate']
+        opt += state.GanttID+'.setShowStartDate(%s);\n' % options['startDate']
+        opt += state.GanttID+'.setShowEndDate(%s);\n' % options['endDate']
 
-        opt += self.GanttID+'.setDateInputFormat("%s");\n' % \
+        opt += state.GanttID+'.setDateInputFormat("%s");\n' % \
             javascript_quote(self.jsDateFormat)
 
-        opt += self.GanttID+'.setDateDisplayFormat("%s");\n' % \
+        opt += state.GanttID+'.setDateDisplayFormat("%s");\n' % \
             javascript_quote(options['dateDisplay'])
 
-        opt += self.GanttID+'.setFormatArr(%s);\n' % ','.join(
+        opt += state.GanttID+'.setFormatArr(%s);\n' % ','.join(
             '"%s"' % javascript_quote(f) for f in options['formats'].split('|'))
-        opt += self.GanttID+'.setPopupFeatures("location=1,scrollbars=1");\n'
+        opt += state.GanttID+'.setPopupFeatures("location=1,scrollbars=1");\n'
         return opt
 
     # TODO - use ticket-classN styles instead of colors?
-    def _add_sample_tasks(self):
+    def _add_sample_tasks(self, state):
         task= ''
-        tasks = self.GanttID+'.setDateInputFormat("mm/dd/yyyy");\n'
+        tasks = state.GanttID+'.setDateInputFormat("mm/dd/yyyy");\n'
 
         #                                                                         ID    Name                   Start        End          Display    Link                    MS Res         Pct  Gr Par Open Dep Cap
-        tasks += self.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+self.GanttID+',1,   "Define Chart API",     "",          "",          "#ff0000", "http://help.com",      0, "Brian",     0,  1, 0,  1));\n'
-        tasks += self.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+self.GanttID+',11,  "Chart Object",         "2/20/2011", "2/20/2011", "#ff00ff", "http://www.yahoo.com", 1, "Shlomy",  100,  0, 1,  1));\n'
-        tasks += self.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+self.GanttID+',12,  "Task Objects",         "",          "",          "#00ff00", "",                     0, "Shlomy",   40,  1, 1,  1));\n'
-        tasks += self.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+self.GanttID+',121, "Constructor Proc",     "2/21/2011", "3/9/2011",  "#00ffff", "http://www.yahoo.com", 0, "Brian T.", 60,  0, 12, 1));\n'
-        tasks += self.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+self.GanttID+',122, "Task Variables",       "3/6/2011",  "3/11/2011", "#ff0000", "http://help.com",      0, "",         60,  0, 12, 1,121));\n'
-        tasks += self.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+self.GanttID+',123, "Task Functions",       "3/9/2011",  "3/29/2011", "#ff0000", "http://help.com",      0, "Anyone",   60,  0, 12, 1, 0, "This is another caption"));\n'
-        tasks += self.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+self.GanttID+',2,   "Create HTML Shell",    "3/24/2011", "3/25/2011", "#ffff00", "http://help.com",      0, "Brian",    20,  0, 0,  1,122));\n'
-        tasks += self.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+self.GanttID+',3,   "Code Javascript",      "",          "",          "#ff0000", "http://help.com",      0, "Brian",     0,  1, 0,  1));\n'
-        tasks += self.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+self.GanttID+',31,  "Define Variables",     "2/25/2011", "3/17/2011", "#ff00ff", "http://help.com",      0, "Brian",    30,  0, 3,  1, 0,"Caption 1"));\n'
-        tasks += self.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+self.GanttID+',32,  "Calculate Chart Size", "3/15/2011", "3/24/2011", "#00ff00", "http://help.com",      0, "Shlomy",   40,  0, 3,  1));\n'
-        tasks += self.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+self.GanttID+',33,  "Draw Taks Items",      "",          "",          "#00ff00", "http://help.com",      0, "Someone",  40,  1, 3,  1));\n'
-        tasks += self.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+self.GanttID+',332, "Task Label Table",     "3/6/2011",  "3/11/2011", "#0000ff", "http://help.com",      0, "Brian",    60,  0, 33, 1));\n'
-        tasks += self.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+self.GanttID+',333, "Task Scrolling Grid",  "3/9/2011",  "3/20/2011", "#0000ff", "http://help.com",      0, "Brian",    60,  0, 33, 1));\n'
-        tasks += self.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+self.GanttID+',34,  "Draw Task Bars",       "",          "",          "#990000", "http://help.com",      0, "Anybody",  60,  1, 3,  1));\n'
-        tasks += self.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+self.GanttID+',341, "Loop each Task",       "3/26/2011", "4/11/2011", "#ff0000", "http://help.com",      0, "Brian",    60,  0, 34, 1, "332,333"));\n'
-        tasks += self.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+self.GanttID+',342, "Calculate Start/Stop", "4/12/2011", "5/18/2011", "#ff6666", "http://help.com",      0, "Brian",    60,  0, 34, 1));\n'
-        tasks += self.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+self.GanttID+',343, "Draw Task Div",        "5/13/2011", "5/17/2011", "#ff0000", "http://help.com",      0, "Brian",    60,  0, 34, 1));\n'
-        tasks += self.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+self.GanttID+',344, "Draw Completion Div",  "5/17/2011", "6/04/2011", "#ff0000", "http://help.com",      0, "Brian",    60,  0, 34, 1));\n'
-        tasks += self.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+self.GanttID+',35,  "Make Updates",         "10/17/2011","12/04/2011","#f600f6", "http://help.com",      0, "Brian",    30,  0, 3,  1));\n'
+        tasks += state.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+state.GanttID+',1,   "Define Chart API",     "",          "",          "#ff0000", "http://help.com",      0, "Brian",     0,  1, 0,  1));\n'
+        tasks += state.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+state.GanttID+',11,  "Chart Object",         "2/20/2011", "2/20/2011", "#ff00ff", "http://www.yahoo.com", 1, "Shlomy",  100,  0, 1,  1));\n'
+        tasks += state.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+state.GanttID+',12,  "Task Objects",         "",          "",          "#00ff00", "",                     0, "Shlomy",   40,  1, 1,  1));\n'
+        tasks += state.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+state.GanttID+',121, "Constructor Proc",     "2/21/2011", "3/9/2011",  "#00ffff", "http://www.yahoo.com", 0, "Brian T.", 60,  0, 12, 1));\n'
+        tasks += state.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+state.GanttID+',122, "Task Variables",       "3/6/2011",  "3/11/2011", "#ff0000", "http://help.com",      0, "",         60,  0, 12, 1,121));\n'
+        tasks += state.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+state.GanttID+',123, "Task Functions",       "3/9/2011",  "3/29/2011", "#ff0000", "http://help.com",      0, "Anyone",   60,  0, 12, 1, 0, "This is another caption"));\n'
+        tasks += state.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+state.GanttID+',2,   "Create HTML Shell",    "3/24/2011", "3/25/2011", "#ffff00", "http://help.com",      0, "Brian",    20,  0, 0,  1,122));\n'
+        tasks += state.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+state.GanttID+',3,   "Code Javascript",      "",          "",          "#ff0000", "http://help.com",      0, "Brian",     0,  1, 0,  1));\n'
+        tasks += state.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+state.GanttID+',31,  "Define Variables",     "2/25/2011", "3/17/2011", "#ff00ff", "http://help.com",      0, "Brian",    30,  0, 3,  1, 0,"Caption 1"));\n'
+        tasks += state.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+state.GanttID+',32,  "Calculate Chart Size", "3/15/2011", "3/24/2011", "#00ff00", "http://help.com",      0, "Shlomy",   40,  0, 3,  1));\n'
+        tasks += state.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+state.GanttID+',33,  "Draw Taks Items",      "",          "",          "#00ff00", "http://help.com",      0, "Someone",  40,  1, 3,  1));\n'
+        tasks += state.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+state.GanttID+',332, "Task Label Table",     "3/6/2011",  "3/11/2011", "#0000ff", "http://help.com",      0, "Brian",    60,  0, 33, 1));\n'
+        tasks += state.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+state.GanttID+',333, "Task Scrolling Grid",  "3/9/2011",  "3/20/2011", "#0000ff", "http://help.com",      0, "Brian",    60,  0, 33, 1));\n'
+        tasks += state.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+state.GanttID+',34,  "Draw Task Bars",       "",          "",          "#990000", "http://help.com",      0, "Anybody",  60,  1, 3,  1));\n'
+        tasks += state.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+state.GanttID+',341, "Loop each Task",       "3/26/2011", "4/11/2011", "#ff0000", "http://help.com",      0, "Brian",    60,  0, 34, 1, "332,333"));\n'
+        tasks += state.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+state.GanttID+',342, "Calculate Start/Stop", "4/12/2011", "5/18/2011", "#ff6666", "http://help.com",      0, "Brian",    60,  0, 34, 1));\n'
+        tasks += state.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+state.GanttID+',343, "Draw Task Div",        "5/13/2011", "5/17/2011", "#ff0000", "http://help.com",      0, "Brian",    60,  0, 34, 1));\n'
+        tasks += state.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+state.GanttID+',344, "Draw Completion Div",  "5/17/2011", "6/04/2011", "#ff0000", "http://help.com",      0, "Brian",    60,  0, 34, 1));\n'
+        tasks += state.GanttID+'.AddTaskItem(new JSGantt.TaskItem('+state.GanttID+',35,  "Make Updates",         "10/17/2011","12/04/2011","#f600f6", "http://help.com",      0, "Brian",    30,  0, 3,  1));\n'
         return tasks
 
     # Get the required columns for the tickets which match the
     # criteria in options.
-    def _query_tickets(self, options):
+    def _query_tickets(self, state, options):
         query_options = {}
         for key in options.keys():
             if not key in self.options:
@@ -313,7 +393,6 @@ All other macro arguments are treated as TracQuery specification (e.g., mileston
 
         # The fields always needed by the Gantt
         fields = set([
-            'description',
             'owner',
             'type',
             'status',
@@ -321,56 +400,106 @@ All other macro arguments are treated as TracQuery specification (e.g., mileston
             'milestone',
             'priority'])
 
+        # Descriptions can be long; only get them if they're shown.
+        if options.get('caption') == 'Caption':
+            fields.add('description')
+
         # Make sure the coloring field is included
         if 'colorBy' in options:
             fields.add(str(options['colorBy']))
 
-        rawtickets = self.pm.query(query_options, fields, self.req)
+        rawtickets = self.pm.query(query_options, fields, state.req)
 
         # Do permissions check on tickets
-        tickets = [t for t in rawtickets
-                   if 'TICKET_VIEW' in self.req.perm('ticket', t['id'])]
+        return self._viewable_tickets(state, rawtickets)
 
-        return tickets
+    # Return True if a user's permission on each ticket is the same as
+    # on the ticket realm (only the default permission policies are
+    # active).
+    def _plain_permissions(self):
+        policies = [p.__class__.__name__
+                    for p in PermissionSystem(self.env).policies]
+        return not [p for p in policies if p not in self.plainPolicies]
 
-    def _compare_tickets(self, t1, t2):
-        # If t2 depends on t1, t2 is first
-        if t1['id'] in self.pm.successors(t2):
-            return 1
-        # If t1 depends on t2, t1 is first
-        elif t2['id'] in self.pm.successors(t1):
-            return -1
-        # If t1 ends first, it's first
-        elif self.pm.finish(t1) < self.pm.finish(t2):
-            return -1
-        # If t2 ends first, it's first
-        elif self.pm.finish(t1) > self.pm.finish(t2):
-            return 1
-        # End dates are same. If t1 starts later, it's later
-        elif self.pm.start(t1) > self.pm.start(t2):
-            return 1
-        # Otherwise, preserve order (assume t1 is before t2 when called)
-        else:
-            return 0
+    # Filter tickets to those the user may view.
+    #
+    # If permissions don't depend on the ticket, it's all or nothing.
+    # Otherwise each ticket is checked once per request, however many
+    # charts on the page include it.
+    def _viewable_tickets(self, state, tickets):
+        if self._plain_permissions():
+            if 'TICKET_VIEW' in state.req.perm:
+                return tickets
+            else:
+                return []
+
+        viewable = self.pm.requestCache(state.req, 'ticketView')
+        for t in tickets:
+            if t['id'] not in viewable:
+                viewable[t['id']] = \
+                    'TICKET_VIEW' in state.req.perm('ticket', t['id'])
+        return [t for t in tickets if viewable[t['id']]]
+
+    # Rank tickets for computing WBS: predecessors before their
+    # successors, otherwise earliest finish, then start, then ID
+    # first.
+    #
+    # A topological sort (Kahn's algorithm) which takes the first
+    # ready ticket each time.  Tickets in dependency loops follow the
+    # rest, by finish, start and ID.
+    #
+    # @return a hash of integer ranks indexed by ticket ID
+    def _rank_tickets(self, state):
+        keys = {}
+        for t in state.tickets:
+            keys[t['id']] = (self.pm.finish(t), self.pm.start(t), t['id'])
+
+        # Links to tickets not in the chart don't order anything.
+        succs = {}
+        for t in state.tickets:
+            for sid in self.pm.successors(t):
+                if sid in keys:
+                    succs.setdefault(t['id'], set()).add(sid)
+            for pid in self.pm.predecessors(t):
+                if pid in keys:
+                    succs.setdefault(pid, set()).add(t['id'])
+        predCount = dict.fromkeys(keys, 0)
+        for tid in succs:
+            for sid in succs[tid]:
+                predCount[sid] += 1
+
+        ready = [keys[tid] for tid in keys if predCount[tid] == 0]
+        heapq.heapify(ready)
+        ranks = {}
+        while ready:
+            tid = heapq.heappop(ready)[2]
+            ranks[tid] = len(ranks)
+            for sid in succs.get(tid, ()):
+                predCount[sid] -= 1
+                if predCount[sid] == 0:
+                    heapq.heappush(ready, keys[sid])
+
+        for key in sorted([keys[tid] for tid in keys if tid not in ranks]):
+            ranks[key[2]] = len(ranks)
+
+        return ranks
 
     # Compute WBS for sorting and figure out the tickets' levels for
     # controlling how many levels are open.
     #
     # WBS is a list like [ 2, 4, 1] (the first child of the fourth
     # child of the second top-level element).
-    def _compute_wbs(self):
+    def _compute_wbs(self, state):
         # Set the ticket's level and wbs then recurse to children.
         def _setLevel(tid, wbs, level):
             # Update this node
-            self.ticketsByID[tid]['level'] = level
-            self.ticketsByID[tid]['wbs'] = copy.copy(wbs)
+            state.ticketsByID[tid]['level'] = level
+            state.ticketsByID[tid]['wbs'] = copy.copy(wbs)
 
             # Recurse to children
-            childIDs = self.pm.children(self.ticketsByID[tid])
+            childIDs = self.pm.children(state.ticketsByID[tid])
             if childIDs:
-                childTickets = [self.ticketsByID[cid] for cid in childIDs]
-                childTickets.sort(self._compare_tickets)
-                childIDs = [ct['id'] for ct in childTickets]
+                childIDs = sorted(childIDs, key=state.ranks.get)
 
                 # Add another level
                 wbs.append(1)
@@ -389,36 +518,29 @@ All other macro arguments are treated as TracQuery specification (e.g., mileston
         # a ticket's parent is not in the viewed tickets, consider it
         # top-level
         wbs = [ 1 ]
-        roots = self.pm.roots(self.ticketsByID)
-        for t in self.tickets:
+        roots = self.pm.roots(state.ticketsByID)
+        for t in state.tickets:
             if t['id'] in roots:
                 wbs = _setLevel(t['id'], wbs, 1)
 
 
-    def _task_display(self, t, options):
+    def _task_display(self, state, t, options):
         def _buildMap(field):
-            self.classMap = {}
+            state.classMap = {}
             i = 0
-            for t in self.tickets:
-                if t[field] not in self.classMap:
+            for t in state.tickets:
+                if t[field] not in state.classMap:
                     i = i + 1
-                    self.classMap[t[field]] = i
+                    state.classMap[t[field]] = i
 
         def _buildEnumMap(field):
-            self.classMap = {}
-            db = self.env.get_db_cnx()
-            cursor = db.cursor()
-            cursor.execute("SELECT name," +
-                           db.cast('value', 'int') +
-                           " FROM enum WHERE type=%s", (field,))
-            for name, value in cursor:
-                self.classMap[name] = value
+            state.classMap = self.pm.enumMap(field)
 
         display = None
         colorBy = options['colorBy']
 
         # Build the map the first time we need it
-        if self.classMap == None:
+        if state.classMap == None:
             # Enums (TODO: what others should I list?)
             if options['colorBy'] in ['priority', 'severity']:
                 _buildEnumMap(colorBy)
@@ -426,8 +548,8 @@ All other macro arguments are treated as TracQuery specification (e.g., mileston
                 _buildMap(colorBy)
 
         # Set display based on class map
-        if t[colorBy] in self.classMap:
-            display = 'class=ticket-class%d' % self.classMap[t[colorBy]]
+        if t[colorBy] in state.classMap:
+            display = 'class=ticket-class%d' % state.classMap[t[colorBy]]
 
         # Add closed status for strike through
         if t['status'] == 'closed':
@@ -441,10 +563,52 @@ All other macro arguments are treated as TracQuery specification (e.g., mileston
         return display
 
 
-    # Format a ticket into JavaScript source to display the
-    # task. ticket is expected to have:
+    # Return True if ticket's children are shown when the chart is
+    # first drawn.
+    def _is_open(self, ticket, options):
+        return int(ticket['level']) < int(options['openLevel']) and \
+            ((options['expandClosedTickets'] != 0) or \
+                 (ticket['status'] != 'closed'))
+
+    # Find the tickets to send to the browser.
+    #
+    # Tickets under a closed group start hidden so they are left out
+    # and loaded when the group is opened.  With parent, the tickets
+    # under it which are shown when it is opened are found instead.
+    #
+    # @param tickets tickets to display
+    # @param options chart options
+    # @param parent ID of an opened group
+    #
+    # @return a set of ticket IDs
+    def _visible_tickets(self, tickets, options, parent=None):
+        byID = dict([(t['id'], t) for t in tickets])
+        visible = set()
+        for t in tickets:
+            shown = True
+            seen = set()
+            p = byID.get(self.pm.parent(t))
+            while p is not None and p['id'] != parent \
+                    and p['id'] not in seen:
+                if not self._is_open(p, options):
+                    shown = False
+                    break
+                seen.add(p['id'])
+                p = byID.get(self.pm.parent(p))
+            if shown and (parent is None or \
+                              (p is not None and p['id'] == parent)):
+                visible.add(t['id'])
+        return visible
+
+    # Format a ticket into a task record for JSGantt.addTaskData()
+    # (see jsgantt.js).  The record is a list of the arguments to
+    # JSGantt.TaskItem() after the chart, with dates as milliseconds
+    # from the epoch to the wall clock time in UTC (so the browser
+    # shows the same time whatever its time zone).
+    #
+    # ticket is expected to have:
     #   children - child ticket IDs or None
-    #   description - ticket description.
+    #   description - ticket description (only with caption=Caption)
     #   id - ticket ID, an integer
     #   level - levels from root (0)
     #   link - What to link to
@@ -458,7 +622,7 @@ All other macro arguments are treated as TracQuery specification (e.g., mileston
     #   status - string displayed in tool tip ; FIXME - not displayed yet
     #   summary - ticket summary
     #   type - string displayed in tool tip FIXME - not displayed yet
-    def _format_ticket(self, ticket, options):
+    def _format_ticket(self, state, ticket, options):
         # Translate owner to full name
         def _owner(ticket):
             if self.pm.isMilestone(ticket):
@@ -466,18 +630,11 @@ All other macro arguments are treated as TracQuery specification (e.g., mileston
             else:
                 owner_name = ticket['owner']
                 if options['userMap']:
-                    # Build the map the first time we use it
-                    if self.user_map is None:
-                        self.user_map = {}
-                        for username, name, email in self.env.get_known_users():
-                            self.user_map[username] = name
                     # Map the user name
-                    if self.user_map.get(owner_name):
-                        owner_name = self.user_map[owner_name]
+                    owner_name = self.pm.userNames().get(owner_name,
+                                                         owner_name)
             return owner_name
 
-        task = ''
-
         # pID, pName
         if self.pm.isMilestone(ticket):
             if ticket['id'] > 0:
@@ -490,69 +647,64 @@ All other macro arguments are treated as TracQuery specification (e.g., mileston
             name = "#%d:%s (%s %s)" % \
                    (ticket['id'], ticket['summary'],
                     ticket['status'], ticket['type'])
-        task += 't = new JSGantt.TaskItem(%s,%d,"%s",' % \
-            (self.GanttID, ticket['id'], javascript_quote(name))
+        task = [ticket['id'], name]
 
         # pStart, pEnd
-        task += '"%s",' % self.pm.start(ticket).strftime(self.pyDateFormat)
-        task += '"%s",' % self.pm.finish(ticket).strftime(self.pyDateFormat)
+        task.append(_epochMS(self.pm.start(ticket)))
+        task.append(_epochMS(self.pm.finish(ticket)))
 
         # pDisplay
-        task += '"%s",' % javascript_quote(self._task_display(ticket, options))
+        task.append(self._task_display(state, ticket, options))
 
         # pLink
-        task += '"%s",' % javascript_quote(ticket['link'])
+        task.append(ticket['link'])
 
         # pMile
         if self.pm.isMilestone(ticket):
-            task += '1,'
+            task.append(1)
         else:
-            task += '0,'
+            task.append(0)
 
         # pRes (owner)
-        task += '"%s",' % javascript_quote(_owner(ticket))
+        task.append(_owner(ticket))
 
         # pComp (percent complete); integer 0..100
-        task += '"%s",' % self.pm.percentComplete(ticket)
+        task.append(self.pm.percentComplete(ticket))
 
         # pGroup (has children)
         if self.pm.children(ticket):
-            task += '%s,' % 1
+            task.append(1)
         else:
-            task += '%s,' % 0
+            task.append(0)
 
         # pParent (parent task ID)
         # If there's no parent, don't link to it
         if self.pm.parent(ticket) == None:
-            task += '%s,' % 0
+            task.append(0)
         else:
-            task += '%s,' % self.pm.parent(ticket)
+            task.append(self.pm.parent(ticket))
 
         # open
-        if int(ticket['level']) < int(options['openLevel']) and \
-                ((options['expandClosedTickets'] != 0) or \
-                     (ticket['status'] != 'closed')):
-            openGroup = 1
+        if self._is_open(ticket, options):
+            task.append(1)
         else:
-            openGroup = 0
-        task += '%d,' % openGroup
+            task.append(0)
 
         # predecessors
-        pred = [str(s) for s in self.pm.predecessors(ticket)]
-        if len(pred):
-            task += '"%s",' % javascript_quote(','.join(pred))
-        else:
-            task += '"%s",' % javascript_quote(','.join(''))
+        task.append(','.join([str(s) for s in
+                              self.pm.predecessors(ticket)]))
 
         # caption
-        # FIXME - if caption isn't set to caption, use "" because the
-        # description could be quite long and take a long time to make
-        # safe and display.
-        task += '"%s (%s %s)"' % (javascript_quote(ticket['description']),
-                                  javascript_quote(ticket['status']),
-                                  javascript_quote(ticket['type']))
-        task += ');\n'
-        task += self.GanttID+'.AddTaskItem(t);\n'
+        # Only shown for caption=Caption.  The description could be
+        # quite long so only the start of it is shown.
+        if options.get('caption') == 'Caption':
+            description = ' '.join(ticket.get('description', '').split())
+            task.append('%s (%s %s)' %
+                        (shorten_line(description, self.captionLength),
+                         ticket['status'],
+                         ticket['type']))
+        else:
+            task.append('')
         return task
 
     def _filter_tickets(self, options, tickets):
@@ -622,90 +774,151 @@ All other macro arguments are treated as TracQuery specification (e.g., mileston
 
         return filteredTickets
 
+    # Ticket fields whose values are enums, with their enum type
+    enumTypes = { 'priority': 'priority',
+                  'severity': 'severity',
+                  'resolution': 'resolution',
+                  'type': 'ticket_type' }
+
     # Sort tickets by options['order'].  For example,
     # order=milestone|wbs sorts by wbs within milestone.
     #
-    # http://wiki.python.org/moin/HowTo/Sorting (at
-    # #Sort_Stability_and_Complex_Sorts) notes that Python list
-    # sorting is stable so you can sort by increasing priority of keys
-    # (tertiary, then secondary, then primary) to get a multi-key
-    # sort.
-    #
-    # FIXME - this sorts enums by text, not value.
+    # Tickets are sorted once on a key with a part for each field in
+    # order.  Enums (e.g., priority) sort by value, not name; names
+    # that aren't in the enum sort after those that are.  When
+    # sorting by milestone, milestone tickets sort after the other
+    # tickets they'd otherwise tie with (e.g., at the end of their
+    # milestone).  The sort is stable so ties keep their order.
     def _sortTickets(self, tickets, options):
-        # Force milestones to the end
-        def msSorter(t1, t2):
-            # If t1 is a not milestone and t2 is, t1 comes first
-            if not self.pm.isMilestone(t1) and self.pm.isMilestone(t2):
-                result = -1
-            elif self.pm.isMilestone(t1) and not self.pm.isMilestone(t2):
-                result = 1
-            else:
-                result = 0
-            return result
-
         # Get all the sort fields
         sortFields = options['order'].split('|')
 
-        # If sorting by milestone, force milestone type tickets to the
-        # end before any other sort.  The stability of the other sorts
-        # will keep them at the end of the milestone group (unless
-        # overridden by other fields listed in `order`).
-        if 'milestone' in sortFields:
-            tickets.sort(msSorter)
-
-        # Reverse sort fields so lowest priority is first
-        sortFields.reverse()
+        # Build a function to get each field's part of the key
+        def enumKey(field, enumMap):
+            def key(t):
+                value = t[field]
+                if value in enumMap:
+                    return (0, enumMap[value])
+                else:
+                    return (1, value)
+            return key
 
-        # Do the sort by each field
+        keys = []
         for field in sortFields:
-            tickets.sort(key=itemgetter(field))
+            enumMap = None
+            if field in self.enumTypes:
+                enumMap = self.pm.enumMap(self.enumTypes[field])
+            if enumMap:
+                keys.append(enumKey(field, enumMap))
+            else:
+                keys.append(itemgetter(field))
+
+        if 'milestone' in sortFields:
+            keys.append(self.pm.isMilestone)
+
+        tickets.sort(key=lambda t: [key(t) for key in keys])
 
         return tickets
 
 
-    def _add_tasks(self, options):
+    def _add_tasks(self, state, options):
         if options.get('sample') and int(options['sample']) != 0:
-            tasks = self._add_sample_tasks()
+            tasks = self._add_sample_tasks(state)
         else:
             tasks = ''
-            self.tickets = self._query_tickets(options)
-
-            # Faster lookups for WBS and scheduling.
-            self.ticketsByID = {}
-            for t in self.tickets:
-                self.ticketsByID[t['id']] = t
-
-            # Schedule the tasks
-            self.pm.computeSchedule(options, self.tickets)
-
-            # Sort tickets by date for computing WBS
-            self.tickets.sort(self._compare_tickets)
-
-            # Compute the WBS
-            self._compute_wbs()
-
-            # Set the link for clicking through the Gantt chart
-            for t in self.tickets:
-                if t['id'] > 0:
-                    t['link'] = self.req.href.ticket(t['id'])
-                else:
-                    t['link'] = self.req.href.milestone(t['summary'])
-
-            # Filter tickets based on options (omitMilestones, display, etc.)
-            displayTickets = self._filter_tickets(options, self.tickets)
-
-            # Sort the remaining tickets for display (based on order option).
-            displayTickets = self._sortTickets(displayTickets, options)
-
-            for ticket in displayTickets:
-                tasks += self._format_ticket(ticket, options)
+            records = self._task_records(state, options)
+            if records:
+                tasks = 'JSGantt.addTaskData(%s, %s);\n' % \
+                    (state.GanttID, _jsonForScript(records))
 
         return tasks
 
-    def _parse_options(self, content):
-        _, options = parse_args(content, strict=False)
-
+    # Get the task records (see _format_ticket()) for the tickets
+    # options selects, in display order.
+    #
+    # Only tickets which are shown when the chart is drawn are
+    # included (see _visible_tickets()).  A closed group whose
+    # children are left out is marked lazy (a 15th element, 1) and has
+    # the start, finish and work/estimate of its children, as
+    # JSGantt.processRows() would compute them.
+    #
+    # @param options chart options
+    # @param parent ID of a lazy group to get the children of
+    def _task_records(self, state, options, parent=None):
+        state.tickets = self._query_tickets(state, options)
+
+        # Faster lookups for WBS and scheduling.
+        state.ticketsByID = {}
+        for t in state.tickets:
+            state.ticketsByID[t['id']] = t
+
+        # Schedule the tasks
+        self.pm.computeSchedule(options, state.tickets)
+
+        # Sort tickets by dependencies and date for computing WBS
+        state.ranks = self._rank_tickets(state)
+        state.tickets.sort(key=lambda t: state.ranks[t['id']])
+
+        # Compute the WBS
+        self._compute_wbs(state)
+
+        # Set the link for clicking through the Gantt chart
+        for t in state.tickets:
+            if t['id'] > 0:
+                t['link'] = state.req.href.ticket(t['id'])
+            else:
+                t['link'] = state.req.href.milestone(t['summary'])
+
+        # Filter tickets based on options (omitMilestones, display, etc.)
+        displayTickets = self._filter_tickets(options, state.tickets)
+
+        # Sort the remaining tickets for display (based on order option).
+        displayTickets = self._sortTickets(displayTickets, options)
+
+        visible = self._visible_tickets(displayTickets, options, parent)
+
+        displayedIDs = set([t['id'] for t in displayTickets])
+        children = {}
+        for t in displayTickets:
+            pid = self.pm.parent(t)
+            if pid in displayedIDs:
+                children.setdefault(pid, []).append(t)
+
+        # Start, finish, work, and estimate of a task, as in
+        # JSGantt.processRows() and JSGantt.TaskItem()
+        def summary(t):
+            kids = children.get(t['id'])
+            if kids:
+                parts = [summary(k) for k in kids]
+                return (min([part[0] for part in parts]),
+                        max([part[1] for part in parts]),
+                        sum([part[2] for part in parts]),
+                        sum([part[3] for part in parts]))
+
+            percent = self.pm.percentComplete(t)
+            if isinstance(percent, basestring) and '/' in percent:
+                work, estimate = [float(x) for x in percent.split('/')]
+            else:
+                work, estimate = float(percent), 100
+            return (self.pm.start(t), self.pm.finish(t), work, estimate)
+
+        records = []
+        for ticket in displayTickets:
+            if ticket['id'] not in visible:
+                continue
+            record = self._format_ticket(state, ticket, options)
+            if ticket['id'] in children and \
+                    not self._is_open(ticket, options):
+                start, finish, work, estimate = summary(ticket)
+                record[2] = _epochMS(start)
+                record[3] = _epochMS(finish)
+                record[8] = '%s/%s' % (work, estimate)
+                record.append(1)
+            records.append(record)
+        return records
+
+    # Fill in defaults for macro options not in options.
+    def _default_options(self, options):
         for opt in self.options.keys():
             if opt in options:
                 # FIXME - test for success, log on failure
@@ -725,24 +938,158 @@ All other macro arguments are treated as TracQuery specification (e.g., mileston
 
         return options
 
-    def expand_macro(self, formatter, name, content):
-        self.req = formatter.req
-
-        # Each invocation needs to build its own map.
-        self.classMap = None
+    # Get a key for what the viewer may see.
+    #
+    # With the default permission policies, users with the same
+    # permissions see the same tickets (so, e.g., all anonymous users
+    # share charts).  Otherwise, permissions may depend on the ticket
+    # and user so each user has their own charts.
+    def _permissionKey(self, state):
+        permSystem = PermissionSystem(self.env)
+        perms = sorted(permSystem.get_user_permissions(state.req.authname))
+        if not self._plain_permissions():
+            perms.append('user:%s' % state.req.authname)
+        return hashlib.sha1(repr(perms)).hexdigest()
+
+    # Get the key for a chart in the chart cache.
+    #
+    # @param options options as returned by _default_options()
+    def _cacheKey(self, state, options):
+        key = [sorted(options.items()), self._permissionKey(state),
+               state.req.href()]
+        # root=self and goal=self depend on the page the chart is on.
+        if 'self' in (options.get('root'), options.get('goal')):
+            key.append(state.req.path_info)
+        # Queries expand $USER to the viewer.
+        if [v for v in options.values()
+            if isinstance(v, basestring) and '$USER' in v]:
+            key.append(state.req.authname)
+        return repr(key)
+
+    # Get the state a cached chart must have been rendered in to be
+    # current: the data it's built from, enums and user names, and
+    # the date (unscheduled tasks start today).
+    def _cacheStamp(self):
+        return (self.pm.dataVersion(),
+                self.pm.namesVersion(),
+                datetime.now(localtz).date())
+
+    # Get a chart from the cache.
+    #
+    # @param key key from _cacheKey()
+    # @param stamp state from _cacheStamp()
+    #
+    # @return the chart markup, using the current GanttID, or None if
+    #   there's no current chart for key
+    def _cachedChart(self, state, key, stamp):
+        with self.chartCacheLock:
+            entry = self.chartCache.pop(key, None)
+            if entry is None:
+                return None
+            oldStamp, ganttID, chart = entry
+            if oldStamp != stamp:
+                return None
+            self.chartCache[key] = entry
+        return chart.replace(ganttID, state.GanttID)
+
+    # Save a chart in the cache, dropping the least recently used if
+    # the cache is full.
+    def _cacheChart(self, state, key, stamp, chart):
+        if self.cacheSize <= 0:
+            return
+        with self.chartCacheLock:
+            self.chartCache.pop(key, None)
+            self.chartCache[key] = (stamp, state.GanttID, chart)
+            while len(self.chartCache) > self.cacheSize:
+                self.chartCache.popitem(last=False)
+
+    # Get the URL to fetch the tasks for a chart with macro arguments
+    # args from.
+    def _tasks_href(self, state, args):
+        args = dict(args)
+        args.pop('async', None)
+        # There's no "self" for the data request; pass the ticket ID.
+        matches = re.match('/ticket/(\d+)', state.req.path_info)
+        for opt in ('root', 'goal'):
+            if args.get(opt) == 'self' and matches:
+                args[opt] = matches.group(1)
+        return state.req.href('pm', 'gantt.json', args)
 
-        options = self._parse_options(content)
+    def expand_macro(self, formatter, name, content):
+        _, args = parse_args(content, strict=False)
+        options = self._default_options(dict(args))
 
         # Surely we can't create two charts in one microsecond.
-        self.GanttID = 'g_'+str(to_utimestamp(datetime.now(localtz)))
+        state = _ChartState(formatter.req,
+                            'g_'+str(to_utimestamp(datetime.now(localtz))))
+
+        # Where to get tasks from (all, or the children of lazy
+        # groups)
+        tasksURL = self._tasks_href(state, args)
+
+        # Draw an empty chart and fill it in when the tasks arrive.
+        if int(options['async']) and not int(options['sample']):
+            chart = ''
+            chart += self._begin_gantt(state, options)
+            chart += self._gantt_options(state, options)
+            chart += self._load_gantt(state, options, tasksURL)
+            return chart
+
+        # Reuse the chart if nothing it shows has changed.
+        key = self._cacheKey(state, options)
+        stamp = self._cacheStamp()
+        chart = self._cachedChart(state, key, stamp)
+        if chart is not None:
+            return chart
+
         chart = ''
-        tasks = self._add_tasks(options)
+        tasks = self._add_tasks(state, options)
         if len(tasks) == 0:
             chart += 'No tasks selected.'
         else:
-            chart += self._begin_gantt(options)
-            chart += self._gantt_options(options)
+            chart += self._begin_gantt(state, options)
+            chart += self._gantt_options(state, options)
+            chart += state.GanttID + '.setTaskDataURL("%s");\n' % \
+                javascript_quote(tasksURL)
             chart += tasks
-            chart += self._end_gantt(options)
+            chart += self._end_gantt(state, options)
 
+        self._cacheChart(state, key, stamp, chart)
         return chart
+
+    # IRequestHandler methods
+    #
+    # /pm/gantt.json takes the macro's arguments and returns the task
+    # records for the chart (see _task_records()) as JSON.  With
+    # _children_of=<id>, only the records to show when that lazy group
+    # is opened are returned.  (The argument name can't be a ticket
+    # field like parent, which the macro arguments may filter on.)
+    # The ETag changes when the data the chart is built from or the
+    # user's permissions do.
+
+    def match_request(self, req):
+        return req.path_info == '/pm/gantt.json'
+
+    def process_request(self, req):
+        state = _ChartState(req, None)
+
+        args = dict([(k, v) for k, v in req.args.iteritems()
+                     if not k.startswith('__')])
+        parent = args.pop('_children_of', None)
+        if parent is not None:
+            try:
+                parent = int(parent)
+            except (TypeError, ValueError):
+                raise HTTPBadRequest('Invalid _children_of "%s"' % parent)
+        options = self._default_options(args)
+
+        # Unscheduled tasks start today so the data may change daily.
+        today = datetime.now(localtz).replace(hour=0, minute=0, second=0,
+                                              microsecond=0)
+        req.check_modified(today, [self._cacheKey(state, options), parent,
+                                   self.pm.dataVersion(),
+                                   self.pm.namesVersion()])
+
+        records = self._task_records(state, options, parent)
+        req.send(json.dumps(records, separators=(',', ':')),
+                 'application/json')
@@ -6,24 +6,39 @@
 # This software is licensed as described in the file COPYING, which
 # you should have received as part of this distribution.
 
+import os
 import re
 import time
 import math
 import copy
+import zlib
+import base64
+import hashlib
+import threading
+try:
+    import json
+except ImportError:
+    import simplejson as json
 from datetime import timedelta, datetime
 
 from trac.ticket import ITicketChangeListener, Ticket
+from trac.ticket.api import TicketSystem
 from trac.ticket.query import Query
+from trac.util import as_bool
 from trac.util.datefmt import format_date, localtz, to_datetime
 try:
-    from trac.util.datefmt import to_utimestamp
+    from trac.util.datefmt import to_utimestamp, from_utimestamp
 except ImportError:
     from trac.util.datefmt import to_timestamp as to_utimestamp
+    from trac.util.datefmt import to_datetime as from_utimestamp
 
 from trac.config import IntOption, Option, ExtensionOption
 from trac.core import implements, Component, TracError, Interface, ExtensionPoint
 from trac.env import IEnvironmentSetupParticipant
 from trac.db import DatabaseManager
+from trac.web.api import IRequestFilter, IRequestHandler, HTTPBadRequest
+from trac.admin.api import IAdminCommandProvider, AdminCommandError
+from trac.util.text import printout
 
 from pmapi import IResourceCalendar, ITaskScheduler, ITaskSorter
 
@@ -125,10 +140,57 @@ class TracPM(Component):
             cursor.execute("UPDATE system SET value=%s WHERE name=%s",
                            (db_default.version, db_default.name))
 
-        # Create tables
+        # Create tables added since the version found
         for table in db_default.tables:
-            for sql in db_manager.to_sql(table):
-                cursor.execute(sql)
+            if db_default.table_versions[table.name] > self.found_db_version:
+                for sql in db_manager.to_sql(table):
+                    cursor.execute(sql)
+
+        if self.found_db_version == 1:
+            # Flag schedule changes that idled a ticket
+            cursor.execute('ALTER TABLE schedule_change' + \
+                               ' ADD COLUMN idled integer')
+            self._flagIdled(cursor)
+
+            # Start scheduleAsOf() from the schedule as of the last
+            # change saved before checkpoints were kept.
+            cursor.execute('SELECT MAX(time) FROM schedule_change')
+            when = cursor.fetchone()[0]
+            if when is not None:
+                self._writeCheckpoint(cursor, when)
+
+    # Flag schedule changes saved before version 2 that idled a ticket.
+    #
+    # Those had no new dates or, for closed tickets, the same old and
+    # new dates.  Unchanged tickets were saved the same way so the
+    # latter only count if the ticket's next change added it to the
+    # schedule again or, if there is none, it is not in it now.
+    #
+    # @param cursor cursor to use
+    def _flagIdled(self, cursor):
+        # MySQL can't read the table being updated in a subquery
+        # except through a derived table.
+        history = '(SELECT ticket, time, oldstart, oldfinish' + \
+            ' FROM schedule_change)'
+        later = ' WHERE %s.ticket = schedule_change.ticket' + \
+            ' AND %s.time > schedule_change.time'
+        cursor.execute('UPDATE schedule_change SET idled=1' + \
+                           ' WHERE (newstart IS NULL' + \
+                           ' AND newfinish IS NULL)' + \
+                           ' OR ((oldstart = newstart' + \
+                           ' OR oldstart IS NULL AND newstart IS NULL)' + \
+                           ' AND (oldfinish = newfinish' + \
+                           ' OR oldfinish IS NULL AND newfinish IS NULL)' + \
+                           ' AND (EXISTS (SELECT * FROM ' + history + \
+                           ' AS n WHERE n.ticket = schedule_change.ticket' + \
+                           ' AND n.oldstart IS NULL' + \
+                           ' AND n.oldfinish IS NULL' + \
+                           ' AND n.time = (SELECT MIN(m.time) FROM ' + \
+                           history + ' AS m' + later % ('m', 'm') + '))' + \
+                           ' OR NOT EXISTS (SELECT * FROM ' + history + \
+                           ' AS m' + later % ('m', 'm') + ')' + \
+                           ' AND ticket NOT IN' + \
+                           ' (SELECT ticket FROM schedule)))')
 
 
     # Configurable data sources
@@ -185,6 +247,9 @@ class TracPM(Component):
            """List of statuses for goal-type tickets that are active""")
     Option(cfgSection, 'useActuals', '0',
            """Use actual start, finish date for tickets""")
+    Option(cfgSection, 'checkpoint_interval_hours', '24',
+           """Hours between copies of the schedule kept for
+              scheduleAsOf() (0 to keep none)""")
 
     scheduler = ExtensionOption(cfgSection, 'scheduler',
                                 ITaskScheduler, 'ResourceScheduler')
@@ -298,10 +363,16 @@ class TracPM(Component):
 
         # This is the format of start and finish in the Trac database
         self.dbDateFormat = str(self.config.get(self.cfgSection, 'date_format'))
+        self._parsedDates = {}
 
         # Use actual start, finish time for tickets
         self.useActuals = int(self.config.get(self.cfgSection, 'useActuals'))
 
+        # How often to checkpoint the schedule
+        self.checkpointInterval = \
+            float(self.config.get(self.cfgSection,
+                                  'checkpoint_interval_hours'))
+
     # Return True if all of the listed PM data items ('pred',
     # 'parent', etc.) have sources configured, False otherwise
     def isCfg(self, sources):
@@ -332,16 +403,58 @@ class TracPM(Component):
     # FIXME - Many of these should be marked as more private.  Perhaps
     # an leading underscore?
 
+    # Dates in the default date_format can be parsed without strptime().
+    isoDatePattern = re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})$')
+
+    # Most charts use few distinct dates so parsed dates are kept
+    # (datetimes are immutable).  The cache is cleared when it gets
+    # this big.
+    parsedDatesSize = 10000
+
     def parseDbDate(self, dateString):
         if not dateString:
-            d = None
-        else:
-            d = datetime(*time.strptime(dateString,
-                                        self.dbDateFormat)[0:7])
+            return None
+
+        d = self._parsedDates.get(dateString)
+        if d is None:
+            match = None
+            if self.dbDateFormat == '%Y-%m-%d':
+                match = self.isoDatePattern.match(dateString)
+            if match:
+                d = datetime(*[int(part) for part in match.groups()])
+            else:
+                d = datetime(*time.strptime(dateString,
+                                            self.dbDateFormat)[0:7])
             d = d.replace(hour=0, minute=0, second=0, microsecond=0,
                           tzinfo=localtz)
+
+            if len(self._parsedDates) >= self.parsedDatesSize:
+                self._parsedDates = {}
+            self._parsedDates[dateString] = d
         return d
 
+    # Convert the date in ticket[key] with convert(), once.
+    #
+    # start(), finish() and the scheduler read ticket dates many times
+    # while sorting and scheduling.  The converted value is kept on the
+    # ticket with the value it came from and reused until that changes.
+    #
+    # @param ticket ticket with the date
+    # @param key name of the field with the date (e.g., '_sched_start')
+    # @param convert function to turn the field value into a datetime
+    #
+    # @return the converted date
+    def ticketDate(self, ticket, key, convert=to_datetime):
+        memo = ticket.get('_pm_dates')
+        if memo is None:
+            memo = ticket['_pm_dates'] = {}
+        value = ticket[key]
+        cached = memo.get(key)
+        if cached is None or cached[0] != value:
+            cached = (value, convert(value))
+            memo[key] = cached
+        return cached[1]
+
     # Parse the start field and return a datetime
     # Return None if the field is not configured or empty.
     def parseStart(self, ticket):
@@ -355,7 +468,8 @@ class TracPM(Component):
     def parseTaskDate(self, ticket, field):
         if self.isSet(ticket, field):
             try:
-                taskDate = self.parseDbDate(ticket[self.fields[field]])
+                taskDate = self.ticketDate(ticket, self.fields[field],
+                                           self.parseDbDate)
             except:
                 raise TracError('Ticket %s has an invalid %s value, "%s".' \
                                     ' It should match the format "%s".' %
@@ -451,7 +565,7 @@ class TracPM(Component):
         if ticket.get('_calc_start'):
             return ticket['_calc_start'][0]
         elif ticket.get('_sched_start'):
-            return to_datetime(ticket['_sched_start'])
+            return self.ticketDate(ticket, '_sched_start')
         else:
             return None
 
@@ -460,7 +574,7 @@ class TracPM(Component):
         if ticket.get('_calc_finish'):
             return ticket['_calc_finish'][0]
         elif ticket.get('_sched_finish'):
-            return to_datetime(ticket['_sched_finish'])
+            return self.ticketDate(ticket, '_sched_finish')
         else:
             return None
 
@@ -625,10 +739,12 @@ class TracPM(Component):
     # Expand the list of tickets in origins to include those
     # related through field.
     #
-    # Recurses following link until
+    # Follows link until
     #  * no new items are found, or
     #  * field has been followed depth times
     #
+    # All the steps use the same database connection.
+    #
     # @param origins a list of ticket IDs as strings
     # @param field the field to follow
     # @param format the format of ticket IDs in field
@@ -637,63 +753,72 @@ class TracPM(Component):
     # @return a list of integer ticket IDs of tickets up to depth
     # steps from origins via field
     def _followLink(self, origins, field, format, depth = -1):
-        if len(origins) == 0 or depth == 0:
-            return []
+        found = []
+        # Ticket IDs we already know about
+        known = set(['%s' % tid for tid in origins])
 
-        node_list = [format % tid for tid in origins]
         with self.env.db_query as db:
             cursor = db.cursor()
-            # Query from external table
-            if self.isRelation(field):
-                relation = self.relations[self.sources[field]]
-                # Forward query
-                if field == relation[0]:
-                    (f1, f2, tbl, src, dst) = relation
-                # Reverse query
-                elif field == relation[1]:
-                    (f1, f2, tbl, dst, src) = relation
+            while len(origins) != 0 and depth != 0:
+                depth -= 1
+                node_list = [format % tid for tid in origins]
+
+                # Query from external table
+                if self.isRelation(field):
+                    relation = self.relations[self.sources[field]]
+                    # Forward query
+                    if field == relation[0]:
+                        (f1, f2, tbl, src, dst) = relation
+                    # Reverse query
+                    elif field == relation[1]:
+                        (f1, f2, tbl, dst, src) = relation
+                    else:
+                        raise TracError('Relation configuration error for %s' %
+                                        field)
+
+                    # Build up enough instances of %s to represent all the
+                    # nodes.  The DB API will replace them with items from
+                    # node_list, properly quoted for the DB back-end.
+                    #
+                    # In 0.12, we could do
+                    #
+                    #   ','.join([db.quote(node) for node in node_list])
+                    #
+                    # but 0.11 doesn't have db.quote()
+                    inClause = "IN (%s)" % ','.join(('%s',) * len(node_list))
+                    cursor.execute("SELECT %s FROM %s WHERE %s " % \
+                                       (dst, tbl, src) + \
+                                       inClause,
+                                   node_list)
+                # Query from custom field
+                elif self.isField(field):
+                    fieldName = self.fields[self.sources[field]]
+                    # See explantion in relation handling, above.
+                    inClause = "IN (%s)" % ','.join(('%s',) * len(node_list))
+                    cursor.execute("SELECT t.id "
+                                   "FROM ticket AS t "
+                                   "LEFT OUTER JOIN ticket_custom AS p ON "
+                                   "    (t.id=p.ticket AND p.name=%s) "
+                                   "WHERE p.value " + inClause,
+                                   [fieldName] + node_list)
+                # We really can't get here because the callers test for
+                # isCfg() but it's nice form to have an else.
                 else:
-                    raise TracError('Relation configuration error for %s' %
+                    raise TracError('Cannot expand %s; '
+                                    'Not configured as a field or relation.' %
                                     field)
 
-                # Build up enough instances of %s to represent all the
-                # nodes.  The DB API will replace them with items from
-                # node_list, properly quoted for the DB back-end.
-                #
-                # In 0.12, we could do
-                #
-                #   ','.join([db.quote(node) for node in node_list])
-                #
-                # but 0.11 doesn't have db.quote()
-                inClause = "IN (%s)" % ','.join(('%s',) * len(node_list))
-                cursor.execute("SELECT %s FROM %s WHERE %s " % \
-                                   (dst, tbl, src) + \
-                                   inClause,
-                               node_list)
-            # Query from custom field
-            elif self.isField(field):
-                fieldName = self.fields[self.sources[field]]
-                # See explantion in relation handling, above.
-                inClause = "IN (%s)" % ','.join(('%s',) * len(node_list))
-                cursor.execute("SELECT t.id "
-                               "FROM ticket AS t "
-                               "LEFT OUTER JOIN ticket_custom AS p ON "
-                               "    (t.id=p.ticket AND p.name=%s) "
-                               "WHERE p.value " + inClause,
-                               [fieldName] + node_list)
-            # We really can't get here because the callers test for
-            # isCfg() but it's nice form to have an else.
-            else:
-                raise TracError('Cannot expand %s; '
-                                'Not configured as a field or relation.' %
-                                field)
+                # Get tickets IDs of related tickets as strings
+                nodes = ['%s' % row[0] for row in cursor]
+                # Filter out ticket IDs we already know about
+                nodes = [tid for tid in set(nodes) if tid not in known]
+                known |= set(nodes)
 
-            # Get tickets IDs of related tickets as strings
-            nodes = ['%s' % row[0] for row in cursor]
-            # Filter out ticket IDs we already know about
-            nodes = [tid for tid in nodes if tid not in origins]
+                # Follow the link from the new tickets next time
+                found += nodes
+                origins = nodes
 
-        return nodes + self._followLink(nodes, field, format, depth - 1)
+        return found
 
 
     # Returns (possibily empty) set of ID strings of tickets
@@ -814,94 +939,550 @@ class TracPM(Component):
 
         return ticket
 
+    # Get a cache that lives as long as req.
+    #
+    # Several charts on one page (or a chart and a query in the same
+    # request) look up the same things.  Caches are hashes stored on
+    # the request object so they go away with it.
+    #
+    # @param req request the cache belongs to (None for no cache)
+    # @param name name of the cache
+    #
+    # @return a hash to use as a cache
+    def requestCache(self, req, name):
+        if req is None:
+            return {}
+        caches = getattr(req, '_pm_caches', None)
+        if caches is None:
+            caches = {}
+            req._pm_caches = caches
+        return caches.setdefault(name, {})
+
+    # Enum value maps and the user name map, each with the Trac data
+    # it was built from and a digest of its contents.  See enumMap(),
+    # userNames() and namesVersion().
+    _enumMaps = (None, {}, '')
+    _userNames = (None, {}, '')
+
+    # Get the map from name to integer value for an enum.
+    #
+    # When sorting on an enum like priority or severity, we need to
+    # sort on 1, 2, 3, not 'critical', 'blocker', 'major', etc.
+    #
+    # All enums are read in one query and shared by every caller in
+    # the environment.  Trac resets the ticket field cache whenever an
+    # enum changes (in any process) so the maps are rebuilt when
+    # TicketSystem.fields is.
+    #
+    # @param field enum type (e.g., 'priority')
+    #
+    # @return a hash of integer values indexed by name.  Callers
+    #   must not modify it.
+    def enumMap(self, field):
+        fields = TicketSystem(self.env).fields
+        source, maps, digest = self._enumMaps
+        if source is not fields:
+            maps = {}
+            with self.env.db_query as db:
+                cursor = db.cursor()
+                cursor.execute("SELECT type,name," +
+                               db.cast('value', 'int') +
+                               " FROM enum")
+                for enumType, name, value in cursor:
+                    maps.setdefault(enumType, {})[name] = value
+            digest = hashlib.md5(repr(sorted([(enumType, sorted(m.items()))
+                                              for enumType, m
+                                              in maps.items()]))).hexdigest()
+            self._enumMaps = (fields, maps, digest)
+
+        return maps.get(field, {})
+
+    # Get the map from login to full name for known users.
+    #
+    # Built from Trac's list of known users (which Trac caches and
+    # refreshes when session data changes) and rebuilt only when that
+    # list changes.
+    #
+    # @return a hash of names indexed by login for users who set
+    #   their name.  Callers must not modify it.
+    def userNames(self):
+        users = list(self.env.get_known_users())
+        source, names, digest = self._userNames
+        if users != source:
+            names = {}
+            for username, name, email in users:
+                if name:
+                    names[username] = name
+            digest = hashlib.md5(repr(sorted(names.items()))).hexdigest()
+            self._userNames = (users, names, digest)
+
+        return names
+
+    # Get a stamp that changes when what enumMap() or userNames()
+    # returns does (e.g., when a priority is renamed or a user sets
+    # their name).
+    #
+    # @return a string to compare with an earlier stamp
+    def namesVersion(self):
+        # Rebuild the maps if they are out of date.
+        self.enumMap(None)
+        self.userNames()
+        return self._enumMaps[2] + self._userNames[2]
+
+    # Get a stamp that changes when the data a schedule is computed
+    # from changes: tickets (changing a custom field or a link updates
+    # the ticket's changetime), milestones and the saved schedule.
+    # Cheap enough to check on every request.
+    #
+    # @return a tuple to compare with an earlier stamp
+    def dataVersion(self):
+        with self.env.db_query as db:
+            cursor = db.cursor()
+            cursor.execute('SELECT COUNT(*), MAX(changetime) FROM ticket')
+            stamp = tuple(cursor.fetchone())
+            cursor.execute('SELECT COUNT(*), SUM(due), SUM(completed)' + \
+                               ' FROM milestone')
+            stamp += tuple(cursor.fetchone())
+            cursor.execute('SELECT MAX(time) FROM schedule_change')
+            stamp += tuple(cursor.fetchone())
+        return stamp
+
+    # Save a copy of the schedule table in schedule_checkpoint.
+    #
+    # @param force if False (default), only save if the last checkpoint
+    #   is at least checkpoint_interval_hours old
+    # @param when timestamp of the last schedule change the copy
+    #   includes (default, now)
+    #
+    # @return True if a checkpoint was saved
+    def checkpointSchedule(self, force=False, when=None):
+        if not force and self.checkpointInterval <= 0:
+            return False
+
+        if when is None:
+            when = to_utimestamp(datetime.now().replace(tzinfo=localtz))
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            if not force:
+                cursor.execute('SELECT MAX(time) FROM schedule_checkpoint')
+                last = cursor.fetchone()[0]
+                interval = int(self.checkpointInterval * 3600 * 1000000)
+                if last and when - last < interval:
+                    return False
+
+            self._writeCheckpoint(cursor, when)
+        return True
+
+    # Copy the schedule table to schedule_checkpoint.
+    #
+    # @param cursor cursor to use
+    # @param when timestamp to save the copy as of
+    def _writeCheckpoint(self, cursor, when):
+        cursor.execute('SELECT ticket, start, finish FROM schedule')
+        data = json.dumps([list(row) for row in cursor])
+        cursor.execute('INSERT INTO schedule_checkpoint (time, data)' + \
+                           ' VALUES (%s,%s)',
+                       (when, base64.b64encode(zlib.compress(data))))
+
+    # Get the saved start and finish of tickets.
+    #
+    # @param tickets list of tickets
+    #
+    # @return a hash of (start, finish) timestamps indexed by integer
+    #   ticket ID for the tickets in the schedule table
+    def savedSchedule(self, tickets):
+        ids = [t['id'] for t in tickets]
+        saved = {}
+        with self.env.db_query as db:
+            cursor = db.cursor()
+            for i in range(0, len(ids), self.inClauseSize):
+                chunk = ids[i:i + self.inClauseSize]
+                inClause = 'IN (%s)' % ','.join(('%s',) * len(chunk))
+                cursor.execute('SELECT ticket, start, finish' + \
+                                   ' FROM schedule WHERE ticket ' + \
+                                   inClause,
+                               chunk)
+                for tid, start, finish in cursor:
+                    saved[tid] = (start, finish)
+        return saved
+
+    # Get the schedule as it was at a point in time.
+    #
+    # Starts from the latest checkpoint at or before when (see
+    # checkpointSchedule()) and replays the schedule changes after it.
+    # Changes flagged idled remove a ticket.
+    #
+    # @param when datetime to get the schedule for
+    #
+    # @return a hash of [start, finish] datetimes indexed by integer
+    #   ticket ID
+    def scheduleAsOf(self, when):
+        ts = to_utimestamp(when)
+        schedule = {}
+        with self.env.db_query as db:
+            cursor = db.cursor()
+            cursor.execute('SELECT time, data FROM schedule_checkpoint' + \
+                               ' WHERE time <= %s' + \
+                               ' ORDER BY time DESC LIMIT 1',
+                           (ts,))
+            row = cursor.fetchone()
+            if row:
+                since = row[0]
+                for tid, start, finish in \
+                        json.loads(zlib.decompress(base64.b64decode(row[1]))):
+                    schedule[tid] = (start, finish)
+            else:
+                since = -1
+
+            cursor.execute('SELECT ticket, newstart, newfinish, idled' + \
+                               ' FROM schedule_change' + \
+                               ' WHERE time > %s AND time <= %s' + \
+                               ' ORDER BY time',
+                           (since, ts))
+            for tid, newStart, newFinish, idled in cursor:
+                if idled:
+                    schedule.pop(tid, None)
+                else:
+                    schedule[tid] = (newStart, newFinish)
+
+        result = {}
+        for tid in schedule:
+            start, finish = schedule[tid]
+            result[tid] = [ start and from_utimestamp(start),
+                            finish and from_utimestamp(finish) ]
+        return result
+
+    # Split tickets into groups that can be scheduled independently.
+    #
+    # Tickets are in the same group if they are linked (parent/child
+    # or dependency) or, when leveling resources, have the same owner.
+    #
+    # @param tickets list of tickets as returned by query()
+    # @param leveling True if resources are leveled
+    #
+    # @return a list of lists of tickets, largest first
+    def ticketGroups(self, tickets, leveling):
+        # Union-find over ticket IDs
+        leader = {}
+        def find(tid):
+            root = tid
+            while leader[root] != root:
+                root = leader[root]
+            while leader[tid] != root:
+                leader[tid], tid = root, leader[tid]
+            return root
+        def union(tid1, tid2):
+            if tid2 in leader:
+                leader[find(tid1)] = find(tid2)
+
+        for t in tickets:
+            leader[t['id']] = t['id']
+
+        byOwner = {}
+        for t in tickets:
+            for tid in self.predecessors(t) + self.successors(t) + \
+                    self.children(t):
+                union(t['id'], tid)
+            pid = self.parent(t)
+            if pid:
+                union(t['id'], pid)
+            if leveling and t['owner'] and not self.isMilestone(t):
+                if t['owner'] in byOwner:
+                    union(t['id'], byOwner[t['owner']])
+                else:
+                    byOwner[t['owner']] = t['id']
+
+        groups = {}
+        for t in tickets:
+            groups.setdefault(find(t['id']), []).append(t)
+        return sorted(groups.values(), key=len, reverse=True)
+
+    # Apply hypothetical changes to tickets and see how the schedule
+    # would change.  Nothing is written to the database and tickets
+    # is not modified.
+    #
+    # overrides is a hash which may have:
+    #  * tickets: a hash of changes indexed by ticket ID.  Each
+    #    change may have estimate (new estimate), owner (new owner),
+    #    addPred, removePred, addSucc, removeSucc (lists of IDs of
+    #    dependencies to add or remove).
+    #  * unavailable: a hash of lists of dates ('YYYY-MM-DD' strings
+    #    or date objects) indexed by owner.  The owner has no hours
+    #    on those dates.
+    #
+    # Only the groups of tickets (see ticketGroups()) the changes can
+    # affect are scheduled, with and without the changes and with the
+    # same options, and the two schedules compared.
+    #
+    # @param options schedule options as for computeSchedule()
+    # @param tickets list of tickets as returned by query()
+    # @param overrides changes to make, as above
+    #
+    # @return a list of hashes for tickets whose dates would change,
+    #   ordered by ID, with id, start and finish ([before, after]
+    #   datetimes)
+    def simulate(self, options, tickets, overrides):
+        changes = overrides.get('tickets') or {}
+        unavailable = overrides.get('unavailable') or {}
+        if not isinstance(changes, dict) or \
+                not isinstance(unavailable, dict):
+            raise TracError('Ticket changes and unavailable dates must'
+                            ' be indexed by ticket ID and owner')
+        changes = self._simulationChanges(changes, tickets)
+
+        options = dict(options)
+        options['force'] = True
+        leveling = options.get('doResourceLeveling') == '1'
+
+        dates = {}
+        for owner in unavailable:
+            if not isinstance(unavailable[owner], list):
+                raise TracError('Unavailable dates for %s must be a list' %
+                                owner)
+            dates[owner] = set()
+            for d in unavailable[owner]:
+                if isinstance(d, basestring):
+                    try:
+                        d = datetime(*time.strptime(d, '%Y-%m-%d')[0:3])
+                    except ValueError:
+                        raise TracError('Invalid date "%s" for %s' %
+                                        (d, owner))
+                    d = d.date()
+                dates[owner].add(d)
+
+        # Apply the changes to a copy of the tickets.
+        modified = [copy.deepcopy(t) for t in tickets]
+        modifiedByID = dict([(t['id'], t) for t in modified])
+        def linkKey(field):
+            if self.isField(field):
+                return self.fields[self.sources[field]]
+            else:
+                return field
+        for tid in changes:
+            change = changes[tid]
+            t = modifiedByID[tid]
+            if 'owner' in change:
+                t['owner'] = change['owner']
+            if 'estimate' in change and self.isCfg('estimate'):
+                t[self.fields['estimate']] = change['estimate']
+            for field, other in [('pred', 'succ'), ('succ', 'pred')]:
+                if not self.isCfg([field, other]):
+                    continue
+                cap = field.capitalize()
+                for oid in change.get('add' + cap, []):
+                    o = modifiedByID.get(oid)
+                    if o and oid not in t[linkKey(field)]:
+                        t[linkKey(field)].append(oid)
+                        o[linkKey(other)].append(t['id'])
+                for oid in change.get('remove' + cap, []):
+                    o = modifiedByID.get(oid)
+                    if o:
+                        t[linkKey(field)] = [i for i in t[linkKey(field)]
+                                             if i != oid]
+                        o[linkKey(other)] = [i for i in o[linkKey(other)]
+                                             if i != t['id']]
+
+        # Only groups with a changed ticket or an unavailable owner,
+        # before or after the changes, can be affected.
+        def affectedIDs(tickets):
+            ids = set()
+            for group in self.ticketGroups(tickets, leveling):
+                for t in group:
+                    if t['id'] in changes or t['owner'] in unavailable:
+                        ids.update([g['id'] for g in group])
+                        break
+            return ids
+        ids = affectedIDs(tickets) | affectedIDs(modified)
+
+        before = [copy.deepcopy(t) for t in tickets if t['id'] in ids]
+        self.computeSchedule(dict(options), before)
+
+        after = [t for t in modified if t['id'] in ids]
+        options['unavailable'] = dates
+        self.computeSchedule(options, after)
+
+        beforeByID = dict([(t['id'], t) for t in before])
+        result = []
+        for t in sorted(after, key=lambda t: t['id']):
+            b = beforeByID[t['id']]
+            if self.start(b) != self.start(t) or \
+                    self.finish(b) != self.finish(t):
+                result.append({'id': t['id'],
+                               'start': [self.start(b), self.start(t)],
+                               'finish': [self.finish(b), self.finish(t)]})
+        return result
+
+    # Check and normalize the ticket changes for simulate().
+    #
+    # @param changes hash of changes indexed by ticket ID, as for
+    #   simulate()
+    # @param tickets tickets being simulated
+    #
+    # @return the changes indexed by integer ticket ID with estimates
+    #   as strings and dependencies as lists of integer IDs
+    def _simulationChanges(self, changes, tickets):
+        ids = set([t['id'] for t in tickets])
+        result = {}
+        for tid in changes:
+            if not str(tid).isdigit():
+                raise TracError('Invalid ticket ID "%s"' % tid)
+            if int(tid) not in ids:
+                raise TracError('Cannot simulate changes to ticket %s;'
+                                ' it is not in the query' % tid)
+            change = changes[tid]
+            if not isinstance(change, dict):
+                raise TracError('Invalid changes for ticket %s' % tid)
+
+            clean = {}
+            for key in change:
+                value = change[key]
+                if key == 'owner':
+                    if not isinstance(value, basestring):
+                        raise TracError('Invalid owner for ticket %s' % tid)
+                    clean[key] = value
+                elif key == 'estimate':
+                    try:
+                        float(value)
+                    except (TypeError, ValueError):
+                        raise TracError('Invalid estimate "%s" for'
+                                        ' ticket %s' % (value, tid))
+                    clean[key] = str(value)
+                elif key in ('addPred', 'removePred',
+                             'addSucc', 'removeSucc'):
+                    if not isinstance(value, list) or \
+                            [oid for oid in value
+                             if isinstance(oid, bool) or
+                             not (isinstance(oid, (int, long)) or
+                                  isinstance(oid, basestring) and
+                                  oid.isdigit())]:
+                        raise TracError('%s for ticket %s must be a list'
+                                        ' of ticket IDs' % (key, tid))
+                    clean[key] = [int(oid) for oid in value]
+                else:
+                    raise TracError('Cannot simulate changing %s of'
+                                    ' ticket %s' % (key, tid))
+            result[int(tid)] = clean
+        return result
+
+    # Get milestone name, due and completed date for each milestone in
+    # milestones.
+    #
+    # @param milestones list of milestone names
+    # @param req request to cache the rows for (optional)
+    #
+    # @return a list of (name, due, completed) for milestones that
+    #   exist, in the order they were asked for
+    def _milestoneRows(self, milestones, req=None):
+        # Milestones we've seen are cached by name.  Those that don't
+        # exist are cached as None so we don't look for them again.
+        cache = self.requestCache(req, 'milestones')
+        missing = list(set([m for m in milestones if m not in cache]))
+        if missing:
+            with self.env.db_query as db:
+                cursor = db.cursor()
+                # See explanation in _followLink()
+                inClause = "IN (%s)" % ','.join(('%s',) * len(missing))
+                cursor.execute("SELECT name, due, completed FROM milestone " +
+                               "WHERE name " + inClause,
+                               missing)
+                for m in missing:
+                    cache[m] = None
+                for row in cursor:
+                    cache[row[0]] = row
+
+        rows = []
+        seen = set()
+        for m in milestones:
+            if cache[m] and m not in seen:
+                rows.append(cache[m])
+                seen.add(m)
+        return rows
+
     # Add tasks for milestones related to the tickets
-    def _add_milestones(self, options, tickets):
+    def _add_milestones(self, options, tickets, req=None):
         if options.get('milestone'):
             milestones = options['milestone'].split('|')
         else:
             milestones = []
 
+        # Group tickets by milestone in one pass so each milestone
+        # only looks at its own tickets.
+        ticketsByMilestone = {}
         for t in tickets:
-            if 'milestone' in t and \
-                    t['milestone'] != '' and \
-                    t['milestone'] not in milestones:
-                milestones.append(t['milestone'])
+            if 'milestone' in t and t['milestone'] != '':
+                if t['milestone'] not in ticketsByMilestone:
+                    ticketsByMilestone[t['milestone']] = []
+                    if t['milestone'] not in milestones:
+                        milestones.append(t['milestone'])
+                ticketsByMilestone[t['milestone']].append(t)
 
         # Need a unique ID for each task.
         if len(milestones) > 0:
             tid = 0
 
             # Get the milestones and their due dates
-            with self.env.db_query as db:
-                cursor = db.cursor()
-                # See explanation in _followLink()
-                inClause = "IN (%s)" % ','.join(('%s',) * len(milestones))
-                cursor.execute("SELECT name, due, completed FROM milestone " +
-                               "WHERE name " + inClause,
-                               milestones)
-                for row in cursor:
-                    msName, msDueDate, msCompletedDate = row
-
-                    tid = tid - 1
-                    milestoneTicket = self._pseudoTicket(tid,
-                                                         msName,
-                                                         'Milestone %s' % msName,
-                                                         msName)
-
-                    # If the completed date is set (non-0), the milestone is closed"
-                    if msCompletedDate:
-                        milestoneTicket['status'] = 'closed'
-                    # Otherwise, use the configured open status
+            for row in self._milestoneRows(milestones, req):
+                msName, msDueDate, msCompletedDate = row
+
+                tid = tid - 1
+                milestoneTicket = self._pseudoTicket(tid,
+                                                     msName,
+                                                     'Milestone %s' % msName,
+                                                     msName)
+
+                # If the completed date is set (non-0), the milestone is closed"
+                if msCompletedDate:
+                    milestoneTicket['status'] = 'closed'
+                # Otherwise, use the configured open status
+                else:
+                    milestoneTicket['status'] = self.incompleteMilestoneStatus
+
+                # If there's no due date, let the scheduler set it.
+                if self.isCfg('finish'):
+                    ts = msDueDate
+                    if ts:
+                        # The scheduled start and finish, from the database
+                        milestoneTicket['_sched_start'] = ts
+                        milestoneTicket['_sched_finish'] = ts
+
+                        milestoneTicket[self.fields['finish']] = \
+                            format_date(ts, self.dbDateFormat)
                     else:
-                        milestoneTicket['status'] = self.incompleteMilestoneStatus
-
-                    # If there's no due date, let the scheduler set it.
-                    if self.isCfg('finish'):
-                        ts = msDueDate
-                        if ts:
-                            # The scheduled start and finish, from the database
-                            milestoneTicket['_sched_start'] = ts
-                            milestoneTicket['_sched_finish'] = ts
-
-                            milestoneTicket[self.fields['finish']] = \
-                                format_date(ts, self.dbDateFormat)
-                        else:
-                            milestoneTicket[self.fields['finish']] = ''
-
-                        # jsGantt ignores start for a milestone but we use it
-                        # for scheduling.
-                        if self.isCfg('start'):
-                            milestoneTicket[self.fields['start']] = \
-                                  milestoneTicket[self.fields['finish']]
-                    elif self.isCfg('start'):
-                        milestoneTicket[self.fields['start']] = ''
-
-                    # Any ticket with this as a milestone and no
-                    # successors has the milestone as a successor
-                    if self.isCfg(['pred', 'succ']):
-                        pred = []
-                        for t in tickets:
-                            if t['milestone'] == msName and \
-                                    self.successors(t) == []:
-                                if self.isField('succ'):
-                                    t[self.fields[self.sources['succ']]] = \
-                                        [ tid ]
-                                else:
-                                    t['succ'] = [ tid ]
-                                pred.append(t['id'])
-                        if self.isField('pred'):
-                            milestoneTicket[self.fields[self.sources['pred']]] = \
-                                pred
-                        else:
-                            milestoneTicket['pred'] = pred
+                        milestoneTicket[self.fields['finish']] = ''
+
+                    # jsGantt ignores start for a milestone but we use it
+                    # for scheduling.
+                    if self.isCfg('start'):
+                        milestoneTicket[self.fields['start']] = \
+                              milestoneTicket[self.fields['finish']]
+                elif self.isCfg('start'):
+                    milestoneTicket[self.fields['start']] = ''
+
+                # Any ticket with this as a milestone and no
+                # successors has the milestone as a successor
+                if self.isCfg(['pred', 'succ']):
+                    pred = []
+                    for t in ticketsByMilestone.get(msName, []):
+                        if self.successors(t) == []:
+                            if self.isField('succ'):
+                                t[self.fields[self.sources['succ']]] = \
+                                    [ tid ]
+                            else:
+                                t['succ'] = [ tid ]
+                            pred.append(t['id'])
+                    if self.isField('pred'):
+                        milestoneTicket[self.fields[self.sources['pred']]] = \
+                            pred
+                    else:
+                        milestoneTicket['pred'] = pred
 
-                    # A Trac milestone has no successors
-                    if self.isField('succ'):
-                        milestoneTicket[self.fields[self.sources['succ']]] = []
-                    elif self.isRelation('succ'):
-                        milestoneTicket['succ'] = []
+                # A Trac milestone has no successors
+                if self.isField('succ'):
+                    milestoneTicket[self.fields[self.sources['succ']]] = []
+                elif self.isRelation('succ'):
+                    milestoneTicket['succ'] = []
 
-                    tickets.append(milestoneTicket)
+                tickets.append(milestoneTicket)
 
     # Get ticket dates from the database.
     #
@@ -984,24 +1565,16 @@ class TracPM(Component):
                     ticketsByID[tid]['_actual_finish'] = closedTime
 
 
-    # Process the tickets to normalize formats, etc. to simplify
-    # access functions.
-    #
-    # Also queries PM values that come from external relations.
-    #
-    # A 'children' field is added to each ticket.  If a 'parent' field
-    # is configured for PM, then 'children' is the (possibly empty)
-    # list of children.  if there is no 'parent' field, then
-    # 'children' is set to None.
-    #
-    # Schedule information comes from the TracPM private table schedule.
-    #
-    # Any "dangling references" are cleaned up.  That is, if A is a
-    # parent of B but A is not in tickets then the returned set shows
-    # B with no parent.  Similarly for predecessors and successors.
+    # Normalize PM fields and fill in relations for postQuery() and
+    # iterQuery().
     #
-    # Milestones for the tickets are added as pseudo-tickets.
-    def postQuery(self, options, tickets):
+    # @param tickets list of tickets to process
+    # @param known set of integer IDs of all the tickets in the
+    #   result.  Links to tickets not in known are dropped.  Defaults
+    #   to the IDs of tickets.  iterQuery() processes a batch of
+    #   tickets at a time and passes the IDs of the whole result here
+    #   so links between batches are kept.
+    def _normalizeTickets(self, tickets, known=None):
         # Handle custom fields.
 
         # Clean up custom fields which might be null ('--') vs. blank ('')
@@ -1022,6 +1595,8 @@ class TracPM(Component):
 
         # Get all the IDs we care about
         ids = [t['id'] for t in tickets]
+        if known is None:
+            known = set(ids)
 
         # Normalize parent field values.  All parent values must be
         # done before building child lists, below.
@@ -1039,7 +1614,7 @@ class TracPM(Component):
                     t[fieldName] = []
                 # If the parent isn't in the list we're processing,
                 # pretend there is no parent.
-                elif int(t[fieldName]) not in ids:
+                elif int(t[fieldName]) not in known:
                     t[fieldName] = []
                 # Otherwise, convert the string to an integer and put
                 # it in a list.
@@ -1060,17 +1635,40 @@ class TracPM(Component):
                 else:
                     t[fieldName] = [ int(t[fieldName]) ]
 
-        # Build child lists
+        # Build child lists (Children from a relation are filled in
+        # with the other relations, below.)
         for t in tickets:
-            if not self.isCfg('parent'):
+            if not self.isCfg('parent') or self.isField('parent'):
                 t['children'] = []
-            # NOTE: This can't build dangling references becuase it is
-            # built from the parent field which is set to None, above,
-            # if the parent isn't in the set we're processing.
-            elif self.isField('parent'):
-                fieldName = self.fields[self.sources['parent']]
-                t['children'] = [c['id'] for c in tickets \
-                                     if t['id'] in c[fieldName]]
+
+        # NOTE: This can't build dangling references becuase it is
+        # built from the parent field which is set to None, above,
+        # if the parent isn't in the set we're processing.
+        if self.isField('parent'):
+            fieldName = self.fields[self.sources['parent']]
+            ticketsByID = {}
+            for t in tickets:
+                ticketsByID[t['id']] = t
+            for c in tickets:
+                for pid in c[fieldName]:
+                    if pid in ticketsByID:
+                        ticketsByID[pid]['children'].append(c['id'])
+
+            # Children outside this batch have to come from the
+            # database.
+            if len(known) != len(ticketsByID):
+                with self.env.db_query as db:
+                    cursor = db.cursor()
+                    node_list = [self.parent_format % tid for tid in ids]
+                    inClause = "IN (%s)" % ','.join(('%s',) * len(node_list))
+                    cursor.execute("SELECT ticket, value FROM ticket_custom "
+                                   "WHERE name=%s AND value " + inClause +
+                                   " ORDER BY ticket",
+                                   [fieldName] + node_list)
+                    for cid, value in cursor:
+                        pid = int(value.lstrip('#'))
+                        if cid in known and cid not in ticketsByID:
+                            ticketsByID[pid]['children'].append(cid)
 
         # Clean up successor, predecessor lists
         for t in tickets:
@@ -1087,7 +1685,7 @@ class TracPM(Component):
                                  for s in t[fieldName].split(',')]
                         # Prune the list to tickets we care about
                         t[fieldName] = [tid for tid in t[fieldName] \
-                                            if tid in ids]
+                                            if tid in known]
 
         # Fill in relations
         with self.env.db_query as db:
@@ -1103,9 +1701,16 @@ class TracPM(Component):
                 # Use AND, not OR, here so we only get links between the
                 # tickets were care about and don't create dangling
                 # references.
+                #
+                # When processing a batch, links to other batches have
+                # to be kept so we use OR and prune with known, below.
+                if len(known) == len(ids):
+                    op = " AND "
+                else:
+                    op = " OR "
                 cursor.execute("SELECT %s, %s FROM %s " % (src, dst, tbl) + \
                                    "WHERE %s " % src + inClause + \
-                                   " AND %s " % dst + inClause,
+                                   op + "%s " % dst + inClause,
                                ids + ids)
 
                 # ... quickly build a local cache of the forward and
@@ -1116,6 +1721,8 @@ class TracPM(Component):
                 for row in cursor:
                     # FIXME - this masks src, dst field names above.
                     (src, dst) = row
+                    if src not in known or dst not in known:
+                        continue
 
                     if dst in fwd:
                         fwd[dst].append(src)
@@ -1138,24 +1745,252 @@ class TracPM(Component):
                     else:
                         t[f2] = []
 
+    # Process the tickets to normalize formats, etc. to simplify
+    # access functions.
+    #
+    # Also queries PM values that come from external relations.
+    #
+    # A 'children' field is added to each ticket.  If a 'parent' field
+    # is configured for PM, then 'children' is the (possibly empty)
+    # list of children.  if there is no 'parent' field, then
+    # 'children' is set to None.
+    #
+    # Schedule information comes from the TracPM private table schedule.
+    #
+    # Any "dangling references" are cleaned up.  That is, if A is a
+    # parent of B but A is not in tickets then the returned set shows
+    # B with no parent.  Similarly for predecessors and successors.
+    #
+    # Milestones for the tickets are added as pseudo-tickets.
+    def postQuery(self, options, tickets, req=None):
+        # Normalize fields and fill in relations
+        self._normalizeTickets(tickets)
+
         # Get precomputed schedule, close dates, etc.
         self.getTicketDates(tickets)
 
         # Add pseudo-tickets for Trac milestones
-        self._add_milestones(options, tickets)
+        self._add_milestones(options, tickets, req)
 
-    # Something like ticket.query.Query() with a slightly different
-    # interface.
+    # Maximum number of ticket IDs in one "IN (...)" clause.  Keeps
+    # statements under SQLite's default limit on host parameters.
+    inClauseSize = 500
+
+    # Load tickets directly from the ticket and ticket_custom tables.
+    #
+    # Unlike query(), this doesn't go through trac.ticket.query.Query.
+    # Only the columns PM needs (see queryFields()) and those the
+    # caller asks for are selected, custom fields are pivoted from
+    # ticket_custom in Python, and tickets are selected by ID without
+    # building (and then parsing) a query string.
     #
-    # @param options hash of query options (e.g., id, milestone, owner)
     # @param fields set of names of fields that the caller needs
-    #     (e.g., 'status')
-    # @param ticket ticket to use for "root=this", "goal=this".
+    # @param ids iterable of ticket IDs (integers or strings) to load or
+    #   None to select tickets by constraints alone
+    # @param constraints hash of field name to list of values.  A
+    #   ticket matches if, for each field, it has one of the values.
     #
-    # @return a list of ticket results, each item is a hash of ticket
-    #   fields including those named in fields and those required for PM
+    # @return a list of ticket hashes like those from Query.execute(),
+    #   ordered by ticket ID.  No post-processing (see postQuery()) is
+    #   done.
+    def loadTickets(self, fields, ids=None, constraints=None):
+        ticketFields = TicketSystem(self.env).get_ticket_fields()
+        standard = dict([(f['name'], f) for f in ticketFields
+                         if not f.get('custom')])
+        custom = dict([(f['name'], f) for f in ticketFields
+                       if f.get('custom')])
+
+        # Unknown fields are ignored, as Query does.
+        wanted = self.queryFields() | set(fields)
+        columns = ['id'] + sorted([f for f in wanted if f in standard])
+        customNames = sorted([f for f in wanted if f in custom])
+
+        if ids is not None:
+            ids = sorted(set([int(tid) for tid in ids]))
+            if len(ids) == 0:
+                return []
+            chunks = [ids[i:i + self.inClauseSize]
+                      for i in range(0, len(ids), self.inClauseSize)]
+        else:
+            chunks = [None]
+
+        tickets = []
+        with self.env.db_query as db:
+            cursor = db.cursor()
+
+            # Build the WHERE clause for the constraints once.
+            where, whereArgs = self._constraintClauses(db, constraints)
+
+            for chunk in chunks:
+                clauses = list(where)
+                args = []
+                if chunk is not None:
+                    clauses.append('t.id IN (%s)' %
+                                   ','.join(('%s',) * len(chunk)))
+                    args += chunk
+                args += whereArgs
+
+                sql = 'SELECT %s FROM ticket AS t' % \
+                    ','.join(['t.%s' % db.quote(c) for c in columns])
+                if clauses:
+                    sql += ' WHERE ' + ' AND '.join(clauses)
+                sql += ' ORDER BY t.id'
+                cursor.execute(sql, args)
+
+                # Convert values the way Query.execute() does.
+                byID = {}
+                for row in cursor:
+                    t = {}
+                    for name, val in zip(columns, row):
+                        if name == 'id':
+                            val = int(val)
+                        elif name == 'reporter':
+                            val = val or 'anonymous'
+                        elif standard[name]['type'] == 'time':
+                            val = from_utimestamp(val)
+                        elif val is None:
+                            val = ''
+                        t[name] = val
+                    for name in customNames:
+                        if custom[name]['type'] == 'checkbox':
+                            t[name] = False
+                        else:
+                            t[name] = ''
+                    byID[t['id']] = t
+                    tickets.append(t)
+
+                if len(byID) == 0 or len(customNames) == 0:
+                    continue
+
+                # Pivot the custom fields for the tickets just loaded.
+                tids = byID.keys()
+                cursor.execute('SELECT ticket, name, value'
+                               ' FROM ticket_custom'
+                               ' WHERE ticket IN (%s) AND name IN (%s)' %
+                               (','.join(('%s',) * len(tids)),
+                                ','.join(('%s',) * len(customNames))),
+                               tids + customNames)
+                for tid, name, val in cursor:
+                    if custom[name]['type'] == 'checkbox':
+                        val = as_bool(val)
+                    elif val is None:
+                        val = ''
+                    byID[tid][name] = val
+
+        return tickets
+
+    # Build SQL conditions on the ticket table (as "t") for
+    # constraints as passed to loadTickets().
     #
-    def query(self, options, fields, req=None):
+    # @return a tuple of a list of conditions and a list of arguments
+    #   for them
+    def _constraintClauses(self, db, constraints):
+        ticketFields = TicketSystem(self.env).get_ticket_fields()
+        custom = set([f['name'] for f in ticketFields if f.get('custom')])
+        standard = set([f['name'] for f in ticketFields
+                        if not f.get('custom')])
+
+        where = []
+        args = []
+        for field in sorted((constraints or {}).keys()):
+            values = [unicode(v) for v in constraints[field]]
+            inClause = "IN (%s)" % ','.join(('%s',) * len(values))
+            if field in standard or field == 'id':
+                where.append('t.%s %s' % (db.quote(field), inClause))
+            elif field in custom:
+                where.append('t.id IN (SELECT ticket FROM ticket_custom'
+                             ' WHERE name=%%s AND value %s)' % inClause)
+                args.append(field)
+            else:
+                raise TracError('Cannot select tickets by %s; '
+                                'it is not a ticket field.' % field)
+            args += values
+
+        return where, args
+
+    # Like loadTickets() but return only the IDs of matching tickets
+    #
+    # @return a sorted list of integer ticket IDs
+    def _loadTicketIDs(self, ids=None, constraints=None):
+        if ids is not None:
+            ids = sorted(set([int(tid) for tid in ids]))
+            chunks = [ids[i:i + self.inClauseSize]
+                      for i in range(0, len(ids), self.inClauseSize)]
+        else:
+            chunks = [None]
+
+        found = []
+        with self.env.db_query as db:
+            cursor = db.cursor()
+            where, whereArgs = self._constraintClauses(db, constraints)
+            for chunk in chunks:
+                clauses = list(where)
+                args = []
+                if chunk is not None:
+                    clauses.append('t.id IN (%s)' %
+                                   ','.join(('%s',) * len(chunk)))
+                    args += chunk
+                args += whereArgs
+
+                sql = 'SELECT t.id FROM ticket AS t'
+                if clauses:
+                    sql += ' WHERE ' + ' AND '.join(clauses)
+                sql += ' ORDER BY t.id'
+                cursor.execute(sql, args)
+                found += [row[0] for row in cursor]
+
+        return found
+
+    # Query arguments (other than field constraints) that
+    # loadTickets() can handle.
+    _loaderArgs = [ 'max', 'col' ]
+
+    # Convert query arguments to constraints for loadTickets().
+    #
+    # @param query_args hash of query arguments as built in query()
+    #
+    # @return a hash of field name to a list of values or None if
+    #   query_args needs Trac's Query (e.g., a "!=" or "~=" filter,
+    #   $USER, a date range, ordering or grouping).
+    def _simpleConstraints(self, query_args):
+        ticketFields = TicketSystem(self.env).get_ticket_fields()
+        # Query takes values of time fields (e.g., changetime) as date
+        # ranges, not values to match.
+        names = set([f['name'] for f in ticketFields
+                     if f['type'] != 'time'])
+
+        constraints = {}
+        for key in query_args:
+            if key in self._loaderArgs:
+                continue
+            # Query syntax puts modes like "!" at the end of the key
+            # (e.g., "status!=closed").
+            if key != 'id' and key not in names:
+                return None
+            values = unicode(query_args[key]).split('|')
+            for v in values:
+                # Modes like "~", "^", "$" and "!" start the value.
+                # An empty value matches a missing custom field.
+                if v == '' or v[0] in '!~^$':
+                    return None
+                # Query also allows ID ranges (e.g., "1-5,7").
+                if key == 'id' and not v.isdigit():
+                    return None
+            constraints[key] = values
+
+        return constraints
+
+    # Find the tickets matching options.  Shared by query() and
+    # iterQuery().
+    #
+    # @param options hash of query options as for query()
+    # @param fields set of names of fields that the caller needs
+    # @param req request to use for "root=self", "goal=self".
+    # @param idsOnly True to get only a list of integer ticket IDs
+    #
+    # @return a list of ticket hashes, without PM post-processing, or
+    #   a list of ticket IDs if idsOnly is True
+    def _selectTickets(self, options, fields, req=None, idsOnly=False):
         query_args = {}
         # Copy query args from caller (e.g., q_a['owner'] = 'monty|phred')
         for key in options.keys():
@@ -1169,35 +2004,114 @@ class TracPM(Component):
         # Expand (or set) list of IDs to include those specified by PM
         # query meta-options (e.g., root)
         pm_ids = self.preQuery(options, req)
-        if len(pm_ids) != 0:
-            if 'id' in query_args:
-                query_args['id'] += '|' + '|'.join(pm_ids)
+
+        # Tickets selected only by ID and plain field values don't
+        # need Trac's general query machinery.  Load them directly.
+        constraints = self._simpleConstraints(query_args)
+        if constraints is not None:
+            ids = constraints.pop('id', None)
+            if len(pm_ids) != 0:
+                ids = set(ids or []) | pm_ids
+
+            if idsOnly:
+                tickets = self._loadTicketIDs(ids, constraints)
+            else:
+                tickets = self.loadTickets(fields, ids, constraints)
+
+            # Query cuts its results at max (0 means no limit) in its
+            # own order (by priority), not by ID.  If there are more
+            # tickets than that, let Query choose which to return.
+            limit = int(query_args.get('max', 0))
+            if limit and len(tickets) > limit:
+                constraints = None
+
+        if constraints is None:
+            if len(pm_ids) != 0:
+                if 'id' in query_args:
+                    query_args['id'] += '|' + '|'.join(pm_ids)
+                else:
+                    query_args['id'] = '|'.join(pm_ids)
+
+            # Default to getting all tickets
+            if 'max' not in query_args:
+                query_args['max'] = 0
+
+            # Tell the query what columns to return
+            if idsOnly:
+                query_args['col'] = 'id'
             else:
-                query_args['id'] = '|'.join(pm_ids)
+                query_args['col'] = "|".join(self.queryFields() | fields)
 
-        # Default to getting all tickets
-        if 'max' not in query_args:
-            query_args['max'] = 0
+            # Construct the querystring.
+            query_string = '&'.join(['%s=%s' %
+                                     (str(f), unicode(v)) for (f, v) in
+                                     query_args.iteritems()])
 
-        # Tell the query what columns to return
-        query_args['col'] = "|".join(self.queryFields() | fields)
+            # Get the Query object.
+            query = Query.from_string(self.env, query_string)
 
-        # Construct the querystring.
-        query_string = '&'.join(['%s=%s' %
-                                 (str(f), unicode(v)) for (f, v) in
-                                 query_args.iteritems()])
+            # Get all tickets
+            tickets = query.execute(req)
+            if idsOnly:
+                tickets = [t['id'] for t in tickets]
 
-        # Get the Query object.
-        query = Query.from_string(self.env, query_string)
+        return tickets
 
-        # Get all tickets
-        tickets = query.execute(req)
+    # Something like ticket.query.Query() with a slightly different
+    # interface.
+    #
+    # @param options hash of query options (e.g., id, milestone, owner)
+    # @param fields set of names of fields that the caller needs
+    #     (e.g., 'status')
+    # @param ticket ticket to use for "root=this", "goal=this".
+    #
+    # @return a list of ticket results, each item is a hash of ticket
+    #   fields including those named in fields and those required for PM
+    #
+    def query(self, options, fields, req=None):
+        # Nested queries reuse the outermost connection so the whole
+        # pipeline (preQuery(), Query.execute(), postQuery(), etc.)
+        # runs on this one.
+        with self.env.db_query:
+            tickets = self._selectTickets(options, fields, req)
 
-        # Post process to add more PM stuff
-        self.postQuery(options, tickets)
+            # Post process to add more PM stuff
+            self.postQuery(options, tickets, req)
 
         return tickets
 
+    # Like query() but a generator yielding one ticket at a time.
+    #
+    # Only the matching ticket IDs are held for the whole query.
+    # Tickets are loaded and normalized (as postQuery() does,
+    # including relations and dates from the database) batchSize at a
+    # time so memory use is bounded when walking every ticket in a
+    # large environment (e.g., for reports or exports).  Links to
+    # tickets in other batches are kept.
+    #
+    # Unlike query(), no milestone pseudo-tickets are added.  There is
+    # no schedule to compute without the whole set of tickets.
+    #
+    # @param options hash of query options as for query()
+    # @param fields set of names of fields that the caller needs
+    # @param req request to use for "root=self", "goal=self".
+    # @param batchSize number of tickets to load at a time
+    #
+    # @return a generator of ticket hashes
+    def iterQuery(self, options, fields, req=None, batchSize=500):
+        ids = self._selectTickets(options, fields, req, idsOnly=True)
+        known = set(ids)
+
+        for i in range(0, len(ids), batchSize):
+            # Use one connection per batch but don't hold it while the
+            # caller processes the batch.
+            with self.env.db_query:
+                tickets = self.loadTickets(fields, ids[i:i + batchSize])
+                self._normalizeTickets(tickets, known)
+                self.getTicketDates(tickets)
+            for t in tickets:
+                yield t
+
     # tickets is an unordered list of tickets as returned by TracPM.query().
     #
     # TracPM.query() preloads schedule data from the database, if present.
@@ -1274,38 +2188,43 @@ class TracPM(Component):
     # successors.  Then because of the children's dependence on each
     # other, the parent dependencies affect all the children in the
     # sequence.
-
-    # FIXME - I don't like this name.  It really just propagates
-    # dependencies but that's the name of the private helper defined
-    # inside this function.  What can I call the helper?
     def augmentTickets(self, ticketsByID):
-        # Indexed by ticket ID, lists ticket's descendants
-        desc = {}
-        # Build descendant look up recursively.
-        def buildDesc(tid):
-            # A ticket is in its own "family" tree.
-            desc[tid] = [ tid ]
-            # For each child, add its subtree.
-            for cid in self.children(ticketsByID[tid]):
-                desc[tid] += buildDesc(cid)
-            return desc[tid]
-
-        # Propagate dependencies from parent to descendants (first
-        # children, then recurse).
-        #
-        def propagateDependencies(pid):
+        # Number the parent/child forest in pre-order.  Each ticket
+        # gets the number it was reached at (enter) and the highest
+        # number in its subtree (leave).  A ticket is a descendant of
+        # another (or the ticket itself) if its number is in the
+        # other's range.
+        enter = {}
+        leave = {}
+        order = []
+        for rid in self.roots(ticketsByID):
+            stack = [ (rid, False) ]
+            while stack:
+                tid, done = stack.pop()
+                if done:
+                    leave[tid] = len(order) - 1
+                elif tid not in enter:
+                    enter[tid] = len(order)
+                    order.append(tid)
+                    stack.append((tid, True))
+                    # Push in reverse so children are numbered in order
+                    for cid in reversed(self.children(ticketsByID[tid])):
+                        # If the child is in the list we're working on
+                        if cid in ticketsByID:
+                            stack.append((cid, False))
+
+        def isDescendant(did, pid):
+            return did in enter and enter[pid] <= enter[did] <= leave[pid]
+
+        # Propagate dependencies from parent to children.  Parents
+        # come before their descendants in order so what a child gets
+        # from its parent is passed on to its own children in turn.
+        for pid in order:
             parent = ticketsByID[pid]
-            # Process predecessors and successors
-            for fieldFunc in [ self.predecessors,
-                               self.successors ]:
-                # Set functions to add dependency and its reverse
-                # between two tickets.
-                fwd = fieldFunc
-                if fwd == self.predecessors:
-                    rev = self.successors
-                else:
-                    rev = self.predecessors
-
+            # Process predecessors and successors, with functions to
+            # add dependency and its reverse between two tickets.
+            for fwd, rev in [ (self.predecessors, self.successors),
+                              (self.successors, self.predecessors) ]:
                 # For each child, if any
                 for cid in self.children(parent):
                     # If the child is in the list we're
@@ -1314,8 +2233,8 @@ class TracPM(Component):
                         # Does child depend on any "cousins"
                         # (other descendants)?
                         child = ticketsByID[cid]
-                        cousins = [did for did in fieldFunc(child) \
-                                       if did in desc[pid]]
+                        cousins = [did for did in fwd(child) \
+                                       if isDescendant(did, pid)]
                         # If not, this is the end of the
                         # line and we have to copy the
                         # parent's dependencies down.
@@ -1326,31 +2245,12 @@ class TracPM(Component):
                                 # working on
                                 if tid in ticketsByID:
                                     # And not already linked
-                                    if tid not in fwd(ticketsByID[cid]):
+                                    if tid not in fwd(child):
                                         # Add parent's dependency to this
                                         # child
-                                        fwd(ticketsByID[cid]).append(tid)
+                                        fwd(child).append(tid)
                                         rev(ticketsByID[tid]).append(cid)
 
-                        # Recurse to lower-level descendants
-                        propagateDependencies(cid)
-
-
-        roots = self.roots(ticketsByID)
-        if self.isCfg('parent'):
-            # Build the descendant tree for each root (and its descendants)
-            for tid in roots:
-                buildDesc(tid)
-
-        # For each ticket
-        for tid in ticketsByID:
-            ticket = ticketsByID[tid]
-            # If it is the root of a tree
-            if tid in roots:
-                # Propagate depedencies down to its children
-                # (which recurses to update other descendants)
-                propagateDependencies(tid)
-
 # ========================================================================
 # Really simple calendar
 #
@@ -1377,16 +2277,7 @@ class BaseSorter:
     # When sorting on an enum like priority or severity, we need to
     # sort on 1, 2, 3, not 'critical', 'blocker', 'major', etc.
     def _buildEnumMap(self, field):
-        classMap = {}
-        with self.env.db_query as db:
-            cursor = db.cursor()
-            cursor.execute("SELECT name," +
-                           db.cast('value', 'int') +
-                           " FROM enum WHERE type=%s", (field,))
-            for name, value in cursor:
-                classMap[name] = value
-
-        return classMap
+        return TracPM(self.env).enumMap(field)
 
     # Priorities are continuous, 0..n, so half the length is average
     # value Search for the priority string that has that value.
@@ -1422,12 +2313,12 @@ class SimpleSorter(BaseSorter, Component):
 
     prioMap = None
 
-    def __init__(self):
-        self.prioMap = self._buildEnumMap('priority')
-
     # Make sure all tickets hav a valid priority that we can map to
     # sortable integer.
     def prepareTasks(self, ticketsByID):
+        # Priorities may have changed since the last sort.
+        self.prioMap = self._buildEnumMap('priority')
+
         # Use average priority for tickets with bad priority
         avgPriority = self.averageEnum(self.prioMap)
 
@@ -1455,7 +2346,6 @@ class ProjectSorter(BaseSorter, Component):
     prioMap = None
 
     def __init__(self):
-        self.prioMap = self._buildEnumMap('priority')
         # FIXME - would I be better off having the PM pass itself in
         # when creating the sorter?
         self.pm = TracPM(self.env)
@@ -1464,6 +2354,9 @@ class ProjectSorter(BaseSorter, Component):
     # sortable integer and compute effective priority of children
     # based on parent priority.
     def prepareTasks(self, ticketsByID):
+        # Priorities may have changed since the last sort.
+        self.prioMap = self._buildEnumMap('priority')
+
         # Make sure every ticket has a valid priority.
 
         # Use average priority for tickets with bad priority
@@ -1611,6 +2504,11 @@ class ResourceScheduler(Component):
 
                 # Get total hours available for resource on that date
                 available = self.calendar.hoursAvailable(f, ticket['owner'])
+                # What-if scheduling may make resources unavailable
+                # (see TracPM.simulate())
+                if f.date() in options.get('unavailable', {}) \
+                        .get(ticket['owner'], ()):
+                    available = 0
 
                 # Clip available based on time of day on target date
                 # (hours before a finish or after a start)
@@ -1748,14 +2646,14 @@ class ResourceScheduler(Component):
 
                 # Use actual dates, if requested.
                 if t.get('_actual_' + fromField) and options.get('useActuals'):
-                    taskFrom = [ to_datetime(t['_actual_' + fromField]),
+                    taskFrom = [ self.pm.ticketDate(t, '_actual_' + fromField),
                                  SF_ACTUAL ]
                     self._logSch('Using actual %s:%s' %
                                  (fromField, taskFrom[0]))
                 # If there is a precomputed date in the database,
                 # use it unless we're forcing a schedule calculation.
                 elif t.get('_sched_' + fromField) and not options.get('force'):
-                    taskFrom = [ to_datetime(t['_sched_' + fromField]),
+                    taskFrom = [ self.pm.ticketDate(t, '_sched_' + fromField),
                                  SF_SCHEDULE ]
                     self._logSch('Using db %s: %s' % (fromField, taskFrom[0]))
                 # If there is a user-supplied date set, use it
@@ -1834,13 +2732,14 @@ class ResourceScheduler(Component):
             if t.get('_calc_' + toField) == None:
                 # Use actual dates, if requested.
                 if t.get('_actual_' + toField) and options.get('useActuals'):
-                    taskTo = [ to_datetime(t['_actual_' + toField]), SF_ACTUAL ]
+                    taskTo = [ self.pm.ticketDate(t, '_actual_' + toField),
+                               SF_ACTUAL ]
                     self._logSch('Using actual %s: %s' %
                                  (toField, taskTo[0]))
                 # If there is a precomputed date in the database,
                 # use it unless we're forcing a schedule calculation.
                 elif t.get('_sched_' + toField) and not options.get('force'):
-                    taskTo = [ to_datetime(t['_sched_' + toField]),
+                    taskTo = [ self.pm.ticketDate(t, '_sched_' + toField),
                                SF_SCHEDULE ]
                     self._logSch('Using db %s: %s' % (toField, taskTo[0]))
                 # If there is a user-supplied date set, use it
@@ -2215,45 +3114,437 @@ class ResourceScheduler(Component):
             # Don't schedule.  But some milestones may not have due dates.
             # Set them from the latest ticket in the milestone.
 
-            # Get IDs of milestone pseudotickets.
-            milestoneIDs = [tid for tid in ticketsByID.keys() \
-                              if self.pm.isTracMilestone(ticketsByID[tid]) \
-                                and not self.pm.finish(ticketsByID[tid])]
-
-            # Get IDs of all other tickets.
-            ticketIDs = [tid for tid in ticketsByID.keys() \
-                             if tid not in milestoneIDs]
-
-            # Process each milestone, setting the start and finish
-            # from the latest ticket in the milestone.
-            for mid in milestoneIDs:
-                ms = ticketsByID[mid]
-                # Find the latest ticket in the milestone
-                msDue = None
-                for tid in ticketIDs:
-                    t = ticketsByID[tid]
-                    if t['milestone'] == ms['milestone'] \
-                            and (not msDue or msDue < self.pm.finish(t)):
-                        msDue = self.pm.finish(t)
-
-                # A milestone has no duration (start == finish)
-                ms['_calc_start'] = [msDue, True]
-                ms['_calc_finish'] = [msDue, True]
+            # Find the latest finish of the tickets in each milestone
+            # in one pass over the tickets.
+            msDue = {}
+            for t in ticketsByID.values():
+                if self.pm.isTracMilestone(t):
+                    continue
+                finish = self.pm.finish(t)
+                if not msDue.get(t['milestone']) \
+                        or msDue[t['milestone']] < finish:
+                    msDue[t['milestone']] = finish
+
+            # Set the start and finish of milestones without a due
+            # date from the latest ticket in the milestone.
+            for ms in ticketsByID.values():
+                if self.pm.isTracMilestone(ms) and not self.pm.finish(ms):
+                    due = msDue.get(ms['milestone'])
+
+                    # A milestone has no duration (start == finish)
+                    ms['_calc_start'] = [due, True]
+                    ms['_calc_finish'] = [due, True]
 
-# FIXME - need to react to milestone changes, too (for dates).  0.11.6
-# doesn't have a milestone change listener.  I belive a later version
-# does.
-class TicketRescheduler(Component):
-    implements(ITicketChangeListener)
+# ========================================================================
+# Background thread for TicketRescheduler.
+#
+# Ticket changes are queued with notify().  The worker waits until no
+# change has been queued for debounce seconds (or until the oldest
+# queued change has waited maxDelayFactor times that) and then
+# reschedules once for everything in the queue.
+class RescheduleWorker(threading.Thread):
+    # Longest a reschedule is put off while changes keep coming, as a
+    # multiple of the debounce window.
+    maxDelayFactor = 10
+
+    def __init__(self, rescheduler, debounce):
+        threading.Thread.__init__(self, name='TracPM rescheduler')
+        self.daemon = True
+
+        self.rescheduler = rescheduler
+        self.debounce = debounce
+
+        self.lock = threading.Condition()
+        # Queued changes, old values indexed by ticket ID string
+        self.pending = {}
+        # When the first and last queued changes arrived
+        self.firstQueued = None
+        self.lastQueued = None
+
+        self.running = False
+        # When the last reschedule finished, how long it took, and
+        # how many changed tickets it covered
+        self.lastRun = None
+        self.lastRunDuration = None
+        self.lastRunCount = 0
+
+    # Queue changes for the next reschedule.
+    #
+    # @param changes old values indexed by ticket ID string
+    def notify(self, changes):
+        with self.lock:
+            self.rescheduler.mergeChanges(self.pending, changes)
+            now = time.time()
+            if self.firstQueued is None:
+                self.firstQueued = now
+            self.lastQueued = now
+            self.lock.notify()
+
+    # Return the number of changed tickets waiting to be rescheduled.
+    def queueDepth(self):
+        with self.lock:
+            return len(self.pending)
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.lock.wait()
+
+                # Wait for the burst of changes to end.
+                while True:
+                    deadline = min(self.lastQueued + self.debounce,
+                                   self.firstQueued +
+                                       self.debounce * self.maxDelayFactor)
+                    now = time.time()
+                    if now >= deadline:
+                        break
+                    self.lock.wait(deadline - now)
+
+                changes = self.pending
+                self.pending = {}
+                self.firstQueued = None
+                self.lastQueued = None
+                self.running = True
+
+            start = time.time()
+            try:
+                self.rescheduler.rescheduleChanges(changes)
+            except Exception, e:
+                self.rescheduler.env.log.exception(
+                    'Background reschedule of %d tickets failed: %s' %
+                    (len(changes), e))
+            finally:
+                with self.lock:
+                    self.running = False
+                    self.lastRun = time.time()
+                    self.lastRunDuration = self.lastRun - start
+                    self.lastRunCount = len(changes)
 
-    pm = None
-    scheduleFields = None
-    options = {}
 
-    def __init__(self):
-        self.pm = TracPM(self.env)
+# ========================================================================
+# Thread that keeps the reschedule lock from going stale while a long
+# reschedule holds it.
+#
+# Every third of the lock timeout the time in the lock is brought up
+# to date.  stop() ends the thread and returns the lock's value then.
+class LockRefresher(threading.Thread):
+    def __init__(self, rescheduler, lock):
+        threading.Thread.__init__(self, name='TracPM reschedule lock')
+        self.daemon = True
+
+        self.rescheduler = rescheduler
+        self.lock = lock
+        self.stopped = threading.Event()
+
+    def run(self):
+        interval = self.rescheduler.lockTimeout / 3
+        while not self.stopped.wait(interval):
+            try:
+                self.lock = self.rescheduler._refreshLock(self.lock)
+            except Exception, e:
+                self.rescheduler.env.log.exception(
+                    'Refreshing reschedule lock failed: %s' % e)
 
-        self.scheduleFields = []
+    # Stop refreshing the lock.
+    #
+    # @return the current lock value
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.lock
+
+
+# ========================================================================
+# Worker processes for TicketRescheduler._recomputeParallel().
+
+# The environment each worker process schedules in.  Not the cached
+# one: after a fork that shares the parent's database connections.
+_workerEnv = None
+
+def _initRescheduleWorker(path):
+    global _workerEnv
+    from trac.env import open_environment
+    _workerEnv = open_environment(path, use_cache=False)
+
+# Schedule one group of tickets.
+#
+# @param args options and list of tickets as for recomputeSchedule()
+#
+# @return a list of (ID, schedule fields) for the tickets
+def _rescheduleGroup(args):
+    options, tickets = args
+    TracPM(_workerEnv).recomputeSchedule(dict(options), tickets)
+    return [(t['id'], dict([(f, t[f]) for f in ('_calc_start',
+                                                 '_calc_finish',
+                                                 '_rescheduled')
+                            if f in t]))
+            for t in tickets]
+
+# ========================================================================
+# In-memory index of ticket owners and links for TicketRescheduler.
+#
+# Holds the owner of every ticket, the open tickets of each owner and,
+# for each ticket, the tickets linked to it in either direction by the
+# configured parent, predecessor and successor sources.
+#
+# refresh() brings the index up to date with one query when nothing
+# changed.  Tickets changed since the last refresh (by this or another
+# process) are found by their change time and reloaded; if the number
+# of tickets changed, everything is reloaded.  The change listener
+# updates the owner of changed tickets right away and marks them to be
+# reloaded.
+class TicketIndex(object):
+    def __init__(self, pm):
+        self.pm = pm
+        self.env = pm.env
+        self.lock = threading.RLock()
+
+        # Ticket count and latest change time when last refreshed
+        self.stamp = None
+        # Ticket ID strings to reload on the next refresh
+        self.dirty = set()
+
+        # Owner indexed by ticket ID string
+        self.owners = {}
+        # Set of open ticket ID strings indexed by owner
+        self.openByOwner = {}
+        # Set of linked ticket ID strings indexed by ticket ID string
+        self.links = {}
+
+    # Update the owner of a changed ticket and mark it for reloading.
+    #
+    # @param tid ticket ID string
+    # @param owner owner of the ticket (None if it was deleted)
+    # @param status status of the ticket
+    def touch(self, tid, owner, status):
+        with self.lock:
+            self._removeOwner(tid)
+            if owner is not None:
+                self._addOwner(tid, owner, status)
+            self.dirty.add(tid)
+
+    # Bring the index up to date with the database.
+    def refresh(self):
+        with self.lock:
+            with self.env.db_query as db:
+                cursor = db.cursor()
+                cursor.execute('SELECT COUNT(*), MAX(changetime) FROM ticket')
+                stamp = tuple(cursor.fetchone())
+
+                if self.stamp is None or stamp[0] != self.stamp[0]:
+                    self._load(cursor, None)
+                elif stamp[1] != self.stamp[1] or self.dirty:
+                    cursor.execute('SELECT id FROM ticket' + \
+                                       ' WHERE changetime >= %s',
+                                   (self.stamp[1] or 0,))
+                    ids = set(['%s' % row[0] for row in cursor])
+                    self._load(cursor, ids | self.dirty)
+
+            self.stamp = stamp
+            self.dirty = set()
+
+    # Return the IDs of tickets linked to any in ids, directly or
+    # indirectly (including ids).
+    #
+    # @param ids set of ticket ID strings
+    #
+    # @return set of ticket ID strings
+    def reachable(self, ids):
+        explored = set(ids)
+        toExplore = list(ids)
+        while toExplore:
+            tid = toExplore.pop()
+            for lid in self.links.get(tid, ()):
+                if lid not in explored:
+                    explored.add(lid)
+                    toExplore.append(lid)
+        return explored
+
+    # Return the set of owners of tickets in ids.
+    def ownersOf(self, ids):
+        return set([self.owners[tid] for tid in ids if tid in self.owners])
+
+    # Return the set of IDs of open tickets owned by owners.
+    def openTickets(self, owners):
+        ids = set()
+        for owner in owners:
+            ids |= self.openByOwner.get(owner, set())
+        return ids
+
+    def _addOwner(self, tid, owner, status):
+        self.owners[tid] = owner
+        # Unowned tickets don't compete for anyone's time.
+        if owner and status != 'closed':
+            self.openByOwner.setdefault(owner, set()).add(tid)
+
+    def _removeOwner(self, tid):
+        owner = self.owners.pop(tid, None)
+        if owner is not None:
+            self.openByOwner.get(owner, set()).discard(tid)
+
+    def _link(self, tid1, tid2):
+        if tid1 != tid2:
+            self.links.setdefault(tid1, set()).add(tid2)
+            self.links.setdefault(tid2, set()).add(tid1)
+
+    # Load owners and links for ids (or all tickets if ids is None)
+    def _load(self, cursor, ids):
+        if ids is None:
+            self.owners = {}
+            self.openByOwner = {}
+            self.links = {}
+            chunks = [ None ]
+        else:
+            # Forget what we knew about these tickets.  Links from other
+            # tickets are read again below.
+            for tid in ids:
+                self._removeOwner(tid)
+                for lid in self.links.pop(tid, ()):
+                    self.links.get(lid, set()).discard(tid)
+            ids = list(ids)
+            size = self.pm.inClauseSize
+            chunks = [ids[i:i + size] for i in range(0, len(ids), size)]
+
+        # Sources of links: (table, source column, target column,
+        # format of target values)
+        sources = []
+        for relation in self.pm.relations.values():
+            sources.append((relation[2], relation[3], relation[4], '%s'))
+        for field in [ 'parent', 'pred', 'succ' ]:
+            if self.pm.isField(field):
+                if field == 'parent':
+                    format = self.pm.parent_format
+                else:
+                    format = '%s'
+                sources.append((self.pm.fields[self.pm.sources[field]],
+                                None, None, format))
+
+        for chunk in chunks:
+            if chunk is None:
+                where = ''
+                args = []
+            else:
+                where = ' WHERE id IN (%s)' % ','.join(('%s',) * len(chunk))
+                args = chunk
+            cursor.execute('SELECT id, owner, status FROM ticket' + where,
+                           args)
+            for tid, owner, status in cursor:
+                self._addOwner('%s' % tid, owner, status)
+
+            for table, src, dst, format in sources:
+                # Custom field: ticket is the source, value the target
+                if src is None:
+                    prefix, suffix = (format.split('%s', 1) + [''])[:2]
+                    sql = 'SELECT ticket, value FROM ticket_custom' + \
+                        ' WHERE name=%s'
+                    args = [ table ]
+                    if chunk is not None:
+                        inClause = 'IN (%s)' % ','.join(('%s',) * len(chunk))
+                        sql += ' AND (ticket ' + inClause + \
+                            ' OR value ' + inClause + ')'
+                        args += chunk + [format % tid for tid in chunk]
+                    cursor.execute(sql, args)
+                    for tid, value in cursor:
+                        # Only exact references count, as in
+                        # TracPM._followLink().
+                        if value and value.startswith(prefix) \
+                                and value.endswith(suffix):
+                            target = value[len(prefix):
+                                               len(value) - len(suffix)]
+                            if target.isdigit():
+                                self._link('%s' % tid, target)
+                # Relation table
+                else:
+                    sql = 'SELECT %s, %s FROM %s' % (src, dst, table)
+                    args = []
+                    if chunk is not None:
+                        inClause = 'IN (%s)' % ','.join(('%s',) * len(chunk))
+                        sql += ' WHERE %s %s OR %s %s' % \
+                            (src, inClause, dst, inClause)
+                        args = chunk + chunk
+                    cursor.execute(sql, args)
+                    for tid1, tid2 in cursor:
+                        self._link('%s' % tid1, '%s' % tid2)
+
+
+# FIXME - need to react to milestone changes, too (for dates).  0.11.6
+# doesn't have a milestone change listener.  I belive a later version
+# does.
+class TicketRescheduler(Component):
+    implements(ITicketChangeListener, IRequestFilter, IAdminCommandProvider)
+
+    Option('TracPM', 'reschedule_mode', 'sync',
+           """When to reschedule after tickets change: 'sync' (before
+              the request that saved the ticket returns), 'background'
+              (in a worker thread) or 'queue' (by a separate
+              "trac-admin pm worker" process)""")
+    Option('TracPM', 'reschedule_debounce', '2.0',
+           """Seconds the background rescheduler waits for more changes
+              before rescheduling""")
+    Option('TracPM', 'reschedule_queue_batch', '500',
+           """Most queued changes "trac-admin pm worker" reschedules at
+              once""")
+    Option('TracPM', 'reschedule_lock_timeout', '300',
+           """Seconds after which a reschedule that still holds the
+              reschedule lock is assumed to have died and the lock is
+              taken over""")
+    Option('TracPM', 'history_detail_days', '30',
+           """Schedule history newer than this many days is kept as is
+              by 'trac-admin pm compact-history'""")
+    Option('TracPM', 'history_bucket_hours', '24',
+           """Older schedule history is collapsed to one net change per
+              ticket for each period of this many hours""")
+    Option('TracPM', 'history_retention_days', '0',
+           """Schedule history older than this many days is removed
+              except for the first and last change to each ticket (0
+              to keep it all)""")
+
+    pm = None
+    scheduleFields = None
+    options = {}
+
+    # Valid values for reschedule_mode
+    rescheduleModes = ('sync', 'background', 'queue')
+
+    # Old values key marking a deleted ticket
+    deletedKey = '_deleted'
+
+    # Background worker, started by the first change in background mode
+    worker = None
+    workerLock = threading.Lock()
+    # Owners and links of tickets for _findAffected(), loaded on demand
+    ticketIndex = None
+
+    def __init__(self):
+        self.pm = TracPM(self.env)
+
+        # Changes deferred to the end of the current request (per
+        # thread).  None when not in a request.
+        self.deferred = threading.local()
+
+        self.rescheduleMode = self.config.get('TracPM', 'reschedule_mode')
+        if self.rescheduleMode not in self.rescheduleModes:
+            self.env.log.error('Invalid reschedule_mode "%s"; should be'
+                               ' one of %s.  Rescheduling synchronously.' %
+                               (self.rescheduleMode,
+                                ', '.join(self.rescheduleModes)))
+            self.rescheduleMode = 'sync'
+        self.debounce = float(self.config.get('TracPM',
+                                              'reschedule_debounce'))
+        self.queueBatch = int(self.config.get('TracPM',
+                                              'reschedule_queue_batch'))
+        self.lockTimeout = float(self.config.get('TracPM',
+                                                 'reschedule_lock_timeout'))
+
+        self.historyDetailDays = \
+            float(self.config.get('TracPM', 'history_detail_days'))
+        self.historyBucketHours = \
+            float(self.config.get('TracPM', 'history_bucket_hours'))
+        self.historyRetentionDays = \
+            float(self.config.get('TracPM', 'history_retention_days'))
+
+        self.scheduleFields = []
 
         # Built-in fields that can affect scheduling
         self.scheduleFields = ['owner', 'priority', 'milestone']
@@ -2325,42 +3616,13 @@ class TicketRescheduler(Component):
     #  Same owner
     #  Any successors, predecessors
     #  Any ancestors, descendants
-    # @param ticket ticket object passed to change listener
+    # @param tid ID string of the changed ticket
     # @param old_values list of old values passed to change listener
     #
     # @return a list of ticket ID strings
-    def _findAffected(self, ticket, old_values):
-        # Helper to find owners of tickets
-        # @param ids set of tickets ID strings
-        # @return set of owner strings
-        def ownersOf(ids):
-            with self.env.db_query as db:
-                inClause = "IN (%s)" % ','.join(('%s',) * len(ids))
-                cursor = db.cursor()
-                cursor.execute(("SELECT DISTINCT owner FROM ticket "
-                                "WHERE id " +
-                               inClause),
-                               list(ids))
-                owners = [row[0] for row in cursor]
-                return set(owners)
-
-        # Helper to find open tickets by owners
-        # @param owners set of owner strings from tickets
-        # @return a set of ticket ID strings for tickets owned by owners
-        def openByOwner(owners):
-            # FIXME - this may fix a bug I don't have any more.
-            if len(owners) == 0:
-                return set()
-            with self.env.db_query as db:
-                inClause = "IN (%s)" % ','.join(('%s',) * len(owners))
-                cursor = db.cursor()
-                cursor.execute(("SELECT id FROM ticket "
-                                "WHERE status!=%s AND owner " +
-                               inClause),
-                               ['closed'] + list(owners))
-                ids = ['%s' % row[0] for row in cursor]
-                return set(ids)
-
+    def _findAffected(self, tid, old_values):
+        index = self._ticketIndex()
+        index.refresh()
 
         # Find all the tickets affected by the old values.  For
         # example if processing ticket A which used to be a
@@ -2396,77 +3658,69 @@ class TicketRescheduler(Component):
             # If owner changed, get tickets by old owner.  (New owner is
             # handled by more())
             if 'owner' in old_values.keys():
-                owners = set()
-                owners.add(old_values['owner'])
-                affected |= openByOwner(owners)
+                affected |= index.openTickets(set([old_values['owner']]))
 
             return affected
 
-
-        # Used by more(), below, to optimize queries. (I'd like a
-        # better scope but Python doesn't do closures the way I
-        # expected.)
-        self.knownOwners = set()
+        # Owners whose open tickets are already included
+        knownOwners = set()
 
         # Helper to expand set of tickets by one generation
         #
-        # FIXME - passing 1 as depth to _reachable() misses some
-        # closed but reachable tickets.  In my test data, I don't get
-        # 150, a child of 149.  Other children of 149 show up.
-        #
         # @param ids set of ticket ID strings to find more tickets from
         # @return set of IDs for tickets related to ids
         def more(ids):
-            n = set(self.pm._reachable(list(ids)))
+            n = index.reachable(ids)
 
-            # Get owners for these tickets
-            newOwners = ownersOf(n)
-
-            # Remove owners we already know
-            newOwners -= self.knownOwners
+            # Get owners for these tickets we don't already know
+            newOwners = index.ownersOf(n) - knownOwners
 
             # If we don't already have all these owners, process the new ones
             if len(newOwners) != 0:
                 # Add new owners to known owners
-                self.knownOwners |= newOwners
-
-                # Get tickets for the new owners
-                x = openByOwner(newOwners)
+                knownOwners.update(newOwners)
 
-                # Remove known tickets
-                x -= ids
-
-                # Add new tickets to set
-                n |= x
+                # Add tickets for the new owners
+                n |= index.openTickets(newOwners) - ids
 
             return n
 
-        # The set of tickets that may be affected by this change.
-        affected = set()
-        # The changed ticket is affected
-        affected.add(str(ticket.id))
+        with index.lock:
+            # The set of tickets that may be affected by this change.
+            affected = set()
+            # The changed ticket is affected
+            affected.add(tid)
 
-        # Tickets referenced in old values
-        affected |= affectedByOld(old_values)
+            # Tickets referenced in old values
+            affected |= affectedByOld(old_values)
 
-        # Find all tickets reachable from the list we've built so far
-        #
-        # NOTE: The last loop finds all the tickets in explored that
-        # are adjacent to the border and pruning gives an empty set.
-        # You'd think I could stop one iteration earlier but I don't
-        # know how.
-        explored = set()
-        toExplore = affected
-        # FIXME - elsewhere I use "toExplore != set()".  Which is more
-        # efficient?  Or clearer?
-        while len(toExplore) != 0:
-            border = toExplore
-            toExplore = more(border)
-            toExplore -= explored
-            explored |= border
+            # Find all tickets reachable from the list we've built so far
+            explored = set()
+            toExplore = affected
+            while len(toExplore) != 0:
+                border = toExplore
+                toExplore = more(border)
+                toExplore -= explored
+                explored |= border
 
         return list(explored)
 
+    # Get the ticket index, creating it if needed.
+    def _ticketIndex(self):
+        with self.workerLock:
+            if self.ticketIndex is None:
+                self.ticketIndex = TicketIndex(self.pm)
+        return self.ticketIndex
+
+    # Keep the ticket index (if any) current as tickets change.
+    def _touchIndex(self, ticket, deleted=False):
+        if self.ticketIndex is not None:
+            if deleted:
+                self.ticketIndex.touch(str(ticket.id), None, None)
+            else:
+                self.ticketIndex.touch(str(ticket.id),
+                                       ticket['owner'], ticket['status'])
+
     # Clean up links to removed tickets
     def _repairGraph(self, tickets):
 
@@ -2590,11 +3844,14 @@ class TicketRescheduler(Component):
     #
     # @return list of hashes for tickets
     def queryTickets(self, ids):
-        options = {}
-        options['max'] = 0
-        options['id'] = "|".join(ids)
+        # We already know the IDs so load the tickets directly rather
+        # than going through a query string.  (On one connection, as
+        # TracPM.query() does.)
+        with self.env.db_query:
+            tickets = self.pm.loadTickets(set(), ids)
+            self.pm.postQuery({}, tickets)
 
-        return self.pm.query(options, set())
+        return tickets
 
     ##
     # Update in-memory relationships because other plugins' ticket
@@ -2740,35 +3997,53 @@ class TicketRescheduler(Component):
                             ticketsByID[tid][revField].append(ticket.id)
 
 
+    # Most rows _updateScheduleDB() writes in one transaction.  Keeps
+    # the write lock (all of SQLite) from being held for long.
+    writeChunkSize = 200
+
     # Update schedule and schedule_change tables in the database
     #
     # * Remove idle tickets from the schedule and put them in
-    #   schedule_change with NULL new start and finish (if open) or
-    #   final start, finish (if closed).
+    #   schedule_change, flagged idled, with NULL new start and finish
+    #   (if open) or final start, finish (if closed).
     # * Insert tickets which are not in schedule into it and put them
     #   in schedule_change with a NULL old start and finish
-    # * Update tickets which are in schedule and put their old and new
-    #   start aand finish in schedule_change.
+    # * Update tickets which are in schedule with a different start or
+    #   finish and put their old and new start and finish in
+    #   schedule_change.  Tickets whose schedule didn't change aren't
+    #   written.
+    #
+    # The current schedule is read first, then changes are written
+    # with executemany() in transactions of at most writeChunkSize
+    # tickets.
     def _updateScheduleDB(self, idle, tickets, profile):
-        with self.env.db_transaction as db:
-            cursor = db.cursor()
+        # All the history records need the same timestamp.
+        dbTime = to_utimestamp(datetime.now().replace(tzinfo=localtz))
 
-            # All the history records need the same timestamp.
-            dbTime = datetime.now().replace(tzinfo=localtz)
+        # Helper to write rows in bounded transactions.
+        #
+        # @param rows list of items to write
+        # @param write function to write a chunk of items with a cursor
+        def writeChunks(rows, write):
+            for i in range(0, len(rows), self.writeChunkSize):
+                with self.env.db_transaction as db:
+                    write(db.cursor(), rows[i:i + self.writeChunkSize])
+
+        if len(idle) != 0:
+            start = datetime.now()
 
-            if len(idle) != 0:
-                start = datetime.now()
-                # Remove idle tickets from schedule
-                inClause = 'IN (%s)' % ','.join(('%s',) * len(idle))
+            # Remove idle tickets from schedule and note idling in
+            # schedule history
+            def writeIdle(cursor, chunk):
+                inClause = 'IN (%s)' % ','.join(('%s',) * len(chunk))
                 cursor.execute('DELETE FROM schedule WHERE ticket ' + \
                                    inClause,
-                               [t['id'] for t in idle])
+                               [t['id'] for t in chunk])
 
-                # And note idling in schedule history
                 values = []
-                for t in idle:
+                for t in chunk:
                     value = (t['id'],
-                             to_utimestamp(dbTime),
+                             dbTime,
                              to_utimestamp(self.pm.start(t)),
                              to_utimestamp(self.pm.finish(t)))
 
@@ -2778,123 +4053,545 @@ class TicketRescheduler(Component):
                     else:
                         value += (None, None)
 
-                    values.append(value)
+                    values.append(value + (1,))
 
-                # Update schedule history
                 cursor.executemany('INSERT INTO schedule_change' + \
                                        ' (ticket, time,' + \
                                        ' oldstart, oldfinish,'
+                                       ' newstart, newfinish, idled)' + \
+                                       ' VALUES (%s,%s,%s,%s,%s,%s,%s)',
+                                   values)
+
+            writeChunks(idle, writeIdle)
+            end = datetime.now()
+            profile.append([ 'idling', len(idle), end - start ])
+
+        if len(tickets) != 0:
+            # Some "rescheduled" tickets had their schedule created
+            # for the first time, some had it changed.  We have to be
+            # able to choose between UPDATE (for those that changed)
+            # and INSERT (for the others).
+            #
+            # First, find which are already there and their old start,
+            # finish values.
+            oldValues = self.pm.savedSchedule(tickets)
+
+            # Second, sort tickets into changed and new, with their
+            # new start and finish.
+            toUpdate = []
+            toInsert = []
+            for t in tickets:
+                newValues = (to_utimestamp(self.pm.start(t)),
+                             to_utimestamp(self.pm.finish(t)))
+                if t['id'] not in oldValues:
+                    toInsert.append((t['id'], newValues))
+                elif oldValues[t['id']] != newValues:
+                    toUpdate.append((t['id'], newValues))
+
+            # Third, update the tickets that changed and add their history.
+            start = datetime.now()
+            def writeUpdates(cursor, chunk):
+                cursor.executemany('UPDATE schedule'
+                                   ' SET start=%s, finish=%s'
+                                   ' WHERE ticket=%s',
+                                   [newValues + (tid,)
+                                    for tid, newValues in chunk])
+                cursor.executemany('INSERT INTO schedule_change' + \
+                                       ' (ticket, time,' + \
+                                       ' oldstart, oldfinish,' + \
                                        ' newstart, newfinish)' + \
                                        ' VALUES (%s,%s,%s,%s,%s,%s)',
-                               values)
-                end = datetime.now()
-                profile.append([ 'idling', len(idle), end - start ])
+                                   [(tid, dbTime) + oldValues[tid] +
+                                    newValues
+                                    for tid, newValues in chunk])
 
-            ids = [t['id'] for t in tickets]
+            writeChunks(toUpdate, writeUpdates)
+            end = datetime.now()
+            profile.append([ 'updating', len(toUpdate), end - start ])
 
-            if len(tickets) != 0:
-                # Some "rescheduled" tickets had their schedule created
-                # for the first time, some had it changed.  We have to be
-                # able to choose between UPDATE (for those that changed)
-                # and INSERT (for the others).
-                #
-                # First, find which are already there.
-                # (Query and save old start, finish values at the same time.)
-                inClause = 'IN (%s)' % ','.join(('%s',) * len(ids))
-                cursor.execute('SELECT ticket, start, finish' + \
-                                   ' FROM schedule WHERE ticket ' + \
-                                   inClause,
-                               ids)
-                toUpdate = set()
-                historyValues = {}
+            # Fourth, insert tickets that aren't already in the
+            # schedule and add history records for them.
+            start = datetime.now()
+            def writeInserts(cursor, chunk):
+                cursor.executemany('INSERT INTO schedule' + \
+                                       ' (ticket, start, finish)' + \
+                                       ' VALUES (%s,%s,%s)',
+                                   [(tid,) + newValues
+                                    for tid, newValues in chunk])
+                # Old start and finish are null
+                cursor.executemany('INSERT INTO schedule_change' + \
+                                       ' (ticket, time,' + \
+                                       ' newstart, newfinish)' + \
+                                       ' VALUES (%s,%s,%s,%s)',
+                                   [(tid, dbTime) + newValues
+                                    for tid, newValues in chunk])
+
+            writeChunks(toInsert, writeInserts)
+            end = datetime.now()
+            profile.append([ 'inserting', len(toInsert), end - start ])
+
+        # Keep a copy of the schedule now and then for scheduleAsOf()
+        if len(idle) != 0 or len(tickets) != 0:
+            self.pm.checkpointSchedule(when=dbTime)
+
+
+    # Most tickets compactHistory() processes in one transaction.
+    historyBatch = 100
+
+    # Compact the schedule_change history table.
+    #
+    # Changes older than history_detail_days are collapsed so each
+    # ticket has at most one change per history_bucket_hours: the
+    # consecutive changes in a period become one row with the old
+    # start and finish of the first and the time and new start and
+    # finish of the last.  Collapsed rows with no net change are
+    # dropped.  Changes that idled a ticket are kept as they are and
+    # end a period's changes so closed tickets stay out of
+    # scheduleAsOf().  If history_retention_days is set, changes older
+    # than that are removed.  The first and last change to each
+    # ticket are always kept.
+    #
+    # Tickets are processed historyBatch at a time, each batch in its
+    # own transaction.
+    #
+    # @param now time to measure ages from (default, now)
+    #
+    # @return a list of the number of tickets examined, and rows
+    #   removed and updated
+    def compactHistory(self, now=None):
+        if now is None:
+            now = datetime.now().replace(tzinfo=localtz)
+        detailCutoff = to_utimestamp(now -
+                                     timedelta(days=self.historyDetailDays))
+        if self.historyRetentionDays > 0:
+            retentionCutoff = \
+                to_utimestamp(now - timedelta(days=self.historyRetentionDays))
+        else:
+            retentionCutoff = None
+        bucketSize = int(self.historyBucketHours * 3600 * 1000000) or 1
+
+        with self.env.db_query as db:
+            cursor = db.cursor()
+            cursor.execute('SELECT DISTINCT ticket FROM schedule_change' + \
+                               ' WHERE time < %s ORDER BY ticket',
+                           (detailCutoff,))
+            ids = [row[0] for row in cursor]
+
+        removed = 0
+        updated = 0
+        for i in range(0, len(ids), self.historyBatch):
+            chunk = ids[i:i + self.historyBatch]
+            with self.env.db_transaction as db:
+                cursor = db.cursor()
+                inClause = 'IN (%s)' % ','.join(('%s',) * len(chunk))
+                cursor.execute('SELECT ticket, time, oldstart, oldfinish,' + \
+                                   ' newstart, newfinish, idled' + \
+                                   ' FROM schedule_change' + \
+                                   ' WHERE ticket ' + inClause + \
+                                   ' ORDER BY ticket, time',
+                               chunk)
+                history = {}
                 for row in cursor:
-                    tid = row[0]
-                    oldStart = row[1]
-                    oldFinish = row[2]
+                    history.setdefault(row[0], []).append(row)
+
+                toDelete = []
+                toUpdate = []
+                for tid in history:
+                    # The first and last changes are kept as they are.
+                    rows = history[tid][1:-1]
+
+                    # Consecutive old changes in the same period
+                    groups = []
+                    for row in rows:
+                        when = row[1]
+                        if when >= detailCutoff:
+                            break
+                        if retentionCutoff and when < retentionCutoff:
+                            toDelete.append((tid, when))
+                        elif row[6]:
+                            # Start a new group after this
+                            groups.append([])
+                        elif groups and groups[-1] and \
+                                groups[-1][0][1] // bucketSize == \
+                                when // bucketSize:
+                            groups[-1].append(row)
+                        else:
+                            groups.append([row])
+
+                    for group in [g for g in groups if g]:
+                        first = group[0]
+                        last = group[-1]
+                        # The last row in the period stands for all
+                        # of them unless there's no net change.
+                        for row in group[:-1]:
+                            toDelete.append((tid, row[1]))
+                        if first[2:4] == last[4:6]:
+                            toDelete.append((tid, last[1]))
+                        elif len(group) > 1:
+                            toUpdate.append(first[2:4] + (tid, last[1]))
+
+                cursor.executemany('DELETE FROM schedule_change' + \
+                                       ' WHERE ticket=%s AND time=%s',
+                                   toDelete)
+                cursor.executemany('UPDATE schedule_change' + \
+                                       ' SET oldstart=%s, oldfinish=%s' + \
+                                       ' WHERE ticket=%s AND time=%s',
+                                   toUpdate)
+                removed += len(toDelete)
+                updated += len(toUpdate)
+
+        self.env.log.info('Compacted schedule history for %d tickets: '
+                          '%d changes removed, %d updated' %
+                          (len(ids), removed, updated))
+        return [ len(ids), removed, updated ]
+
+    # Merge changes into pending changes.
+    #
+    # When a ticket changed more than once, the earliest old value of
+    # each field is kept.
+    #
+    # @param pending old values indexed by ticket ID string, updated
+    # @param changes old values indexed by ticket ID string
+    def mergeChanges(self, pending, changes):
+        for tid in changes:
+            oldValues = pending.setdefault(tid, {})
+            for field in changes[tid]:
+                oldValues.setdefault(field, changes[tid][field])
+
+    # Handle changes to tickets.
+    #
+    # Inside a web request, changes are collected and handled once
+    # when the request ends (so, e.g., a batch modify of many tickets
+    # reschedules once).  Otherwise they are handled right away.
+    #
+    # @param changes old values indexed by ticket ID string
+    def _notify(self, changes):
+        deferred = getattr(self.deferred, 'changes', None)
+        if deferred is not None:
+            self.mergeChanges(deferred, changes)
+        else:
+            self._dispatch(changes)
+
+    # Handle changes deferred in this request, if any, and stop
+    # deferring.
+    def _flushDeferred(self):
+        changes = getattr(self.deferred, 'changes', None)
+        self.deferred.changes = None
+        if changes:
+            self._dispatch(changes)
+
+    # Reschedule now or hand the changes to the background worker, as
+    # configured.
+    #
+    # @param changes old values indexed by ticket ID string
+    def _dispatch(self, changes):
+        if self.rescheduleMode == 'background':
+            self._worker().notify(changes)
+        elif self.rescheduleMode == 'queue':
+            self.enqueueChanges(changes)
+        else:
+            self.rescheduleChanges(changes)
 
-                    historyValues[tid] = [ oldStart, oldFinish ]
+    # Add changes to the reschedule queue for "trac-admin pm worker".
+    #
+    # @param changes old values indexed by ticket ID string
+    def enqueueChanges(self, changes):
+        now = to_utimestamp(datetime.now().replace(tzinfo=localtz))
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            cursor.executemany('INSERT INTO pm_reschedule_queue' + \
+                                   ' (ticket, time, old_values)' + \
+                                   ' VALUES (%s,%s,%s)',
+                               [(int(tid), now, json.dumps(changes[tid]))
+                                for tid in changes])
 
-                    toUpdate.add(tid)
+    # Claim queued changes for this worker.
+    #
+    # Takes up to queueBatch changes, oldest first, that no worker has
+    # claimed or whose claim is older than lockTimeout (the worker
+    # that claimed them is assumed to have died).  The claim is set
+    # only on rows still unclaimed when it is written so two workers
+    # never get the same row.
+    #
+    # @param claim value identifying this worker's claim
+    #
+    # @return a list of [id, ticket, old_values] for the claimed rows
+    def _claimQueued(self, claim):
+        now = int(time.time())
+        stale = now - int(self.lockTimeout)
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            cursor.execute('SELECT id FROM pm_reschedule_queue' + \
+                               ' WHERE claim IS NULL OR claim_time < %s' + \
+                               ' ORDER BY id LIMIT %s',
+                           (stale, self.queueBatch))
+            ids = [row[0] for row in cursor.fetchall()]
+            if not ids:
+                return []
+            inClause = 'IN (%s)' % ','.join(('%s',) * len(ids))
+            cursor.execute('UPDATE pm_reschedule_queue' + \
+                               ' SET claim=%s, claim_time=%s' + \
+                               ' WHERE id ' + inClause + \
+                               ' AND (claim IS NULL OR claim_time < %s)',
+                           [claim, now] + ids + [stale])
+            cursor.execute('SELECT id, ticket, old_values' + \
+                               ' FROM pm_reschedule_queue' + \
+                               ' WHERE claim=%s ORDER BY id',
+                           (claim,))
+            return cursor.fetchall()
+
+    # Reschedule for the changes in the reschedule queue.
+    #
+    # Queued changes are claimed queueBatch rows at a time, oldest
+    # first, so concurrent workers split the queue.  Changes to the
+    # same ticket in a batch are merged and rescheduled once.  Rows
+    # are removed only after their reschedule finishes so a worker
+    # that stops part way leaves them for another once its claim goes
+    # stale (changes are handled at least once).
+    #
+    # @return the number of queued changes processed
+    def drainQueue(self):
+        total = 0
+        while True:
+            claim = '%d %s:%s' % (time.time(), os.getpid(),
+                                  threading.current_thread().ident)
+            rows = self._claimQueued(claim)
+            if not rows:
+                break
+
+            changes = {}
+            for qid, tid, oldValues in rows:
+                self.mergeChanges(changes,
+                                  {str(tid): json.loads(oldValues or '{}')})
+            self.rescheduleChanges(changes)
+
+            ids = [row[0] for row in rows]
+            with self.env.db_transaction as db:
+                cursor = db.cursor()
+                inClause = 'IN (%s)' % ','.join(('%s',) * len(ids))
+                cursor.execute('DELETE FROM pm_reschedule_queue' + \
+                                   ' WHERE claim=%s AND id ' + inClause,
+                               [claim] + ids)
 
-                # Second, update the tickets that are there.
-                # (Build before/after values as we go to update history next.)
-                start = datetime.now()
-                values = []
-                for t in tickets:
-                    if t['id'] in toUpdate:
-                        value = ()
-                        # Index history by ticket ID and time
-                        value += (t['id'],
-                                  to_utimestamp(dbTime))
-                        # Old start and finish
-                        value += (historyValues[t['id']][0],
-                                  historyValues[t['id']][1])
-                        # New start and finish
-                        value += (to_utimestamp(self.pm.start(t)),
-                                  to_utimestamp(self.pm.finish(t)))
+            self.env.log.info('Rescheduled for %d queued changes to %d'
+                              ' tickets' % (len(rows), len(changes)))
+            total += len(rows)
 
-                        values.append(value)
-
-                        cursor.execute('UPDATE schedule'
-                                       ' SET start=%s, finish=%s'
-                                       ' WHERE ticket=%s',
-                                       (to_utimestamp(self.pm.start(t)),
-                                        to_utimestamp(self.pm.finish(t)),
-                                        t['id']))
-
-
-                # Third, insert the history for the updated tickets.
-                if len(toUpdate) != 0:
-                    cursor.executemany('INSERT INTO schedule_change' + \
-                                           ' (ticket, time,' + \
-                                           ' oldstart, oldfinish,' + \
-                                           ' newstart, newfinish)' + \
-                                           ' VALUES (%s,%s,%s,%s,%s,%s)',
-                                       values)
-
-                end = datetime.now()
-                profile.append([ 'updating', len(toUpdate), end - start ])
-
-
-                # Fourth, insert tickets that aren't already in the schedule
-                toInsert = set(ids) - toUpdate
-                start = datetime.now()
-                if len(toInsert) != 0:
-                    values = []
-                    for t in tickets:
-                        if t['id'] in toInsert:
-                            value = (t['id'],
-                                     to_utimestamp(self.pm.start(t)),
-                                     to_utimestamp(self.pm.finish(t)))
-
-                            values.append(value)
-                    cursor.executemany('INSERT INTO schedule' + \
-                                           ' (ticket, start, finish)' + \
-                                           ' VALUES (%s,%s,%s)',
-                                       values)
-
-
-                    # Finally, add history records to schedule_change
-                    # for newly scheduled tickets.
-                    values = []
-                    for t in tickets:
-                        if t['id'] in toInsert:
-                            # Old start and finish are null
-                            value = (t['id'],
-                                     to_utimestamp(dbTime),
-                                     to_utimestamp(self.pm.start(t)),
-                                     to_utimestamp(self.pm.finish(t)))
-
-                            values.append(value)
-                    cursor.executemany('INSERT INTO schedule_change' + \
-                                           ' (ticket, time,' + \
-                                           ' newstart, newfinish)' + \
-                                           ' VALUES (%s,%s,%s,%s)',
-                                       values)
-
-                end = datetime.now()
-                profile.append([ 'inserting', len(toInsert), end - start ])
+        return total
 
+    # Get the background worker, starting it if needed.
+    def _worker(self):
+        with self.workerLock:
+            if self.worker is None:
+                self.worker = RescheduleWorker(self, self.debounce)
+                self.worker.start()
+        return self.worker
+
+    # Get the state of the background rescheduler.
+    #
+    # @return a hash with mode, queued (changed tickets waiting),
+    #   running (True while rescheduling), and lastRun,
+    #   lastRunDuration (seconds) and lastRunCount (changed tickets)
+    #   for the most recent reschedule (None, None, 0 if none yet)
+    def rescheduleStatus(self):
+        status = { 'mode': self.rescheduleMode,
+                   'queued': 0,
+                   'running': False,
+                   'lastRun': None,
+                   'lastRunDuration': None,
+                   'lastRunCount': 0 }
+        if self.rescheduleMode == 'queue':
+            with self.env.db_query as db:
+                cursor = db.cursor()
+                cursor.execute('SELECT COUNT(*) FROM pm_reschedule_queue')
+                status['queued'] = cursor.fetchone()[0]
+
+        worker = self.worker
+        if worker:
+            with worker.lock:
+                status['queued'] = len(worker.pending)
+                status['running'] = worker.running
+                status['lastRun'] = worker.lastRun
+                status['lastRunDuration'] = worker.lastRunDuration
+                status['lastRunCount'] = worker.lastRunCount
+        return status
+
+    # Names of rows in the system table used to run one reschedule at
+    # a time across processes:
+    #  * generationKey counts requests to reschedule
+    #  * doneKey is the generation of the last full reschedule saved
+    #  * lockKey exists while a reschedule runs; its value is the time
+    #    it was taken and who took it
+    generationKey = 'tracpm_reschedule_generation'
+    doneKey = 'tracpm_reschedule_done'
+    lockKey = 'tracpm_reschedule_lock'
+
+    # Seconds between checks while waiting for the reschedule lock
+    lockPoll = 0.2
+
+    # Get an integer counter from the system table.
+    #
+    # @param name name of the system table row
+    #
+    # @return the value or 0 if there is no such row
+    def _getCounter(self, name):
+        with self.env.db_query as db:
+            cursor = db.cursor()
+            cursor.execute('SELECT value FROM system WHERE name=%s',
+                           (name,))
+            row = cursor.fetchone()
+        if row:
+            return int(row[0])
+        return 0
+
+    # Set an integer counter in the system table, creating the row if
+    # needed.
+    #
+    # @param name name of the system table row
+    # @param value new value
+    # @param expected if not None, only set the counter if its value
+    #   is still expected
+    #
+    # @return True if the counter was set
+    def _setCounter(self, name, value, expected=None):
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            if expected is None:
+                cursor.execute('UPDATE system SET value=%s WHERE name=%s',
+                               (str(value), name))
+            else:
+                cursor.execute('UPDATE system SET value=%s' + \
+                                   ' WHERE name=%s AND value=%s',
+                               (str(value), name, str(expected)))
+            if cursor.rowcount == 1:
+                return True
+            cursor.execute('SELECT COUNT(*) FROM system WHERE name=%s',
+                           (name,))
+            if cursor.fetchone()[0] != 0:
+                return False
+            cursor.execute('INSERT INTO system (name, value)' + \
+                               ' VALUES (%s,%s)',
+                           (name, str(value)))
+            return True
+
+    # Count a request to reschedule.
+    #
+    # A compare-and-set so concurrent requests each get their own
+    # generation.
+    #
+    # @return the new generation
+    def _bumpGeneration(self):
+        while True:
+            generation = self._getCounter(self.generationKey)
+            try:
+                if self._setCounter(self.generationKey, generation + 1,
+                                    generation or None):
+                    return generation + 1
+            except self.env.db_exc.IntegrityError:
+                # Another process created the row first
+                pass
+
+    # Try to take the reschedule lock.
+    #
+    # A lock held longer than lockTimeout is taken to belong to a
+    # reschedule that died and is broken.
+    #
+    # @return the lock value to pass to _releaseLock() or None if
+    #   another reschedule holds the lock
+    def _acquireLock(self):
+        now = time.time()
+        value = '%.3f %s:%s' % (now, os.getpid(),
+                                threading.current_thread().ident)
+        try:
+            with self.env.db_transaction as db:
+                cursor = db.cursor()
+                cursor.execute('SELECT value FROM system WHERE name=%s',
+                               (self.lockKey,))
+                row = cursor.fetchone()
+                if row:
+                    if now - float(row[0].split()[0]) < self.lockTimeout:
+                        return None
+                    self.env.log.warning('Breaking stale reschedule lock'
+                                         ' "%s"' % row[0])
+                    cursor.execute('UPDATE system SET value=%s' + \
+                                       ' WHERE name=%s AND value=%s',
+                                   (value, self.lockKey, row[0]))
+                    if cursor.rowcount != 1:
+                        return None
+                else:
+                    cursor.execute('INSERT INTO system (name, value)' + \
+                                       ' VALUES (%s,%s)',
+                                   (self.lockKey, value))
+        except self.env.db_exc.IntegrityError:
+            # Another reschedule took the lock first
+            return None
+        return value
+
+    # Release the reschedule lock.
+    #
+    # @param value value returned by _acquireLock()
+    def _releaseLock(self, value):
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            cursor.execute('DELETE FROM system WHERE name=%s AND value=%s',
+                           (self.lockKey, value))
+
+    # Bring the time in the reschedule lock up to date so it isn't
+    # taken to be stale.
+    #
+    # @param value current value of the lock
+    #
+    # @return the new lock value (value if the lock was lost)
+    def _refreshLock(self, value):
+        newValue = '%.3f %s' % (time.time(), value.split(' ', 1)[1])
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            cursor.execute('UPDATE system SET value=%s' + \
+                               ' WHERE name=%s AND value=%s',
+                           (newValue, self.lockKey, value))
+            if cursor.rowcount == 1:
+                return newValue
+        self.env.log.warning('Reschedule lock "%s" was taken over' % value)
+        return value
+
+    # Call a function while holding the reschedule lock, keeping the
+    # lock fresh, then release the lock.
+    #
+    # @param lock value returned by _waitForLock()
+    # @param function function to call
+    # @param args arguments to pass to it
+    #
+    # @return what function returns
+    def _whileLocked(self, lock, function, *args):
+        refresher = LockRefresher(self, lock)
+        refresher.start()
+        try:
+            return function(*args)
+        finally:
+            self._releaseLock(refresher.stop())
+
+    # Wait for the reschedule lock.
+    #
+    # @param generation if not None, stop waiting once a reschedule
+    #   of this generation or later has been saved
+    #
+    # @return the lock value to pass to _releaseLock() or None if
+    #   there is no need to reschedule
+    def _waitForLock(self, generation=None):
+        while True:
+            lock = self._acquireLock()
+            if lock:
+                # A reschedule may have finished just before the lock
+                # was taken.
+                if generation is not None and \
+                        self._getCounter(self.doneKey) >= generation:
+                    self._releaseLock(lock)
+                    return None
+                return lock
+            if generation is not None and \
+                    self._getCounter(self.doneKey) >= generation:
+                return None
+            time.sleep(self.lockPoll)
 
     # Reschedule based on a ticket changing.
     #
@@ -2903,6 +4600,27 @@ class TicketRescheduler(Component):
     # No return.  The calculated start and finish dates in the ticket
     # database may be updated.
     def rescheduleTickets(self, ticket, old_values):
+        self.rescheduleChanges({str(ticket.id): old_values})
+
+    # Reschedule based on one or more tickets changing.
+    #
+    # Only one reschedule runs at a time, across processes.  Each
+    # request to save a reschedule counts a generation.  Changes
+    # reschedule only the tickets they can affect (see
+    # _findAffected()).  A full reschedule ("trac-admin pm
+    # reschedule") reads every active ticket so one that starts after
+    # the changes were saved covers them; a request that waits for the
+    # lock while such a reschedule finishes does nothing more.  Every
+    # reschedule that isn't a dry run saves its results; any it missed
+    # are requested after it started and saved when that request gets
+    # the lock.
+    #
+    # @param changes old values (as passed to TicketChangeListener)
+    #   indexed by ticket ID string
+    #
+    # No return.  The calculated start and finish dates in the ticket
+    # database may be updated.
+    def rescheduleChanges(self, changes):
         # If active statuses configured
         if not self.pm.activeGoalStatuses:
             self.env.log.info('Background ticket rescheduler requires' +
@@ -2910,23 +4628,106 @@ class TicketRescheduler(Component):
                               ' to be configured.')
             return
 
+        lock = self._waitForLock(self._bumpGeneration())
+        if lock is None:
+            self.env.log.info('Changes to %s rescheduled by another'
+                              ' request' % ', '.join(sorted(changes)))
+            return
+        self._whileLocked(lock, self._rescheduleLocked, changes)
+
+    # Reschedule for changes while holding the reschedule lock.
+    #
+    # Tickets not linked to the changed ones (directly or through an
+    # owner) are scheduled independently of them and keep their
+    # dates.  A deleted ticket's owner and links are gone by the time
+    # it is rescheduled for so deleting a ticket reschedules
+    # everything.
+    #
+    # @param changes old values indexed by ticket ID string
+    def _rescheduleLocked(self, changes):
         # Each step (e.g., finding, querying, pruning) has an entry
         # Each entry is [ step, ticketcount, time ]
         profile = []
 
+        nowActive, wasActive = self._activeTickets(profile)
+
+        if not [tid for tid in changes
+                if changes[tid].get(self.deletedKey)]:
+            start = datetime.now()
+            affected = set()
+            for tid in changes:
+                affected.update(self._findAffected(tid, changes[tid]))
+            nowActive &= affected
+            wasActive &= affected
+            end = datetime.now()
+            profile.append([ 'finding affected tickets',
+                             len(affected),
+                             end - start ])
+
+        # There are four possibilities for the state of each changed
+        # ticket relative to the sets of formerly or currently active
+        # tickets:
+        #
+        #  1. It wasn't and isn't active.
+        #    The schedule doesn't change.
+        #  2. It wasn't active (including didn't exist) and is now.
+        #    Active tickets need to be rescheduled to fit it in.
+        #  3. It was active and isn't now.
+        #    Active tickets needs to be rescheduled to fill in the gap.
+        #  4. It was and continues to be active.
+        #    The schedule needs to be adjusted for the change in
+        #    schedling attributes (dependency, estimated duration,
+        #    etc.)
+        #
+        #  So, if any was or is active, we have to reschedule.
+        reschedule = False
+        for tid in changes:
+            if tid in wasActive:
+                self.env.log.debug('%s was active' % tid)
+            else:
+                self.env.log.debug('%s was not active' % tid)
+            if tid in nowActive:
+                self.env.log.debug('%s is active' % tid)
+            else:
+                self.env.log.debug('%s is not active' % tid)
+            if tid in nowActive or tid in wasActive:
+                reschedule = True
+
+        # This covers only some tickets so it isn't recorded as a
+        # generation done.
+        if reschedule:
+            self._reschedule(nowActive, wasActive, profile)
+
+        for step in profile:
+            self.env.log.info('%s %s tickets took %s' %
+                              (step[0], step[1], step[2]))
+
+    # Find the tickets that are active now and those that were the
+    # last time the schedule was saved.
+    #
+    # @param profile list to add [ step, ticketcount, time ] entries to
+    # @param goals IDs of goals to consider (default, all active goals).
+    #   If given, no tickets are taken to have been active before.
+    #
+    # @return a list of two sets of ticket ID strings: now active
+    #   and was active
+    def _activeTickets(self, profile, goals=None):
         with self.env.db_query as db:
             cursor = db.cursor()
 
             # Get IDs of active goals
             start = datetime.now()
-            inClause = 'IN (%s)' % \
-                ','.join(('%s',) * len(self.pm.activeGoalStatuses))
-            cursor.execute('SELECT id FROM ticket' + \
-                               ' WHERE type = %s' + \
-                               ' AND status ' + inClause,
-                           [self.pm.goalTicketType] +
-                            self.pm.activeGoalStatuses)
-            activeGoals = ['%s' % row[0] for row in cursor]
+            if goals is None:
+                inClause = 'IN (%s)' % \
+                    ','.join(('%s',) * len(self.pm.activeGoalStatuses))
+                cursor.execute('SELECT id FROM ticket' + \
+                                   ' WHERE type = %s' + \
+                                   ' AND status ' + inClause,
+                               [self.pm.goalTicketType] +
+                                self.pm.activeGoalStatuses)
+                activeGoals = ['%s' % row[0] for row in cursor]
+            else:
+                activeGoals = list(goals)
             end = datetime.now()
             profile.append([ 'getting active goals',
                              len(activeGoals),
@@ -2937,7 +4738,10 @@ class TicketRescheduler(Component):
             # NOTE: This includes closed tickets which are predecessors of
             # work still to be done.
             start = datetime.now()
-            nowActive = self.pm.preQuery({'goal': '|'.join(activeGoals)})
+            if activeGoals:
+                nowActive = self.pm.preQuery({'goal': '|'.join(activeGoals)})
+            else:
+                nowActive = set()
             end = datetime.now()
             profile.append([ 'getting active tickets',
                              len(nowActive),
@@ -2948,71 +4752,75 @@ class TicketRescheduler(Component):
             # NOTE: In the steady state, there should be no closed tickets
             # in the schedule.  Why schedule work that is already complete?
             start = datetime.now()
-            cursor.execute('SELECT ticket FROM schedule')
-            wasActive = set(['%s' % row[0] for row in cursor])
+            if goals is None:
+                cursor.execute('SELECT ticket FROM schedule')
+                wasActive = set(['%s' % row[0] for row in cursor])
+            else:
+                wasActive = set()
             end = datetime.now()
             profile.append([ 'getting scheduled tickets',
                              len(wasActive),
                              end - start ])
 
-        # There are four possibilities for the state of the changed
-        # ticket relative to the sets of formerly or currently active
-        # tickets:
-        #
-        #  1. It wasn't and isn't active.
-        #    The schedule doesn't change.
-        #  2. It wasn't active (including didn't exist) and is now.
-        #    Active tickets need to be rescheduled to fit it in.
-        #  3. It was active and isn't now.
-        #    Active tickets needs to be rescheduled to fill in the gap.
-        #  4. It was and continues to be active.
-        #    The schedule needs to be adjusted for the change in
-        #    schedling attributes (dependency, estimated duration,
-        #    etc.)
-        #
-        #  So, if it was or is active, we have to reschedule.  That
-        #  requires getting the ticket details (dependencies,
-        #  estimates, etc.) for the scheduler.
-        start = datetime.now()
-        tid = str(ticket.id)
-        if tid in wasActive:
-            self.env.log.debug('%s was active' % tid)
-        else:
-            self.env.log.debug('%s was not active' % tid)
-        if tid in nowActive:
-            self.env.log.debug('%s is active' % tid)
-        else:
-            self.env.log.debug('%s is not active' % tid)
-        if tid in nowActive or tid in wasActive:
-            start = datetime.now()
+        return [ nowActive, wasActive ]
 
-            # Get ticket details of all tickets to process
-            details = self.queryTickets(wasActive | nowActive)
-
-            # Get the active tickets
-            tickets = [t for t in details if str(t['id']) in nowActive]
-            self.env.log.debug('There are %d active tickets' % len(tickets))
-
-            # Prune to those that aren't closed
-            self._pruneClosed(tickets)
-            self.env.log.debug('There are %d active, open tickets' %
-                               len(tickets))
-
-            # Update nowActive based on pruning
-            nowActive = set([str(t['id']) for t in tickets])
-
-            # Find idle tickets
-            idleIDs = wasActive - nowActive
-            self.env.log.debug('%d tickets were idled' % len(idleIDs))
-            idle = [t for t in details if str(t['id']) in idleIDs]
+    # Reschedule active tickets and save the new schedule.
+    #
+    # Gets the ticket details (dependencies, estimates, etc.) for the
+    # scheduler, drops closed tickets, computes the schedule and saves
+    # changes for rescheduled and idled tickets.
+    #
+    # @param nowActive set of ID strings of active tickets
+    # @param wasActive set of ID strings of tickets in the schedule
+    # @param profile list to add [ step, ticketcount, time ] entries to
+    # @param dryRun if True, don't save the results
+    # @param jobs number of processes to schedule independent groups
+    #   of tickets in (1, the default, schedules in this process)
+    # @param progress function called with progress messages
+    # @param generation if not None, the reschedule generation this
+    #   covers.  It is recorded as done when the results are saved.
+    #
+    # @return a list of the idled tickets and the rescheduled tickets
+    def _reschedule(self, nowActive, wasActive, profile,
+                    dryRun=False, jobs=1, progress=None, generation=None):
+        start = datetime.now()
 
-            end = datetime.now()
-            profile.append([ 'getting ticket details',
-                             len(details),
-                             end - start ])
-        else:
-            idle = []
-            tickets = []
+        # Get ticket details of all tickets to process
+        details = self.queryTickets(wasActive | nowActive)
+
+        # Get the active tickets
+        tickets = [t for t in details if str(t['id']) in nowActive]
+        self.env.log.debug('There are %d active tickets' % len(tickets))
+
+        # Prune to those that aren't closed
+        self._pruneClosed(tickets)
+        self.env.log.debug('There are %d active, open tickets' %
+                           len(tickets))
+
+        # Update nowActive based on pruning
+        nowActive = set([str(t['id']) for t in tickets])
+
+        # Find idle tickets
+        idleIDs = wasActive - nowActive
+        self.env.log.debug('%d tickets were idled' % len(idleIDs))
+        idle = [t for t in details if str(t['id']) in idleIDs]
+
+        # Deleted tickets have no details; idle them with their saved
+        # dates.
+        deleted = idleIDs - set([str(t['id']) for t in idle])
+        saved = self.pm.savedSchedule([{'id': int(tid)} for tid in deleted])
+        for tid in saved:
+            savedStart, savedFinish = saved[tid]
+            idle.append({'id': tid,
+                         'status': None,
+                         '_calc_start': [from_utimestamp(savedStart), True],
+                         '_calc_finish': [from_utimestamp(savedFinish),
+                                          True]})
+
+        end = datetime.now()
+        profile.append([ 'getting ticket details',
+                         len(details),
+                         end - start ])
 
         # Reschedule only if there are active tickets
         if len(tickets) != 0:
@@ -3020,7 +4828,10 @@ class TicketRescheduler(Component):
             self.env.log.info('Recomputing schedule with options:%s' %
                               self.options)
             start = datetime.now()
-            self.pm.recomputeSchedule(self.options, tickets)
+            if jobs > 1:
+                self._recomputeParallel(tickets, jobs, progress)
+            else:
+                self.pm.recomputeSchedule(self.options, tickets)
             end = datetime.now()
             profile.append(['rescheduling', len(tickets), end - start ])
 
@@ -3035,11 +4846,187 @@ class TicketRescheduler(Component):
             tickets = [t for t in tickets if not self.pm.isTracMilestone(t)]
 
         # Update the database for any rescheduled or idled tickets
-        self._updateScheduleDB(idle, tickets, profile)
+        if not dryRun:
+            self._updateScheduleDB(idle, tickets, profile)
+            if generation is not None:
+                self._setCounter(self.doneKey, generation)
+
+        return [ idle, tickets ]
+
+    # Split tickets into groups that can be scheduled independently.
+    # See TracPM.ticketGroups().
+    def _independentGroups(self, tickets):
+        return self.pm.ticketGroups(
+            tickets, self.options.get('doResourceLeveling') == '1')
+
+    # Like TracPM.recomputeSchedule() but schedule independent groups
+    # of tickets in a pool of processes.
+    #
+    # @param tickets list of tickets to schedule (updated in place)
+    # @param jobs number of processes
+    # @param progress function called with progress messages
+    def _recomputeParallel(self, tickets, jobs, progress=None):
+        import multiprocessing
+
+        groups = self._independentGroups(tickets)
+        byID = dict([(t['id'], t) for t in tickets])
+
+        pool = multiprocessing.Pool(jobs, _initRescheduleWorker,
+                                    (self.env.path,))
+        try:
+            results = pool.imap_unordered(_rescheduleGroup,
+                                          [(self.options, group)
+                                           for group in groups])
+            for i, result in enumerate(results):
+                for tid, values in result:
+                    byID[tid].update(values)
+                if progress:
+                    progress('Scheduled group %d of %d (%d tickets)' %
+                             (i + 1, len(groups), len(result)))
+        finally:
+            pool.close()
+            pool.join()
+
+    # IRequestFilter methods
+    #
+    # Changes made by ticket and batch modify POSTs, which end in a
+    # redirect, are deferred until the redirect (or until
+    # post_process_request(), which Trac also calls when the request
+    # fails).  Other requests, which may send their own response
+    # (e.g., XML-RPC) and so get neither, handle changes right away.
+    # Changes a deferring request still left somehow are handled when
+    # the next request on the thread starts.
+
+    # Paths of requests whose changes are deferred
+    deferPath = re.compile(r'/(newticket|ticket/\d+|batchmodify)$')
+
+    def pre_process_request(self, req, handler):
+        self._flushDeferred()
+
+        # Trac before 1.0 has no redirect listeners; don't defer.
+        if req.method == 'POST' and self.deferPath.match(req.path_info) \
+                and hasattr(req, 'add_redirect_listener'):
+            self.deferred.changes = {}
+            req.add_redirect_listener(
+                lambda req, url, permanent: self._flushDeferred())
+
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        self._flushDeferred()
+        return template, data, content_type
+
+    # IAdminCommandProvider methods
+
+    def get_admin_commands(self):
+        yield ('pm worker', '[poll]',
+               """Reschedule for ticket changes in the reschedule queue
+
+               Reschedules until the queue is empty then exits or, if
+               poll is given, checks the queue again every poll
+               seconds.  Use with [TracPM] reschedule_mode = queue.""",
+               None, self._do_worker)
+        yield ('pm reschedule', '[--goal ID] [--dry-run] [--jobs N]',
+               """Recompute and save the whole schedule
+
+               Reschedules the tickets for all active goals as a ticket
+               change would.  With --dry-run, reports how many tickets
+               would get new dates without saving.  --goal reschedules
+               only the tickets for goal ID, without leveling resources
+               against other goals or idling tickets, and implies
+               --dry-run since that schedule can't be saved.  With
+               --jobs, independent groups of tickets are scheduled in N
+               processes.""",
+               None, self._do_reschedule)
+        yield ('pm compact-history', '',
+               """Compact the schedule history
+
+               Collapses and removes old schedule changes as set by the
+               history_detail_days, history_bucket_hours and
+               history_retention_days options in [TracPM].""",
+               None, self._do_compact_history)
+
+    def _do_worker(self, poll=None):
+        if poll is not None:
+            try:
+                poll = float(poll)
+            except ValueError:
+                raise AdminCommandError('Invalid poll interval "%s"' % poll)
+
+        while True:
+            count = self.drainQueue()
+            if count:
+                printout('Rescheduled for %d queued changes' % count)
+            if poll is None:
+                break
+            time.sleep(poll)
+
+    def _do_reschedule(self, *args):
+        goals = None
+        dryRun = False
+        jobs = 1
+        args = list(args)
+        while args:
+            arg = args.pop(0)
+            if arg == '--dry-run':
+                dryRun = True
+            elif arg in ('--goal', '--jobs') and args:
+                value = args.pop(0)
+                if not value.isdigit():
+                    raise AdminCommandError('Invalid %s value "%s"' %
+                                            (arg, value))
+                if arg == '--goal':
+                    goals = (goals or []) + [value]
+                else:
+                    jobs = max(1, int(value))
+            else:
+                raise AdminCommandError('Invalid argument "%s"' % arg)
+
+        if not self.pm.activeGoalStatuses:
+            raise AdminCommandError('Rescheduling requires goal ticket'
+                                    ' type and active goal statuses to'
+                                    ' be configured.')
+
+        # Tickets for some goals, scheduled alone, would be wrong in
+        # the shared schedule.
+        if goals is not None and not dryRun:
+            printout('--goal implies --dry-run')
+            dryRun = True
+
+        # Only a full reschedule that is saved covers every change so
+        # far.
+        if goals is None and not dryRun:
+            generation = self._bumpGeneration()
+        else:
+            generation = None
+
+        def reschedule():
+            nowActive, wasActive = self._activeTickets(profile, goals)
+            printout('%d active tickets, %d scheduled before' %
+                     (len(nowActive), len(wasActive)))
+            return self._reschedule(nowActive, wasActive, profile,
+                                    dryRun, jobs, printout, generation)
+
+        profile = []
+        idle, tickets = self._whileLocked(self._waitForLock(), reschedule)
 
         for step in profile:
-            self.env.log.info('%s %s tickets took %s' %
-                              (step[0], step[1], step[2]))
+            printout('%s %s tickets took %s' % (step[0], step[1], step[2]))
+        if dryRun:
+            saved = self.pm.savedSchedule(tickets)
+            changed = [t for t in tickets
+                       if saved.get(t['id']) !=
+                       (to_utimestamp(self.pm.start(t)),
+                        to_utimestamp(self.pm.finish(t)))]
+            printout('%d tickets would get new dates, %d idled'
+                     ' (not saved)' % (len(changed), len(idle)))
+        else:
+            printout('%d tickets rescheduled, %d idled' %
+                     (len(tickets), len(idle)))
+
+    def _do_compact_history(self):
+        printout('Compacted history for %d tickets: %d changes removed, '
+                 '%d updated' % tuple(self.compactHistory()))
 
     # ITicketChangeListener methods
     #
@@ -3048,16 +5035,103 @@ class TicketRescheduler(Component):
 
     def ticket_created(self, ticket):
         self.env.log.info('Ticket %s created.' % ticket.id)
-        self.rescheduleTickets(ticket, {})
+        self._touchIndex(ticket)
+        self._notify({str(ticket.id): {}})
 
 
     def ticket_changed(self, ticket, comment, author, old_values):
+        self._touchIndex(ticket)
         if self._affectsSchedule(ticket, old_values):
             self.env.log.info('Changes to %s affect schedule.  Rescheduling.' %
                               ticket.id)
-            self.rescheduleTickets(ticket, old_values)
+            self._notify({str(ticket.id): old_values})
 
 
     def ticket_deleted(self, ticket):
         self.env.log.info('Ticket %s deleted.' % ticket.id)
-        self.rescheduleTickets(ticket, {})
+        self._touchIndex(ticket, deleted=True)
+        self._notify({str(ticket.id): {self.deletedKey: True}})
+
+# ========================================================================
+# What-if scheduling over HTTP.
+#
+# GET (or POST) /pm/simulate with query options (as for the Gantt
+# chart macro: milestone=..., goal=..., etc.), optional schedule
+# options (schedule, hoursPerDay, doResourceLeveling), and overrides,
+# a JSON-encoded hash as described for TracPM.simulate().
+#
+# The response is a JSON list of tickets whose dates would change,
+# each with id, start, and finish ([before, after] ISO 8601 dates).
+class TracPMSimulator(Component):
+    implements(IRequestHandler)
+
+    # Options which affect scheduling rather than the query
+    scheduleOptions = ('schedule', 'hoursPerDay', 'doResourceLeveling',
+                       'useActuals')
+
+    def __init__(self):
+        self.pm = TracPM(self.env)
+
+    # IRequestHandler methods
+
+    def match_request(self, req):
+        return req.path_info == '/pm/simulate'
+
+    def process_request(self, req):
+        req.perm.require('TICKET_VIEW')
+
+        try:
+            overrides = json.loads(req.args.get('overrides') or '{}')
+        except ValueError, e:
+            raise HTTPBadRequest('Invalid overrides: %s' % e)
+        if not isinstance(overrides, dict):
+            raise HTTPBadRequest('Invalid overrides: not an object')
+
+        options = {
+            'schedule': self.config.get('TracPM', 'option.schedule', 'asap'),
+            'hoursPerDay': self.config.get('TracPM', 'option.hoursPerDay',
+                                           '6.0'),
+            'doResourceLeveling':
+                self.config.get('TracPM', 'option.doResourceLeveling', '1'),
+            }
+        queryOptions = {}
+        for key in req.args.keys():
+            if key in ('overrides', '__FORM_TOKEN'):
+                continue
+            elif key in self.scheduleOptions:
+                options[key] = req.args[key]
+            else:
+                queryOptions[key] = req.args[key]
+        try:
+            hoursPerDay = float(options['hoursPerDay'])
+        except (TypeError, ValueError):
+            hoursPerDay = 0
+        if not 0 < hoursPerDay <= 24:
+            raise HTTPBadRequest('Invalid hoursPerDay "%s"' %
+                                 options['hoursPerDay'])
+        options['hoursPerDay'] = hoursPerDay
+
+        fields = set(['owner', 'type', 'status', 'milestone', 'priority'])
+        tickets = self.pm.query(queryOptions, fields, req)
+
+        # Milestone pseudo-tickets have negative IDs and no ticket
+        # permissions
+        tickets = [t for t in tickets
+                   if t['id'] < 0 or
+                   'TICKET_VIEW' in req.perm('ticket', t['id'])]
+
+        try:
+            changes = self.pm.simulate(options, tickets, overrides)
+        except TracError, e:
+            raise HTTPBadRequest(unicode(e))
+
+        def isoDate(d):
+            if d:
+                return d.isoformat()
+            return None
+
+        result = [{'id': c['id'],
+                   'start': [isoDate(d) for d in c['start']],
+                   'finish': [isoDate(d) for d in c['finish']]}
+                  for c in changes]
+        req.send(json.dumps(result), 'application/json')